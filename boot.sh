@@ -1,4 +1,6 @@
 source /opt/envs/tuin/bin/activate
+# apply schema migrations
+FLASK_APP=fromflask.py flask db-upgrade
 # launch rq worker
 exec rq worker tuin-tasks &
 # flask run &
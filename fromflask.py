@@ -1,4 +1,6 @@
+import click
 from tuin import create_app, lm
+from tuin.lib import db_migrate, db_model
 
 
 # Run Application
@@ -8,3 +10,39 @@ app = create_app()
 @app.shell_context_processor
 def make_shell_context():
     return dict(app=app, lm=lm)
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search():
+    """
+    Create or rebuild the full-text search index from the content table.
+    """
+    cnt = db_model.search_index_rebuild()
+    click.echo("Search index rebuilt for {cnt} nodes.".format(cnt=cnt))
+
+
+@app.cli.command("rebuild-archive")
+def rebuild_archive():
+    """
+    Create or rebuild the archive table with the number of nodes per month.
+    """
+    cnt = db_model.Archive.rebuild()
+    click.echo("Archive rebuilt for {cnt} months.".format(cnt=cnt))
+
+
+@app.cli.command("flush-history")
+def flush_history():
+    """
+    Write the buffered page views to the history table.
+    """
+    cnt = db_model.History.flush()
+    click.echo("History: {cnt} views written.".format(cnt=cnt))
+
+
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """
+    Apply the schema migrations that are not yet done on the database.
+    """
+    applied = db_migrate.upgrade()
+    click.echo("Migrations applied: {a}, schema version {v}.".format(a=applied or "none", v=db_migrate.get_version()))
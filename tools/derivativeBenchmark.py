@@ -0,0 +1,92 @@
+"""
+This script compares the creation of the medium and small pictures from the full resolution decode (previous method)
+with the draft mode decode in photo_handler.make_derivatives. For each jpeg in the directory the time, the decoded
+size and the quality of the medium picture (PSNR against the previous method) are printed. The small picture is not
+compared, the previous method created it from the medium picture and make_derivatives creates it from the decoded
+picture, so the size can be different.
+
+Usage: python derivativeBenchmark.py <directory with jpeg pictures>
+"""
+import io
+import math
+import os
+import sys
+import time
+from PIL import Image, ImageChops, ImageFile, ImageStat
+from PIL.Image import LANCZOS
+from tuin.lib import photo_handler
+
+
+def legacy_derivatives(file, content):
+    """
+    This function creates the medium and small picture as photo_handler did before draft mode: full resolution decode,
+    resize to medium, rotate and resize medium to small.
+
+    :param file: Filename of the picture.
+    :param content: (binary) contents of the picture.
+    :return: decoded size and medium picture as jpeg bytes.
+    """
+    parser = ImageFile.Parser()
+    parser.feed(content)
+    img = parser.close()
+    exif = photo_handler.get_labeled_exif(file, img)
+    medium_img = img.resize(photo_handler.resize_large(img.size, photo_handler.MEDIUM_SIZE), resample=LANCZOS)
+    angles = {3: 180, 6: -90, 8: 90}
+    if isinstance(exif, dict) and exif.get("Orientation") in angles:
+        medium_img = medium_img.rotate(angles[exif["Orientation"]], expand=True)
+    # The small picture is created for the timing only.
+    photo_handler.to_jpeg(photo_handler.to_small(medium_img))
+    return img.size, photo_handler.to_jpeg(medium_img)
+
+
+def draft_size(content):
+    """
+    This function returns the size that the draft mode decoder will use for the medium picture.
+
+    :param content: (binary) contents of the picture.
+    :return: (width, height) of the decoded picture.
+    """
+    img = Image.open(io.BytesIO(content))
+    img.draft(img.mode, photo_handler.resize_large(img.size, photo_handler.MEDIUM_SIZE))
+    return img.size
+
+
+def psnr(reference, picture):
+    """
+    This function calculates the peak signal-to-noise ratio of the picture against the reference picture.
+
+    :param reference: Reference picture (jpeg bytes).
+    :param picture: Picture to compare (jpeg bytes).
+    :return: PSNR in dB, or None if the sizes are different.
+    """
+    ref_img = Image.open(io.BytesIO(reference)).convert("RGB")
+    pic_img = Image.open(io.BytesIO(picture)).convert("RGB")
+    if ref_img.size != pic_img.size:
+        return None
+    diff = ImageChops.difference(ref_img, pic_img)
+    mse = sum(ms for ms in ImageStat.Stat(diff).sum2) / (3 * ref_img.size[0] * ref_img.size[1])
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+fd = sys.argv[1]
+totals = dict(legacy=0.0, draft=0.0)
+print("file;size;decoded;legacy (s);draft (s);psnr medium (dB)")
+for file in sorted(os.listdir(fd)):
+    if os.path.splitext(file)[1].lower() != ".jpg":
+        continue
+    with open(os.path.join(fd, file), "rb") as fh:
+        content = fh.read()
+    start = time.perf_counter()
+    orig_size, legacy_medium = legacy_derivatives(file, content)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _, medium, _ = photo_handler.make_derivatives(file, content)
+    draft_time = time.perf_counter() - start
+    totals["legacy"] += legacy_time
+    totals["draft"] += draft_time
+    line = "{};{}x{};{}x{};{:.3f};{:.3f};{:.1f}"
+    print(line.format(file, *orig_size, *draft_size(content), legacy_time, draft_time,
+                      psnr(legacy_medium, medium) or 0))
+print("Total legacy: {:.2f}s, draft: {:.2f}s".format(totals["legacy"], totals["draft"]))
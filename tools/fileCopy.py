@@ -1,16 +1,41 @@
 """
-This script copies a set of files from one directory to another directory.
+This script copies a set of files from one directory to another directory. The copy requests run concurrently.
 """
 
+import asyncio
 import csv
 import logging
 import os
-from tuin.lib import my_env, pcloud_handler
+from tuin.lib import my_env
+from tuin.lib.async_pcloud_handler import AsyncPcloudHandler
 
 
 from_dirname = "original"
 to_dirname = "tempOrigin"
 
+
+async def copy_files(filenames):
+    """
+    This function copies the files from the from directory to the to directory.
+
+    :param filenames: List of filenames to copy.
+    :return:
+    """
+    async with AsyncPcloudHandler() as pcloud:
+        public_cloud_id = os.getenv("PCLOUD_PUBLIC_ID")
+        subdirs, files = await pcloud.folder_contents(public_cloud_id)
+        print(subdirs)
+        from_dirid = subdirs[from_dirname]["folderid"]
+        to_dirid = subdirs[to_dirname]["folderid"]
+        _, from_files = await pcloud.folder_contents(from_dirid)
+        copies = []
+        for file in filenames:
+            file_id = from_files[file]["fileid"]
+            print("Copy file {} with ID {} to folder with ID {}".format(file, file_id, to_dirid))
+            copies.append(pcloud.copyfile(file_id, to_dirid))
+        await asyncio.gather(*copies)
+
+
 my_env.init_env("tuin", __file__)
 
 # Get filenames for files to be converted
@@ -18,20 +43,9 @@ fd = os.getenv('LOGDIR')
 fn = 'recent_img'
 fln = os.path.join(fd, '{}.csv'.format(fn))
 
-pcloud = pcloud_handler.PcloudHandler()
-public_cloud_id = os.getenv("PCLOUD_PUBLIC_ID")
-subdirs, files = pcloud.folder_contents(public_cloud_id)
-print(subdirs)
-from_dirid = subdirs[from_dirname]["folderid"]
-to_dirid = subdirs[to_dirname]["folderid"]
-_, from_files = pcloud.folder_contents(from_dirid)
 with open(fln, 'r', newline='') as csvfile:
     reader = csv.DictReader(csvfile)
-    for row in reader:
-        file = row["filename"]
-        file_id = from_files[file]["fileid"]
-        print("Copy file {} with ID {} to folder with ID {}".format(file, file_id, to_dirid))
-        pcloud.copyfile(file_id, to_dirid)
-pcloud.logout()
+    filenames = [row["filename"] for row in reader]
+asyncio.get_event_loop().run_until_complete(copy_files(filenames))
 
 logging.info("End Application")
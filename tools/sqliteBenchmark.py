@@ -0,0 +1,117 @@
+"""
+This script measures the read latency of the picture overview query while another process writes nodes, as the
+ingestion job does. It runs once with the default SQLite settings (rollback journal) and once with the pragma profile
+from db_model.SQLITE_PRAGMAS, on a scratch database. For each run the number of reads, the read latency (median, 95th
+percentile and maximum), the number of failed reads (database is locked) and the number of write transactions are
+printed.
+
+Usage: python sqliteBenchmark.py [seconds per run, default 10] [directory for the database, default current directory]
+Use a directory on the disk of the database: on a tmpfs fsync costs nothing and both runs are alike.
+"""
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from tuin.lib.db_model import set_engine, SQLITE_PRAGMAS
+
+NODES = 20000
+READ_QUERY = "SELECT id, created, type FROM node WHERE type IN ('photo', 'lophoto') ORDER BY created DESC LIMIT 24"
+
+
+def create_db(ffn):
+    """
+    This function creates the scratch database with the node table and index from the tuin schema.
+
+    :param ffn: Full filename of the database.
+    :return:
+    """
+    engine = set_engine("sqlite:///{}".format(ffn), pragmas={})
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE node (id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL, "
+                          "created INTEGER NOT NULL, modified INTEGER NOT NULL, revcnt INTEGER, type TEXT)"))
+        conn.execute(text("CREATE INDEX ix_node_type_created ON node (type, created)"))
+        rows = [dict(created=1500000000 + cnt * 60, type="photo" if cnt % 3 else "blog") for cnt in range(NODES)]
+        conn.execute(text("INSERT INTO node (parent_id, created, modified, revcnt, type) "
+                          "VALUES (-1, :created, :created, 1, :type)"), rows)
+    engine.dispose()
+
+
+def writer(ffn, pragmas, stop, commits):
+    """
+    This function writes nodes in small transactions until stop is set, as the ingestion job does.
+
+    :param ffn: Full filename of the database.
+    :param pragmas: Pragmas for the connection.
+    :param stop: Event to stop the writer.
+    :param commits: Shared counter for the committed transactions.
+    :return:
+    """
+    engine = set_engine("sqlite:///{}".format(ffn), pragmas=pragmas)
+    created = 1600000000
+    while not stop.is_set():
+        try:
+            with engine.begin() as conn:
+                for _ in range(20):
+                    created += 1
+                    conn.execute(text("INSERT INTO node (parent_id, created, modified, revcnt, type) "
+                                      "VALUES (-1, :created, :created, 1, 'photo')"), dict(created=created))
+                    conn.execute(text("UPDATE node SET modified = :created WHERE id = 1"), dict(created=created))
+            commits.value += 1
+        except OperationalError:
+            pass
+
+
+def reader(ffn, pragmas, seconds):
+    """
+    This function runs the picture overview query for seconds and collects the latencies.
+
+    :param ffn: Full filename of the database.
+    :param pragmas: Pragmas for the connection.
+    :param seconds: Duration of the run.
+    :return: list of latencies in ms, number of failed reads.
+    """
+    engine = set_engine("sqlite:///{}".format(ffn), pragmas=pragmas)
+    latencies = []
+    failed = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                conn.execute(text(READ_QUERY)).fetchall()
+        except OperationalError:
+            failed += 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, failed
+
+
+def run(label, pragmas, seconds, directory):
+    with tempfile.TemporaryDirectory(dir=directory) as tmpdir:
+        ffn = os.path.join(tmpdir, "bench.db")
+        create_db(ffn)
+        stop = multiprocessing.Event()
+        commits = multiprocessing.Value("i", 0)
+        proc = multiprocessing.Process(target=writer, args=(ffn, pragmas, stop, commits))
+        proc.start()
+        time.sleep(0.5)
+        latencies, failed = reader(ffn, pragmas, seconds)
+        stop.set()
+        proc.join()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+    print("{};{};{:.2f};{:.2f};{:.2f};{};{}".format(label, len(latencies), statistics.median(latencies or [0]), p95,
+                                                    max(latencies or [0]), failed, commits.value))
+
+
+seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+directory = sys.argv[2] if len(sys.argv) > 2 else os.getcwd()
+# Default settings, with the busy timeout of the profile.
+default_pragmas = dict(busy_timeout=5000)
+print("settings;reads;median (ms);p95 (ms);max (ms);failed;writes")
+run("default", default_pragmas, seconds, directory)
+run("profile", SQLITE_PRAGMAS, seconds, directory)
@@ -24,7 +24,8 @@ def create_app(config_class=Config):
 
     app = Flask(__name__)
 
-    # import configuration
+    # import configuration, static files are cached by the browser for a week unless configured otherwise.
+    app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 7 * 24 * 3600
     app.config.from_object(config_class)
 
     # Configure Logger, except for Test
@@ -38,6 +39,9 @@ def create_app(config_class=Config):
     bootstrap.init_app(app)
     db.init_app(app)
     lm.init_app(app)
+    from tuin.lib.db_model import init_engine
+    with app.app_context():
+        init_engine(db.engine, app.config.get("SQLITE_PRAGMAS"))
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('tuin-tasks', connection=app.redis)
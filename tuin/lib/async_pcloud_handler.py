@@ -0,0 +1,280 @@
+"""
+This module has the asyncio version of the pcloud handler. It has the same methods as PcloudHandler, but each method is
+a coroutine. Requests share a bounded connection pool and the number of requests in flight is limited, so bulk
+operations (copy a list of files, load a batch of pictures) can run many requests concurrently. Errors, retries and the
+circuit breaker are shared with PcloudHandler.
+
+Usage:
+    async with AsyncPcloudHandler() as pcloud:
+        subdirs, files = await pcloud.folder_contents(folderid)
+        await asyncio.gather(*[pcloud.copyfile(file["fileid"], tofolderid) for file in files.values()])
+"""
+import aiohttp
+import asyncio
+import logging
+import os
+from tuin.lib.pcloud_handler import backoff, breaker, check_result, check_status, PcloudConnectionError, PcloudError, \
+    RETRIES, TIMEOUT
+
+# Maximum number of requests in flight.
+CONCURRENCY = 16
+# Maximum number of connections in the pool.
+POOL_SIZE = 16
+# Chunk size for streamed downloads.
+CHUNK_SIZE = 256 * 1024
+
+
+class AsyncPcloudHandler:
+
+    """
+    This class consolidates the pcloud functionality for asyncio. Login is done on entering the context manager (or by
+    calling login), logout and closing the connection pool on exit.
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, pool_size=POOL_SIZE, url_base=None, timeout=TIMEOUT, retries=RETRIES):
+        """
+        Initialization of the handler, no connection is done yet.
+
+        :param concurrency: Maximum number of requests in flight.
+        :param pool_size: Maximum number of connections in the pool.
+        :param url_base: pcloud API URL, default from PCLOUD_HOME.
+        :param timeout: Timeout (connect, read) in seconds for each request.
+        :param retries: Number of retries for idempotent requests.
+        """
+        self.url_base = url_base or os.getenv("PCLOUD_HOME")
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.retries = retries
+        self.semaphore = None
+        self.session = None
+        self.auth = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close_connection()
+
+    async def _get(self, method, params=None, action=None, idempotent=True):
+        """
+        This method calls the pcloud API method and returns the json result. The json result field is checked.
+
+        :param method: pcloud API method.
+        :param params: Dictionary with parameters for the method.
+        :param action: Description of the action, for log and error messages. Default: method.
+        :param idempotent: True if the request can be retried.
+        :return: json result.
+        """
+        action = action or method
+        # Query parameters without value are not sent.
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        if self.auth:
+            params["auth"] = self.auth
+
+        async def send():
+            async with self.session.get(self.url_base + method, params=params) as r:
+                check_status(r.status, r.reason, action)
+                res = await r.json(content_type=None)
+            check_result(res, action)
+            return res
+        return await self._retry(send, action, idempotent)
+
+    async def _retry(self, send, action, idempotent=True):
+        """
+        This method sends a request within the concurrency limit. Temporary failures are retried with backoff if the
+        request is idempotent. The semaphore is released while waiting for the next attempt.
+
+        :param send: Coroutine function that sends the request and checks the response.
+        :param action: Description of the action, for log and error messages.
+        :param idempotent: True if the request can be retried.
+        :return: Result of send.
+        """
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(1, attempts + 1):
+            breaker.check()
+            try:
+                async with self.semaphore:
+                    res = await send()
+            except PcloudError as exc:
+                error = exc
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                error = PcloudConnectionError("Could not {a}. {e}".format(a=action, e=repr(exc)))
+            else:
+                breaker.success()
+                return res
+            if error.retryable:
+                breaker.failure()
+            else:
+                # pcloud answered, the request itself is not accepted.
+                breaker.success()
+            if not error.retryable or attempt == attempts:
+                logging.critical(str(error))
+                raise error
+            delay = backoff(attempt)
+            msg = "{e} Attempt {a} of {t}, retry in {d:.1f} seconds.".format(e=error, a=attempt, t=attempts, d=delay)
+            logging.warning(msg)
+            await asyncio.sleep(delay)
+
+    async def close_connection(self):
+        """
+        Logout from pcloud and close the connection pool.
+
+        :return:
+        """
+        if self.auth:
+            await self.logout()
+        await self.session.close()
+
+    async def copyfile(self, fileid, tofolderid):
+        """
+        This method copies a file to a destination folder.
+
+        :param fileid: ID of the file to be copied.
+        :param tofolderid: Target folder.
+        :return:
+        """
+        return await self._get("copyfile", dict(fileid=fileid, tofolderid=tofolderid), "copy file", idempotent=False)
+
+    async def folder_contents(self, folderid=None, foldername=None):
+        """
+        This method gets a pcloud folder ID and returns a dictionary with sub-directory contents and a dictionary with
+        file contents
+
+        :param folderid: ID of the folder (preferred)
+        :param foldername: Name of the folder.
+        :return: subdirectory contents, files contents
+        """
+        subdirs = {}
+        files = {}
+        res = await self.listfolder(folderid, foldername)
+        for content in res["metadata"]["contents"]:
+            if content["isfolder"]:
+                subdirs[content["name"]] = content
+            else:
+                files[content["name"]] = content
+        return subdirs, files
+
+    async def get_content(self, file, length=None):
+        """
+        This method returns the contents of the file. The file is downloaded in a single streamed request from a file
+        link. If length is specified, then only the leading bytes of the file are downloaded.
+
+        :param file: Dictionary with file information.
+        :param length: Number of leading bytes to return. Default: complete file.
+        :return: (binary) contents of the file.
+        """
+        res = await self._get("getfilelink", dict(fileid=file["fileid"]), "get file link")
+        # File link has the same scheme as the API.
+        scheme = self.url_base.split(":")[0]
+        url = "{scheme}://{host}{path}".format(scheme=scheme, host=res["hosts"][0], path=res["path"])
+        return await self.download(url, length)
+
+    async def download(self, url, length=None):
+        """
+        This method downloads the file link in chunks.
+
+        :param url: File link.
+        :param length: Number of leading bytes to return. Default: complete file.
+        :return: (binary) contents of the file.
+        """
+        headers = {}
+        if length:
+            headers["Range"] = "bytes=0-{end}".format(end=length - 1)
+
+        async def send():
+            contents = bytearray()
+            async with self.session.get(url, headers=headers) as r:
+                check_status(r.status, r.reason, "download file", accepted=(200, 206))
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    contents.extend(chunk)
+                    if length and len(contents) >= length:
+                        break
+            return contents
+        contents = await self._retry(send, "download file")
+        if length:
+            return bytes(contents[:length])
+        return bytes(contents)
+
+    async def listfolder(self, folderid=None, foldername=None):
+        """
+        This method will get a folder ID and return json string with folder information.
+
+        :param folderid: ID of the folder for which the info is required (int)
+        :param foldername: Name of the folder (string).
+        :return:
+        """
+        if folderid:
+            params = dict(folderid=folderid)
+        elif foldername:
+            params = dict(path=foldername)
+        else:
+            logging.error("Listfolder called without specifying foldername or ID")
+            return
+        return await self._get("listfolder", params, "collect metadata")
+
+    async def login(self):
+        """
+        This method opens the connection pool and logs in to pcloud.
+
+        :return:
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        params = dict(username=os.getenv("PCLOUD_USER"), password=os.getenv("PCLOUD_PWD"), getauth=1)
+        res = await self._get("userinfo", params, "connect to pcloud")
+        self.auth = res["auth"]
+        logging.debug("Connected to pcloud")
+
+    async def logout(self):
+        """
+        Logout from pcloud, but keep the connection pool.
+
+        :return:
+        """
+        try:
+            res = await self._get("logout", action="logout from pcloud")
+        except PcloudError as exc:
+            logging.error(str(exc))
+            res = None
+        else:
+            if res.get("auth_deleted"):
+                logging.info("Logout as required")
+            else:
+                logging.info("Logout not successful")
+        self.auth = None
+        return res
+
+    async def movefile(self, fileid, tofolderid, filename):
+        """
+        This method moves a file to a destination folder.
+
+        :param fileid: ID of the file to be moved.
+        :param tofolderid: Target folder.
+        :param filename: Target file name.
+        :return:
+        """
+        return await self._get("renamefile", dict(fileid=fileid, tofolderid=tofolderid, toname=filename), "move file")
+
+    async def upload_content(self, file, content, folderid):
+        """
+        This method loads content as file to folderid.
+
+        :param file: Target File name.
+        :param content: Bytes or file-like object (opened in binary mode) with the contents of the file.
+        :param folderid: pcloud target folderid.
+        :return:
+        """
+        params = dict(folderid=folderid, auth=self.auth)
+
+        async def send():
+            data = aiohttp.FormData()
+            data.add_field(file, content, filename=file)
+            async with self.session.post(self.url_base + "uploadfile", data=data, params=params) as r:
+                check_status(r.status, r.reason, "upload file")
+                res = await r.json(content_type=None)
+            check_result(res, "upload file")
+            return res
+        return await self._retry(send, "upload file", idempotent=False)
@@ -0,0 +1,196 @@
+"""
+This module consolidates the cache functionality in Redis. Values are stored as json. Cached values that depend on the
+database carry a version stamp in their key: the version is bumped when the data changes, so that older values are not
+used anymore and expire. The cache is optional, if Redis is not available then the functions behave as a cache miss
+and the application continues on the database.
+"""
+import json
+import time
+from flask import current_app
+from redis.exceptions import RedisError
+
+# Prefix for all cache keys.
+PREFIX = "tuin"
+# Default expiry time in seconds for cached values.
+TIMEOUT = 3600
+
+
+def _key(*parts):
+    return ":".join([PREFIX] + [str(part) for part in parts])
+
+
+def _count(name, result):
+    try:
+        current_app.redis.hincrby(_key("stats"), "{n}:{r}".format(n=name, r=result))
+    except RedisError as exc:
+        _warning(exc)
+
+
+def _warning(exc):
+    current_app.logger.warning("Cache not available: {}".format(exc))
+
+
+def bump(name):
+    """
+    This function increments the version for name, so that all values cached with the previous version are stale. The
+    time of the change is kept with the version.
+
+    :param name: Name of the version stamp.
+    :return: New version, or None if the cache is not available.
+    """
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.incr(_key("version", name))
+        pipe.set(_key("modified", name), int(time.time()))
+        return pipe.execute()[0]
+    except RedisError as exc:
+        _warning(exc)
+        return None
+
+
+def delete(*keys):
+    """
+    This function removes values from the cache.
+
+    :param keys: Keys of the values.
+    :return:
+    """
+    try:
+        current_app.redis.delete(*[_key(key) for key in keys])
+    except RedisError as exc:
+        _warning(exc)
+    return
+
+
+def fragment(name, key, versions, render):
+    """
+    This function returns a rendered fragment from the cache. On a cache miss the fragment is rendered and stored. The
+    cache key has the current version of each version stamp in versions, so the fragment is invalidated when one of
+    the versions is bumped. Hits and misses are counted per fragment name.
+
+    :param name: Name of the fragment, e.g. node.
+    :param key: Key of the fragment within name, e.g. node ID and page.
+    :param versions: List of names of the version stamps that the fragment depends on.
+    :param render: Function that renders the fragment, the result must be json serializable.
+    :return: Rendered fragment.
+    """
+    res = stamps(versions)
+    if res is None:
+        return render()
+    fragment_key = "fragment:{n}:{k}:{v}".format(n=name, k=key, v=".".join([str(v) for v in res[0]]))
+    value = get(fragment_key)
+    if value is None:
+        value = render()
+        put(fragment_key, value)
+        _count(name, "miss")
+    else:
+        _count(name, "hit")
+    return value
+
+
+def get(key):
+    """
+    This function returns the value for key from the cache.
+
+    :param key: Key of the value.
+    :return: Value, or None if the value is not in the cache or the cache is not available.
+    """
+    try:
+        value = current_app.redis.get(_key(key))
+    except RedisError as exc:
+        _warning(exc)
+        return None
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def incr(key, amount=1):
+    """
+    This function adds amount to a counter in the cache. A counter that is not in the cache is not created, the next get
+    is a cache miss and the counter is calculated again.
+
+    :param key: Key of the counter.
+    :param amount: Amount to add, negative to subtract.
+    :return:
+    """
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.exists(_key(key))
+        pipe.incrby(_key(key), amount)
+        exists, value = pipe.execute()
+        if not exists or value < 0:
+            # The counter was not in the cache (or is wrong), remove it.
+            current_app.redis.delete(_key(key))
+        current_app.redis.set(_key("modified", key), int(time.time()))
+    except RedisError as exc:
+        _warning(exc)
+    return
+
+
+def put(key, value, timeout=None):
+    """
+    This function stores the value for key in the cache.
+
+    :param key: Key of the value.
+    :param value: Value, this must be json serializable.
+    :param timeout: Expiry time in seconds. Default: CACHE_TIMEOUT from the configuration.
+    :return:
+    """
+    if timeout is None:
+        timeout = current_app.config.get("CACHE_TIMEOUT", TIMEOUT)
+    try:
+        current_app.redis.set(_key(key), json.dumps(value), ex=timeout)
+    except RedisError as exc:
+        _warning(exc)
+    return
+
+
+def stamps(names):
+    """
+    This function returns the current versions for names and the time of the last change, in one request.
+
+    :param names: Names of the version stamps or counters.
+    :return: (list of versions, time of the last change or 0), or None if the cache is not available.
+    """
+    try:
+        values = current_app.redis.mget([_key("version", name) for name in names] +
+                                        [_key("modified", name) for name in names])
+    except RedisError as exc:
+        _warning(exc)
+        return None
+    versions = [int(value or 0) for value in values[:len(names)]]
+    modified = max([int(value or 0) for value in values[len(names):]] or [0])
+    return versions, modified
+
+
+def stats():
+    """
+    This function returns the hit and miss counters of the fragment cache.
+
+    :return: Dictionary with fragment name as key and dictionary with hit and miss counts as value.
+    """
+    try:
+        counters = current_app.redis.hgetall(_key("stats"))
+    except RedisError as exc:
+        _warning(exc)
+        return {}
+    res = {}
+    for field, cnt in counters.items():
+        name, result = field.decode().rsplit(":", 1)
+        res.setdefault(name, dict(hit=0, miss=0))[result] = int(cnt)
+    return res
+
+
+def version(name):
+    """
+    This function returns the current version for name.
+
+    :param name: Name of the version stamp.
+    :return: Version, or None if the cache is not available.
+    """
+    try:
+        return int(current_app.redis.get(_key("version", name)) or 0)
+    except RedisError as exc:
+        _warning(exc)
+        return None
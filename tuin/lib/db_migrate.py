@@ -0,0 +1,106 @@
+"""
+This module has the versioned schema migrations for the database. The schema version is kept in the SQLite
+user_version pragma. Each migration brings the schema from the previous version to its version, migrations are applied
+in order and each migration is committed with its version. Statements are idempotent, so that a database on which part
+of a migration has been done (for example the search index from 'flask rebuild-search') can be upgraded.
+
+Usage: flask db-upgrade (see fromflask.py), or db_migrate.upgrade() in an application context.
+"""
+from flask import current_app
+from sqlalchemy import text
+from tuin import db
+from tuin.lib import db_model
+
+
+def _search_index():
+    db_model.search_index_rebuild()
+
+
+def _ingest():
+    db_model.Ingest.init_table()
+
+
+def _archive():
+    db_model.Archive.rebuild()
+
+
+def _view_count():
+    db_model.ViewCount.rebuild()
+
+
+# Indexes for the lookup columns. Names are the names generated from the models, so that a database created with
+# db.create_all() has the same indexes.
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_content_node_id ON content (node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_history_node_id ON history (node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_lophoto_node_id ON lophoto (node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_node_created ON node (created)",
+    "CREATE INDEX IF NOT EXISTS ix_node_modified ON node (modified)",
+    "CREATE INDEX IF NOT EXISTS ix_node_parent_id ON node (parent_id)",
+    "CREATE INDEX IF NOT EXISTS ix_node_type_created ON node (type, created)",
+    "CREATE INDEX IF NOT EXISTS ix_photo_filename ON photo (filename)",
+    "CREATE INDEX IF NOT EXISTS ix_photo_fresh_created ON photo (fresh, created)",
+    "CREATE INDEX IF NOT EXISTS ix_photo_node_id ON photo (node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_taxonomy_node_id ON taxonomy (node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_taxonomy_term_id_node_id ON taxonomy (term_id, node_id)",
+    "CREATE INDEX IF NOT EXISTS ix_term_vocabulary_id ON term (vocabulary_id)",
+    "ANALYZE"
+]
+
+# Unique taxonomy pairs. Duplicate pairs are removed first, the unique index replaces the index on node_id.
+TAXONOMY_UNIQUE = [
+    "DELETE FROM taxonomy WHERE id NOT IN (SELECT min(id) FROM taxonomy GROUP BY node_id, term_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_taxonomy_node_id_term_id ON taxonomy (node_id, term_id)",
+    "DROP INDEX IF EXISTS ix_taxonomy_node_id",
+    "ANALYZE"
+]
+
+# Migrations: (version, description, list of statements or function).
+MIGRATIONS = [
+    (1, "Full-text search index", _search_index),
+    (2, "Ingestion ledger", _ingest),
+    (3, "Archive table", _archive),
+    (4, "Indexes on lookup columns", INDEXES),
+    (5, "Unique node and term in taxonomy", TAXONOMY_UNIQUE),
+    (6, "View count table", _view_count)
+]
+
+
+def get_version():
+    """
+    This function returns the schema version of the database.
+
+    :return: Schema version, 0 for a database without migrations.
+    """
+    return db.session.execute(text("PRAGMA user_version")).scalar()
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def upgrade(target=None):
+    """
+    This function applies the migrations that are not yet done on the database.
+
+    :param target: Version to upgrade to, default: latest version.
+    :return: List of the versions that have been applied.
+    """
+    if target is None:
+        target = latest_version()
+    version = get_version()
+    applied = []
+    for (mig_version, desc, migration) in MIGRATIONS:
+        if mig_version <= version or mig_version > target:
+            continue
+        current_app.logger.info("Migration to version {v}: {d}".format(v=mig_version, d=desc))
+        if callable(migration):
+            migration()
+        else:
+            for statement in migration:
+                db.session.execute(text(statement))
+        # Pragma does not accept bound parameters.
+        db.session.execute(text("PRAGMA user_version = {v:d}".format(v=mig_version)))
+        db.session.commit()
+        applied.append(mig_version)
+    return applied
@@ -1,15 +1,210 @@
 # import logging
-import sqlite3
+import json
 import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
 from tuin import db, lm
-from tuin.lib.my_env import datestamp
+from tuin.lib import cache_handler
+from tuin.lib.my_env import datestamp, highlight, month_key, month_range, strip_tags
 from flask import current_app
 from flask_login import UserMixin
+from redis.exceptions import RedisError
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, literal, text, tuple_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased, contains_eager, joinedload, selectinload, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
+# Full-text search index on node title and body, rowid is the node id.
+SEARCH_INDEX_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, " \
+                   "tokenize = 'unicode61 remove_diacritics 1')"
+# Book tree in a single query: books are sorted on title depth first, the sort key is the path of titles (and ids, to
+# keep children with their parent when titles are equal). The subtree of exclnid is excluded.
+TREE_QUERY = """
+WITH RECURSIVE tree(id, title, depth, path) AS (
+    SELECT node.id, coalesce(content.title, ''), 1,
+           coalesce(content.title, '') || char(2) || printf('%010d', node.id) || char(1)
+    FROM node LEFT OUTER JOIN content ON content.node_id = node.id
+    WHERE node.parent_id = :parent_id AND node.type = 'book' AND node.id != :exclnid
+    UNION ALL
+    SELECT node.id, coalesce(content.title, ''), tree.depth + 1,
+           tree.path || coalesce(content.title, '') || char(2) || printf('%010d', node.id) || char(1)
+    FROM node JOIN tree ON node.parent_id = tree.id LEFT OUTER JOIN content ON content.node_id = node.id
+    WHERE node.type = 'book' AND node.id != :exclnid
+)
+SELECT id, title, depth FROM tree ORDER BY path
+"""
+# SQLite pragmas that are set on each new connection, SQLITE_PRAGMAS in the configuration replaces these. WAL journal
+# mode allows readers while the ingestion job writes. Foreign keys are not enforced: root nodes have parent_id -1.
+SQLITE_PRAGMAS = dict(
+    journal_mode="WAL",
+    synchronous="NORMAL",
+    cache_size=-16000,
+    mmap_size=256 * 1024 * 1024,
+    busy_timeout=5000,
+    temp_store="MEMORY",
+    foreign_keys="OFF"
+)
+# Redis list that buffers the page views for the history table. Views are written to the table when the buffer has
+# HISTORY_BATCH views or when the oldest view is HISTORY_INTERVAL seconds old (HISTORY_BATCH and HISTORY_INTERVAL in the
+# configuration replace these).
+HISTORY_KEY = "tuin:history"
+HISTORY_BATCH = 100
+HISTORY_INTERVAL = 300
+# Expiry time in seconds of the "Nieuwe Foto's" counter, the counter is reconciled with the photo table on expiry.
+NFC_TIMEOUT = 900
+# Largest value of an SQLite integer.
+SQLITE_MAX_INT = 2 ** 63 - 1
+# Node types that are shown in the picture overview.
+PIC_TYPES = ("photo", "lophoto")
+# Markers for the matches in the search snippet, these are converted to html after escaping the snippet.
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+def after_commit(func, *args):
+    """
+    This function calls func after the commit. In a unit of work func is called at the end of the unit of work, so that
+    a cache update is never based on uncommitted data. If the unit of work is rolled back, then func is not called.
+
+    :param func: Function to call.
+    :param args: Arguments for the function.
+    :return:
+    """
+    if db.session.info.get("unit_of_work"):
+        db.session.info.setdefault("after_commit", []).append((func, args))
+    else:
+        func(*args)
+    return
+
+
+def bump_version(name):
+    """
+    This function bumps the cache version for name after the commit.
+
+    :param name: Name of the version stamp.
+    :return:
+    """
+    after_commit(cache_handler.bump, name)
+    return
+
+
+def node_changed(nid, lists=True):
+    """
+    This function invalidates the cached fragments for the node after the commit.
+
+    :param nid: ID of the node.
+    :param lists: True if the change shows in the picture lists (overview and pictures for a term).
+    :return:
+    """
+    bump_version("node:{}".format(nid))
+    # Node lists with title and body (month, term).
+    bump_version("nodes")
+    if lists:
+        bump_version("pics")
+    return
+
+
+def commit():
+    """
+    This function commits the session. In a unit of work the session is flushed only, so that IDs are available and
+    the changes are committed at the end of the unit of work.
+
+    :return:
+    """
+    if db.session.info.get("unit_of_work"):
+        db.session.flush()
+    else:
+        db.session.commit()
+    return
+
+
+@contextmanager
+def unit_of_work():
+    """
+    This function returns a context in which the model operations are committed in one transaction, at the end of the
+    context. If an exception is raised, then all operations in the context are rolled back. Units of work can be
+    nested, the outer unit of work commits.
+
+    Usage:
+        with unit_of_work():
+            nid = Node.add(type="blog")
+            Content.update(node_id=nid, title=title, body=body)
+
+    :return: session
+    """
+    info = db.session.info
+    info["unit_of_work"] = info.get("unit_of_work", 0) + 1
+    try:
+        yield db.session
+    except Exception:
+        info["unit_of_work"] -= 1
+        if info["unit_of_work"] == 0:
+            info.pop("after_commit", None)
+            db.session.rollback()
+        raise
+    info["unit_of_work"] -= 1
+    if info["unit_of_work"] == 0:
+        db.session.commit()
+        for func, args in info.pop("after_commit", []):
+            func(*args)
+
+
+class Archive(db.Model):
+    """
+    Table with the number of nodes per month (UTC), for the archive. The table is maintained when a node is added or
+    removed, or when the created timestamp of a node changes.
+    """
+    __tablename__ = "archive"
+    month = db.Column(db.Text, primary_key=True)
+    cnt = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def add(created):
+        """
+        This method adds a node to the count for the month. The change is committed with the node.
+
+        :param created: Created timestamp of the node.
+        :return:
+        """
+        params = dict(month=month_key(created))
+        res = db.session.execute(text("UPDATE archive SET cnt = cnt + 1 WHERE month = :month"), params)
+        if res.rowcount == 0:
+            db.session.execute(text("INSERT INTO archive (month, cnt) VALUES (:month, 1)"), params)
+        bump_version("archive")
+        return
+
+    @staticmethod
+    def rebuild():
+        """
+        This method creates the archive table if required and recalculates the counts from the node table.
+
+        :return: Number of months in the archive.
+        """
+        Archive.__table__.create(bind=db.engine, checkfirst=True)
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_node_created ON node (created)"))
+        db.session.execute(text("DELETE FROM archive"))
+        month_sel = db.func.datetime(Node.created, "unixepoch")
+        month_desc = db.func.strftime("%Y-%m", month_sel)
+        for month, cnt in db.session.query(month_desc, db.func.count()).group_by(month_desc):
+            db.session.add(Archive(month=month, cnt=cnt))
+        db.session.commit()
+        return Archive.query.count()
+
+    @staticmethod
+    def remove(created):
+        """
+        This method removes a node from the count for the month. The change is committed with the node.
+
+        :param created: Created timestamp of the node.
+        :return:
+        """
+        params = dict(month=month_key(created))
+        db.session.execute(text("UPDATE archive SET cnt = cnt - 1 WHERE month = :month"), params)
+        db.session.execute(text("DELETE FROM archive WHERE month = :month AND cnt <= 0"), params)
+        bump_version("archive")
+        return
+
 
 class Content(db.Model):
     """
@@ -17,7 +212,7 @@ class Content(db.Model):
     """
     __tablename__ = "content"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    node_id = db.Column(db.Integer, db.ForeignKey('node.id'))
+    node_id = db.Column(db.Integer, db.ForeignKey('node.id'), index=True)
     title = db.Column(db.Text, nullable=False)
     body = db.Column(db.Text)
 
@@ -30,7 +225,8 @@ class Content(db.Model):
                                     .format(nid=nid))
         else:
             db.session.delete(content_inst)
-            db.session.commit()
+            search_index_delete(nid)
+            commit()
         return True
 
     @staticmethod
@@ -43,13 +239,23 @@ class Content(db.Model):
         """
         try:
             content_inst = db.session.query(Content).filter_by(node_id=params['node_id']).one()
+            title_changed = content_inst.title != params["title"]
             content_inst.title = params["title"]
             content_inst.body = params["body"]
         except NoResultFound:
             content_inst = Content(**params)
             db.session.add(content_inst)
-        db.session.commit()
-        db.session.refresh(content_inst)
+            title_changed = True
+        search_index_update(params["node_id"], params["title"], params["body"])
+        commit()
+        if title_changed:
+            # Titles are labels in the book tree and in the picture lists.
+            node_type = db.session.query(Node.type).filter_by(id=params["node_id"]).scalar()
+            if node_type == "book":
+                bump_version("tree")
+            node_changed(params["node_id"], lists=node_type in PIC_TYPES)
+        else:
+            node_changed(params["node_id"], lists=False)
         return content_inst.id
 
 
@@ -59,7 +265,7 @@ class Lophoto(db.Model):
     """
     __tablename__ = "lophoto"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    node_id = db.Column(db.Integer, db.ForeignKey('node.id'))
+    node_id = db.Column(db.Integer, db.ForeignKey('node.id'), index=True)
     filename = db.Column(db.Text, nullable=False)
     uri = db.Column(db.Text, nullable=False)
     created = db.Column(db.Integer, nullable=False)
@@ -70,9 +276,10 @@ class Photo(db.Model):
     Table containing information about the pictures on pcloud. A picture can be used by a single node only.
     """
     __tablename__ = "photo"
+    __table_args__ = (db.Index("ix_photo_fresh_created", "fresh", "created"),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    node_id = db.Column(db.Integer, db.ForeignKey('node.id'))
-    filename = db.Column(db.Text, nullable=False)
+    node_id = db.Column(db.Integer, db.ForeignKey('node.id'), index=True)
+    filename = db.Column(db.Text, nullable=False, index=True)
     orig_filename = db.Column(db.Text)
     created = db.Column(db.Integer, nullable=False)
     fresh = db.Column(db.Integer)
@@ -81,8 +288,10 @@ class Photo(db.Model):
     def add(**params):
         photo_inst = Photo(**params)
         db.session.add(photo_inst)
-        db.session.commit()
-        db.session.refresh(photo_inst)
+        commit()
+        if photo_inst.fresh == 1:
+            count_nf_change(1)
+        node_changed(photo_inst.node_id)
         return photo_inst.id
 
     @staticmethod
@@ -104,8 +313,12 @@ class Photo(db.Model):
         else:
             current_app.logger.info("Delete Node {nid} with Photo ID {pid} from Photo"
                                     .format(nid=node_id, pid=photo_inst.id))
+            fresh = photo_inst.fresh
             db.session.delete(photo_inst)
-            db.session.commit()
+            commit()
+            if fresh == 1:
+                count_nf_change(-1)
+            node_changed(node_id)
         return 1
 
     @staticmethod
@@ -118,9 +331,13 @@ class Photo(db.Model):
         :return:
         """
         photo_inst = db.session.query(Photo).filter_by(node_id=params['node_id']).first()
+        fresh = photo_inst.fresh
         for k, v in params.items():
             setattr(photo_inst, k, v)
-        db.session.commit()
+        commit()
+        if fresh != photo_inst.fresh:
+            count_nf_change(1 if photo_inst.fresh == 1 else -1)
+        node_changed(params["node_id"])
         return
 
     @staticmethod
@@ -144,10 +361,11 @@ class Node(db.Model):
     Relationship type is called: Adjacency list.
     """
     __tablename__ = "node"
+    __table_args__ = (db.Index("ix_node_type_created", "type", "created"),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    parent_id = db.Column(db.Integer, db.ForeignKey('node.id'), nullable=False)
-    created = db.Column(db.Integer, nullable=False)
-    modified = db.Column(db.Integer, nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('node.id'), nullable=False, index=True)
+    created = db.Column(db.Integer, nullable=False, index=True)
+    modified = db.Column(db.Integer, nullable=False, index=True)
     revcnt = db.Column(db.Integer)
     type = db.Column(db.Text)
     children = db.relationship("Node",
@@ -167,8 +385,11 @@ class Node(db.Model):
             params["parent_id"] = -1
         node_inst = Node(**params)
         db.session.add(node_inst)
-        db.session.commit()
-        db.session.refresh(node_inst)
+        Archive.add(params['created'])
+        commit()
+        if node_inst.type == "book":
+            bump_version("tree")
+        node_changed(node_inst.id, lists=node_inst.type in PIC_TYPES)
         return node_inst.id
 
     @staticmethod
@@ -183,9 +404,13 @@ class Node(db.Model):
         node_inst.modified = int(time.time())
         node_inst.revcnt += 1
         # If node has a photo attached to it, set fresh to 0
+        fresh = node_inst.photo and node_inst.photo.fresh == 1
         if node_inst.photo:
             node_inst.photo.fresh = 0
-        db.session.commit()
+        commit()
+        if fresh:
+            count_nf_change(-1)
+        node_changed(node_id, lists=False)
         return
 
     @staticmethod
@@ -196,11 +421,13 @@ class Node(db.Model):
         :param params: Dictionary with nid and parent_id as keys.
         :return:
         """
-        node_inst = db.session.query(Node).filter_by(nid=params['nid']).first()
+        node_inst = db.session.query(Node).filter_by(id=params['nid']).first()
         node_inst.parent_id = params['parent_id']
         node_inst.modified = int(time.time())
         node_inst.revcnt += 1
-        db.session.commit()
+        commit()
+        bump_version("tree")
+        node_changed(params["nid"], lists=False)
         return
 
     @staticmethod
@@ -211,13 +438,20 @@ class Node(db.Model):
             current_app.logger.info("Trying to remove node record for node ID {nid}, but no record found"
                                     .format(nid=nid))
         else:
-            if node_inst.type == "photo":
-                Photo.delete(nid)
-            # Remove Content record
-            Content.delete(nid)
-            # Then remove node record.
-            db.session.delete(node_inst)
-            db.session.commit()
+            node_type = node_inst.type
+            # Photo, content (with search index) and node are removed in one transaction.
+            with unit_of_work():
+                if node_type == "photo":
+                    Photo.delete(nid)
+                # Remove Content record
+                Content.delete(nid)
+                # Then remove node record.
+                Archive.remove(node_inst.created)
+                db.session.delete(node_inst)
+                commit()
+                if node_type == "book":
+                    bump_version("tree")
+                node_changed(nid, lists=node_type in PIC_TYPES)
         return True
 
     @staticmethod
@@ -228,8 +462,11 @@ class Node(db.Model):
         created = node_inst.photo.created
         current_app.logger.info("Node created datestamp from {nc} to {fd}".format(nc=datestamp(nc),
                                                                                   fd=created))
+        Archive.remove(nc)
+        Archive.add(created)
         node_inst.created = created
-        db.session.commit()
+        commit()
+        node_changed(nid)
         return
 
 
@@ -239,26 +476,171 @@ class History(db.Model):
     """
     __tablename__ = "history"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    node_id = db.Column(db.Integer, nullable=False)
+    node_id = db.Column(db.Integer, nullable=False, index=True)
     timestamp = db.Column(db.Integer, nullable=False)
 
     @staticmethod
     def add(nid):
-        params = dict(
-            timestamp=int(time.time()),
-            node_id=nid
-        )
-        hist_inst = History(**params)
-        db.session.add(hist_inst)
-        db.session.commit()
+        """
+        This method registers a view of the node. The view is buffered in Redis, a flush job is queued when the buffer
+        is full or when the oldest view is too old. If Redis is not available, then the view is written immediately.
+
+        :param nid: ID of the node.
+        :return:
+        """
+        view = [int(nid), int(time.time())]
+        redis = current_app.redis
+        try:
+            pipe = redis.pipeline()
+            pipe.rpush(HISTORY_KEY, json.dumps(view))
+            pipe.lindex(HISTORY_KEY, 0)
+            length, first = pipe.execute()
+            interval = current_app.config.get("HISTORY_INTERVAL", HISTORY_INTERVAL)
+            if length >= current_app.config.get("HISTORY_BATCH", HISTORY_BATCH) or \
+                    view[1] - json.loads(first)[1] >= interval:
+                # Queue one flush job at a time, the lock expires if the job fails.
+                if redis.set(HISTORY_KEY + ":flush", 1, nx=True, ex=interval):
+                    current_app.task_queue.enqueue("tuin.lib.history_handler.flush_history")
+        except RedisError as exc:
+            current_app.logger.warning("History buffer not available: {}".format(exc))
+            History.record([view])
+        return
+
+    @staticmethod
+    def flush():
+        """
+        This method writes the buffered views to the history table, in batches of HISTORY_BATCH views. The views of a
+        batch are put back in the buffer if the batch cannot be written.
+
+        :return: Number of views written.
+        """
+        redis = current_app.redis
+        batch = current_app.config.get("HISTORY_BATCH", HISTORY_BATCH)
+        cnt = 0
+        while True:
+            pipe = redis.pipeline()
+            pipe.lrange(HISTORY_KEY, 0, batch - 1)
+            pipe.ltrim(HISTORY_KEY, batch, -1)
+            views = pipe.execute()[0]
+            if not views:
+                break
+            try:
+                History.record([json.loads(view) for view in views])
+            except Exception:
+                db.session.rollback()
+                redis.lpush(HISTORY_KEY, *reversed(views))
+                raise
+            cnt += len(views)
+        redis.delete(HISTORY_KEY + ":flush")
+        return cnt
+
+    @staticmethod
+    def record(views):
+        """
+        This method writes views to the history table and adds them to the view counts, in one commit.
+
+        :param views: List of [node ID, timestamp] pairs.
+        :return:
+        """
+        rows = [dict(node_id=nid, timestamp=timestamp) for nid, timestamp in views]
+        db.session.execute(History.__table__.insert(), rows)
+        ViewCount.add(views)
+        commit()
         return
 
 
+class Ingest(db.Model):
+    """
+    Ledger for the photo ingestion jobs. A record is added for each picture (pcloud file ID) and step when the step is
+    completed, so that a job that stopped halfway can resume from the last completed step. The records for a picture
+    are removed when all steps are done.
+    Steps for photo_handler: downloaded (target filename and created timestamp are known), node, moved, medium, small.
+    Steps for temp_handler: medium, small.
+    """
+    __tablename__ = "ingest"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    job = db.Column(db.Text, nullable=False)
+    fileid = db.Column(db.Integer, nullable=False)
+    step = db.Column(db.Text, nullable=False)
+    filename = db.Column(db.Text, nullable=False)
+    size = db.Column(db.Integer)
+    target = db.Column(db.Text)
+    created = db.Column(db.Integer)
+    timestamp = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint("job", "fileid", "step"),)
+
+    @staticmethod
+    def add(job, filedata, step, **params):
+        """
+        This method registers a completed step for the picture.
+
+        :param job: Name of the ingestion job.
+        :param filedata: Dictionary with pcloud file information (name, fileid, size) of the source picture.
+        :param step: Name of the completed step.
+        :param params: Optional target (calculated filename) and created (picture timestamp).
+        :return:
+        """
+        params.update(job=job, fileid=filedata["fileid"], step=step, filename=filedata["name"],
+                      size=filedata.get("size"), timestamp=int(time.time()))
+        ingest_inst = Ingest(**params)
+        db.session.add(ingest_inst)
+        commit()
+        return
+
+    @staticmethod
+    def finish(job, fileid):
+        """
+        This method removes the ledger records for a picture when all steps are done.
+
+        :param job: Name of the ingestion job.
+        :param fileid: pcloud file ID of the source picture.
+        :return:
+        """
+        Ingest.query.filter_by(job=job, fileid=fileid).delete()
+        commit()
+        return
+
+    @staticmethod
+    def init_table():
+        """
+        This method creates the ledger table if it does not exist.
+
+        :return:
+        """
+        Ingest.__table__.create(bind=db.engine, checkfirst=True)
+        return
+
+    @staticmethod
+    def pending(job, step="downloaded"):
+        """
+        This method returns the pictures for which the job stopped before all steps were done.
+
+        :param job: Name of the ingestion job.
+        :param step: Step that identifies a started picture.
+        :return: List of dictionaries with pcloud file information (name, fileid, size) of the source pictures.
+        """
+        ingest_list = Ingest.query.filter_by(job=job, step=step).order_by(Ingest.id)
+        return [dict(name=rec.filename, fileid=rec.fileid, size=rec.size) for rec in ingest_list]
+
+    @staticmethod
+    def steps(job, fileid):
+        """
+        This method returns the completed steps for a picture.
+
+        :param job: Name of the ingestion job.
+        :param fileid: pcloud file ID of the source picture.
+        :return: Dictionary with step name as key and Ingest record as value.
+        """
+        return {rec.step: rec for rec in Ingest.query.filter_by(job=job, fileid=fileid)}
+
+
 class Taxonomy(db.Model):
     """
     Table containing the taxonomy of a Node. Each term that can be assigned to the node is listed here.
     """
     __tablename__ = "taxonomy"
+    __table_args__ = (db.Index("ix_taxonomy_term_id_node_id", "term_id", "node_id"),
+                      db.Index("ix_taxonomy_node_id_term_id", "node_id", "term_id", unique=True))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     node_id = db.Column(db.Integer, db.ForeignKey("node.id"), nullable=False)
     term_id = db.Column(db.Integer, db.ForeignKey("term.id"), nullable=False)
@@ -269,17 +651,48 @@ class Taxonomy(db.Model):
         params['created'] = int(time.time())
         taxonomy_inst = Taxonomy(**params)
         db.session.add(taxonomy_inst)
-        db.session.commit()
-        db.session.refresh(taxonomy_inst)
+        commit()
         return taxonomy_inst.id
 
+    @staticmethod
+    def add_terms(node_id, term_ids):
+        """
+        This method adds the terms to the node in one INSERT. Terms that are assigned to the node already are ignored.
+
+        :param node_id: ID of the node.
+        :param term_ids: Iterable of term IDs.
+        :return:
+        """
+        created = int(time.time())
+        rows = [dict(node_id=node_id, term_id=term_id, created=created) for term_id in term_ids]
+        if rows:
+            db.session.execute(Taxonomy.__table__.insert().prefix_with("OR IGNORE"), rows)
+            commit()
+        return
+
     @staticmethod
     def delete(**params):
         taxonomy_inst = Taxonomy.query.filter_by(node_id=params["node_id"], term_id=params["term_id"]).one()
         db.session.delete(taxonomy_inst)
-        db.session.commit()
+        commit()
         return True
 
+    @staticmethod
+    def delete_terms(node_id, term_ids):
+        """
+        This method removes the terms from the node in one DELETE.
+
+        :param node_id: ID of the node.
+        :param term_ids: Iterable of term IDs.
+        :return:
+        """
+        term_ids = list(term_ids)
+        if term_ids:
+            Taxonomy.query.filter(Taxonomy.node_id == node_id, Taxonomy.term_id.in_(term_ids))\
+                .delete(synchronize_session=False)
+            commit()
+        return
+
 
 class Term(db.Model):
     """
@@ -287,7 +700,7 @@ class Term(db.Model):
     """
     __tablename__ = "term"
     id = db.Column(db.Integer, primary_key=True)
-    vocabulary_id = db.Column(db.Integer, db.ForeignKey("vocabulary.id"), nullable=False)
+    vocabulary_id = db.Column(db.Integer, db.ForeignKey("vocabulary.id"), nullable=False, index=True)
     name = db.Column(db.Text, nullable=False)
     description = db.Column(db.Text)
 
@@ -295,9 +708,52 @@ class Term(db.Model):
     def add(**params):
         term_inst = Term(**params)
         db.session.add(term_inst)
+        commit()
+        return term_inst.id
+
+
+class ViewCount(db.Model):
+    """
+    Table with the number of views and the last view per node, aggregated from the history table.
+    """
+    __tablename__ = "view_count"
+    node_id = db.Column(db.Integer, primary_key=True)
+    cnt = db.Column(db.Integer, nullable=False, index=True)
+    last_view = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def add(views):
+        """
+        This method adds views to the counts. The change is committed with the history records.
+
+        :param views: List of [node ID, timestamp] pairs.
+        :return:
+        """
+        counts = Counter(nid for nid, _ in views)
+        last_views = {}
+        for nid, timestamp in views:
+            last_views[nid] = max(timestamp, last_views.get(nid, 0))
+        rows = [dict(node_id=nid, cnt=cnt, last_view=last_views[nid]) for nid, cnt in counts.items()]
+        db.session.execute(text("INSERT OR IGNORE INTO view_count (node_id, cnt, last_view) VALUES (:node_id, 0, 0)"),
+                           rows)
+        db.session.execute(text("UPDATE view_count SET cnt = cnt + :cnt, last_view = max(last_view, :last_view) "
+                                "WHERE node_id = :node_id"), rows)
+        return
+
+    @staticmethod
+    def rebuild():
+        """
+        This method creates the view count table if required and recalculates the counts from the history table.
+
+        :return: Number of nodes with views.
+        """
+        ViewCount.__table__.create(bind=db.engine, checkfirst=True)
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_view_count_cnt ON view_count (cnt)"))
+        db.session.execute(text("DELETE FROM view_count"))
+        db.session.execute(text("INSERT INTO view_count (node_id, cnt, last_view) "
+                                "SELECT node_id, count(*), max(timestamp) FROM history GROUP BY node_id"))
         db.session.commit()
-        db.session.refresh(term_inst)
-        return term_inst.nid
+        return ViewCount.query.count()
 
 
 class Vocabulary(db.Model):
@@ -330,7 +786,7 @@ class User(UserMixin, db.Model):
         user.username = username
         user.set_password(password)
         db.session.add(user)
-        db.session.commit()
+        commit()
 
     @staticmethod
     def update_password(user, password):
@@ -342,6 +798,23 @@ class User(UserMixin, db.Model):
         return "<User: {user}>".format(user=self.username)
 
 
+# Loader profiles: relationships that are loaded with the nodes, so that templates do not trigger lazy loads per node.
+# One-to-one relations are joined, collections are loaded with a single select per relation for all nodes.
+_terms = selectinload(Node.terms).joinedload("vocabularies")
+LOADER_PROFILES = dict(
+    # pic_matrix.html and taxpics.html: title and picture.
+    pics=[joinedload(Node.content), joinedload(Node.photo), joinedload(Node.lophoto)],
+    # node_list.html and timeline.html: title, body, picture and terms.
+    list=[joinedload(Node.content), joinedload(Node.photo), joinedload(Node.lophoto), _terms],
+    # node.html: title, body, picture, terms and the children with their title and children.
+    node=[joinedload(Node.content), joinedload(Node.photo), joinedload(Node.lophoto), _terms,
+          selectinload(Node.children).joinedload(Node.content),
+          selectinload(Node.children).selectinload(Node.children)]
+)
+# Page of nodes for keyset pagination. The cursors are None if there is no next or previous page.
+CursorPage = namedtuple("CursorPage", "items next_cursor prev_cursor")
+
+
 def init_session(dbconn, echo=False):
     """
     This function configures the connection to the database and returns the session object.
@@ -356,11 +829,34 @@ def init_session(dbconn, echo=False):
     return session
 
 
-def set_engine(conn_string, echo=False):
-    engine = create_engine(conn_string, echo=echo)
+def init_engine(engine, pragmas=None):
+    """
+    This function configures the engine so that the SQLite pragmas are set on each new connection. Other databases
+    are not changed.
+
+    :param engine: SQLAlchemy engine.
+    :param pragmas: Dictionary with pragma name and value. Default: SQLITE_PRAGMAS.
+    :return: engine
+    """
+    if engine.dialect.name != "sqlite":
+        return engine
+    if pragmas is None:
+        pragmas = SQLITE_PRAGMAS
+
+    def set_pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {n} = {v}".format(n=name, v=value))
+        cursor.close()
+    event.listen(engine, "connect", set_pragmas)
     return engine
 
 
+def set_engine(conn_string, echo=False, pragmas=None):
+    engine = create_engine(conn_string, echo=echo)
+    return init_engine(engine, pragmas)
+
+
 def set_session4engine(engine):
     session_class = sessionmaker(bind=engine)
     session = session_class()
@@ -374,34 +870,79 @@ def load_user(user_id):
 
 def count_nf():
     """
-    Function to return the count of the "Nieuwe Foto's".
+    Function to return the count of the "Nieuwe Foto's". The count is a counter in the cache, that is updated when a
+    photo becomes fresh or is not fresh anymore. The counter is reconciled with the photo table when it expires
+    (NFC_TIMEOUT in the configuration, default 15 minutes) and at the end of the photo handler.
 
     :return:
     """
-    return Photo.query.filter_by(fresh=1).count()
+    cnt = cache_handler.get("nfc")
+    if cnt is None:
+        cnt = count_nf_reconcile()
+    return cnt
+
+
+def count_nf_change(amount):
+    """
+    Function to update the count of the "Nieuwe Foto's" after the commit.
+
+    :param amount: Number of photos that became fresh, negative for photos that are not fresh anymore.
+    :return:
+    """
+    after_commit(cache_handler.incr, "nfc", amount)
+    return
+
+
+def count_nf_reconcile():
+    """
+    Function to count the "Nieuwe Foto's" in the photo table and to store the count in the cache.
+
+    :return: Count of the "Nieuwe Foto's".
+    """
+    cnt = Photo.query.filter_by(fresh=1).count()
+    cache_handler.put("nfc", cnt, timeout=current_app.config.get("NFC_TIMEOUT", NFC_TIMEOUT))
+    return cnt
+
+
+def count_pics():
+    """
+    Function to return the number of pictures in the picture overview. The count is cached until the pictures change.
+
+    :return: Number of pictures.
+    """
+    key = "count:pics:{}".format(cache_handler.version("pics"))
+    cnt = cache_handler.get(key)
+    if cnt is None:
+        cnt = Node.query.filter(Node.type.in_(PIC_TYPES)).count()
+        cache_handler.put(key, cnt)
+    return cnt
 
 
 def get_archive():
     """
-    This function will collect the articles by month. SQL query:
-    select count(*), strftime("%Y-%m", datetime(created, 'unixepoch')) from node
-    group by strftime("%Y-%m", datetime(created, 'unixepoch'))
-    order by created desc
+    This function will collect the articles by month from the archive table. SQL query:
+    select month as monthDesc, cnt from archive order by month desc
 
-    :return: Year - month (%Y-%m) and number of nodes created in this month, sorted from youngest to oldest.
+    :return: Query for Year - month (%Y-%m) and number of nodes created in this month, sorted from youngest to oldest.
     """
-    month_sel = db.func.datetime(Node.created, "unixepoch")
-    month_desc = db.func.strftime("%Y-%m", month_sel).label("monthDesc")
-    query = db.session.query(month_desc, db.func.count().label("cnt"))\
-        .group_by(month_desc).order_by(Node.created.desc())
-    return query.all()
+    query = db.session.query(Archive.month.label("monthDesc"), Archive.cnt.label("cnt"))\
+        .order_by(Archive.month.desc())
+    return query
 
 
 def get_breadcrumb(nid, bc=None):
     """
-    This function will get the breadcrumb for the node. It will find the parent's node until root
-    (there is no more node).
+    This function will get the breadcrumb for the node. The parent's nodes until root (there is no more node) are
+    collected in a single recursive query, with the content loaded so that the titles are available.
     For adding a new node, add nid for the new parent and add bc=[current_node].
+    SQL query:
+    with recursive ancestors(id, parent_id, depth) as
+        (select id, parent_id, 0 from node where id = :nid
+         union all
+         select node.id, node.parent_id, depth + 1 from node, ancestors where node.id = ancestors.parent_id)
+    select node.*, content.* from node join ancestors on node.id = ancestors.id
+    left outer join content on node.id = content.node_id
+    where depth > 0 order by depth desc
 
     :param nid:
     :param bc: Breadcrumb list so far
@@ -409,15 +950,14 @@ def get_breadcrumb(nid, bc=None):
     """
     if not bc:
         bc = []
-    node = get_node_attribs(nid=nid)
-    if node.parent_id == -1:
-        # Found the root node
-        return bc
-    else:
-        parent = get_node_attribs(nid=node.parent_id)
-        # bc.append(parent)
-        bc[:0] = [parent]
-        return get_breadcrumb(parent.id, bc)
+    ancestors = db.session.query(Node.id, Node.parent_id, literal(0).label("depth"))\
+        .filter(Node.id == nid).cte(name="ancestors", recursive=True)
+    parent = aliased(Node, name="parent")
+    ancestors = ancestors.union_all(
+        db.session.query(parent.id, parent.parent_id, ancestors.c.depth + 1).filter(parent.id == ancestors.c.parent_id))
+    query = Node.query.join(ancestors, Node.id == ancestors.c.id).outerjoin(Node.content)\
+        .options(contains_eager(Node.content)).filter(ancestors.c.depth > 0).order_by(ancestors.c.depth.desc())
+    return query.all() + bc
 
 
 def get_file_from_nid(nid):
@@ -442,7 +982,7 @@ def get_node_attribs(nid):
     :param nid: Node ID for the node
     :return: Dictionary with the attributes required to display the node.
     """
-    node = Node.query.filter_by(id=nid).one()
+    node = Node.query.options(*LOADER_PROFILES["node"]).filter_by(id=nid).one()
     return node
 
 
@@ -465,12 +1005,42 @@ def get_nodes_for_month(ym):
     This method will return the list of nodes that were created in a specific month.
 
     :param ym: Month is format YYYY-MM
-    :return: Nodes that have been created in this month.
+    :return: Query for the nodes that have been created in this month.
     """
-    month_sel = db.func.datetime(Node.created, "unixepoch")
-    month_desc = db.func.strftime("%Y-%m", month_sel).label("monthDesc")
-    query = db.session.query(Node).filter(month_desc == ym).order_by(Node.created.desc())
-    return query.all()
+    start, end = month_range(ym)
+    query = db.session.query(Node).options(*LOADER_PROFILES["list"])\
+        .filter(Node.created >= start, Node.created < end).order_by(Node.created.desc())
+    return query
+
+
+def get_nodes_for_term(term_id, profile="list", pics=False):
+    """
+    This method will return the nodes for a taxonomy term, youngest first.
+
+    :param term_id: ID of the taxonomy term.
+    :param profile: Name of the loader profile for the nodes.
+    :param pics: True to return photo and lophoto nodes only.
+    :return: Query object with the nodes for the term.
+    """
+    query = Node.query.options(*LOADER_PROFILES[profile]).join(Taxonomy, Taxonomy.node_id == Node.id)\
+        .filter(Taxonomy.term_id == term_id)
+    if pics:
+        query = query.filter((Node.type == "photo") | (Node.type == "lophoto"))
+    return query.order_by(Node.created.desc())
+
+
+def get_term_neighbours(term_id, created):
+    """
+    This method will return the pictures for a taxonomy term that are just younger and just older than the timestamp.
+
+    :param term_id: ID of the taxonomy term.
+    :param created: Created timestamp of the current picture.
+    :return: previous (younger) node and next (older) node, None if there is no such node.
+    """
+    query = get_nodes_for_term(term_id, profile="pics", pics=True).order_by(None)
+    prev_node = query.filter(Node.created > created).order_by(Node.created.asc()).first()
+    next_node = query.filter(Node.created < created).order_by(Node.created.desc()).first()
+    return prev_node, next_node
 
 
 def get_oldest_nf():
@@ -490,10 +1060,112 @@ def get_pics():
     This method will get the picture URLs for the page specified.
     """
     node_order = Node.created.desc()
-    nodes = Node.query.filter((Node.type == "photo") | (Node.type == "lophoto")).order_by(node_order)
+    nodes = Node.query.options(*LOADER_PROFILES["pics"])\
+        .filter((Node.type == "photo") | (Node.type == "lophoto")).order_by(node_order)
     return nodes
 
 
+def get_most_viewed(limit=10):
+    """
+    This method returns the nodes with the most views.
+
+    :param limit: Number of nodes.
+    :return: Query for the nodes, most viewed first.
+    """
+    nodes = Node.query.options(*LOADER_PROFILES["list"])\
+        .join(ViewCount, ViewCount.node_id == Node.id).order_by(ViewCount.cnt.desc()).limit(limit)
+    return nodes
+
+
+def get_pics_cursor(node):
+    """
+    This method returns the cursor for a node in the picture overview.
+
+    :param node: Node object.
+    :return: Cursor created-id.
+    """
+    return "{c}-{i}".format(c=node.created, i=node.id)
+
+
+def get_pics_ids(key=None, before=False, limit=25):
+    """
+    This method returns the query for the IDs of the pictures on a page of the picture overview. The pictures are
+    sorted on created and id, newest first. Each picture type is selected in the order of the index on type and created
+    and the selections are merged, so that a page is an index seek, also for the first page.
+
+    :param key: (created, id) of the node from where the page starts, or None for the first page.
+    :param before: True for the page with the newer pictures before key, False for the older pictures after key.
+    :param limit: Number of pictures.
+    :return: Query for the node IDs.
+    """
+    if before:
+        order = [Node.created.asc(), Node.id.asc()]
+    else:
+        order = [Node.created.desc(), Node.id.desc()]
+    selects = []
+    for node_type in PIC_TYPES:
+        query = db.session.query(Node.id).filter(Node.type == node_type)
+        if key:
+            if before:
+                query = query.filter(tuple_(Node.created, Node.id) > tuple_(*key))
+            else:
+                query = query.filter(tuple_(Node.created, Node.id) < tuple_(*key))
+        sel = query.order_by(*order).limit(limit).subquery()
+        selects.append(db.session.query(sel.c.id))
+    return selects[0].union_all(*selects[1:])
+
+
+def get_pics_page(cursor=None, before=False, per_page=24):
+    """
+    This method returns a page of the picture overview, with keyset pagination on created and id. A page starts after
+    the cursor, or ends before the cursor for the previous page.
+
+    :param cursor: Cursor (created-id) of the first or last node on the current page, None for the first page.
+    :param before: True for the page before the cursor (newer pictures), False for the page after the cursor.
+    :param per_page: Number of pictures on the page.
+    :return: CursorPage with the nodes and the cursors for the next and the previous page.
+    """
+    key = parse_pics_cursor(cursor)
+    if key is None:
+        before = False
+    order = [Node.created.asc(), Node.id.asc()] if before else [Node.created.desc(), Node.id.desc()]
+    # One node more than the page, to know if there are more pages.
+    nodes = Node.query.options(*LOADER_PROFILES["pics"])\
+        .filter(Node.id.in_(get_pics_ids(key, before, per_page + 1))).order_by(*order).limit(per_page + 1).all()
+    more = len(nodes) > per_page
+    nodes = nodes[:per_page]
+    if before:
+        nodes.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, key is not None
+    next_cursor = get_pics_cursor(nodes[-1]) if nodes and has_next else None
+    prev_cursor = get_pics_cursor(nodes[0]) if nodes and has_prev else None
+    return CursorPage(nodes, next_cursor, prev_cursor)
+
+
+def parse_pics_cursor(cursor):
+    """
+    This method returns (created, id) from a cursor of the picture overview. The cursor comes from the query string, so
+    it must be exactly two integers within the SQLite integer range.
+
+    :param cursor: Cursor created-id, or None.
+    :return: (created, id), or None if the cursor is not given or not valid.
+    """
+    if not cursor:
+        return None
+    parts = cursor.split("-")
+    if len(parts) != 2:
+        return None
+    try:
+        key = tuple(int(part) for part in parts)
+    except ValueError:
+        return None
+    if any(value < 0 or value > SQLITE_MAX_INT for value in key):
+        return None
+    return key
+
+
 def get_pics_tax(tax=1):
     """
     This method will get the picture URLs for the page and taxonomy term specified.
@@ -557,30 +1229,19 @@ def get_title(title, planten):
         return "(Geen titel)"
 
 
-def get_tree(parent_id=-1, tree=None, level="", exclnid=-1):
+def get_tree(parent_id=-1, exclnid=-1):
     """
-    This method will get the full node tree sorted on title and depth first in a recursive way
+    This method will get the book tree sorted on title and depth first, in a single recursive query (TREE_QUERY).
 
     :param parent_id: ID for the parent
-    :param tree: Node tree so far
-    :param level: Level so far.
     :param exclnid: Specifies node nid for which descendants do not need to be acquired. For adding a node to
     another parent, then the node itself and its children should not be included, so exclnid needs to be nid
     of the node that will be moved.
     :return: list with (nid, label) per node. This is format required by SelectField.
     """
-    if not tree:
-        tree = []
-    # nodes = Node.query.filter_by(parent_id=parent_id).order_by("title")
-    nodes = Node.query.filter(Node.parent_id == parent_id, Node.nid != exclnid).order_by("title")
-    level += "-"
-    for node in nodes.all():
-        params = (node.nid, "{lvl} {t}".format(lvl=level, t=node.title))
-
-        tree.append(params)
-        if node.nid != exclnid:
-            tree = get_tree(parent_id=node.nid, tree=tree, level=level, exclnid=exclnid)
-    return tree
+    params = dict(parent_id=parent_id, exclnid=exclnid)
+    res = db.session.execute(text(TREE_QUERY), params)
+    return [(row.id, "{lvl} {t}".format(lvl="-" * row.depth, t=row.title)) for row in res]
 
 
 def get_voc_name(nid):
@@ -594,34 +1255,87 @@ def get_voc_name(nid):
     return voc
 
 
-def search_term(term):
+def search_index_delete(nid):
     """
-    Trying to work from https://www.sqlite.org/fts5.html
+    This function removes the node from the full-text search index.
 
-    :param term:
+    :param nid: Node ID
     :return:
     """
-    sc = sqlite3.connect(':memory:')
-    with sc:
-        sc.row_factory = sqlite3.Row
-        sc_cur = sc.cursor()
-        query = "CREATE VIRTUAL TABLE nodes USING fts4(nid, title, body, created, parent," \
-                "notindexed=nid, notindexed=created, notindexed=parent)"
-        sc.execute(query)
-        nodes = Node.query.all()
-        for node in nodes:
-            if node.parent_id > 0:
-                parent = get_node_attribs(node.parent_id)
-                category = parent.content.title
-            else:
-                category = "Main"
-            query = "INSERT INTO nodes (nid, title, body, created, parent) VALUES (?, ?, ?, ?, ?)"
-            sc_cur.execute(query, (node.id, node.content.title, node.content.body, node.created, category))
-        # logging.info("Table populated")
-        # query = "SELECT * FROM nodes WHERE nodes MATCH ? ORDER BY bm25(nodes)"
-        query = "SELECT distinct * FROM nodes WHERE nodes MATCH ?"
-        res = sc_cur.execute(query, (term, ))
-        return res
+    db.session.execute(text("DELETE FROM search_index WHERE rowid = :nid"), dict(nid=nid))
+    return
+
+
+def search_index_rebuild():
+    """
+    This function will (re-)create the full-text search index from the content table. This is required once for an
+    existing database, afterwards the index is kept up-to-date by Content.update, Content.delete and Node.delete.
+
+    :return: Number of nodes in the search index.
+    """
+    db.session.execute(text("DROP TABLE IF EXISTS search_index"))
+    db.session.execute(text(SEARCH_INDEX_DDL))
+    contents = db.session.query(Content.node_id, Content.title, Content.body).filter(Content.node_id.isnot(None))
+    rows = [dict(nid=nid, title=title, body=strip_tags(body)) for (nid, title, body) in contents]
+    if rows:
+        query = "INSERT INTO search_index (rowid, title, body) VALUES (:nid, :title, :body)"
+        db.session.execute(text(query), rows)
+    db.session.commit()
+    current_app.logger.info("Search index rebuilt for {cnt} nodes".format(cnt=len(rows)))
+    return len(rows)
+
+
+def search_index_update(nid, title, body):
+    """
+    This function adds or replaces the title and body of the node in the full-text search index. Html tags are removed
+    from the body, so that only text is indexed. The change is part of the current session, the caller needs to commit.
+
+    :param nid: Node ID
+    :param title: Title of the node.
+    :param body: Body of the node.
+    :return:
+    """
+    search_index_delete(nid)
+    query = "INSERT INTO search_index (rowid, title, body) VALUES (:nid, :title, :body)"
+    db.session.execute(text(query), dict(nid=nid, title=title, body=strip_tags(body)))
+    return
+
+
+def search_term(term):
+    """
+    This function will search the persistent full-text search index (https://www.sqlite.org/fts5.html). Results are
+    ranked using bm25, a match on the title weighs more than a match on the body. If the term is not a valid fts5 query,
+    then the term is searched as a phrase.
+
+    :param term: Search term
+    :return: List of dictionaries with nid, title, created, parent (title of the parent node, or Main) and snippet (body
+    extract with highlighted matches).
+    """
+    query = text("""
+        SELECT search_index.rowid AS nid, content.title AS title, node.created AS created,
+               coalesce(parent.title, 'Main') AS parent,
+               snippet(search_index, 1, :start, :end, '...', 16) AS snippet
+        FROM search_index
+        JOIN node ON node.id = search_index.rowid
+        JOIN content ON content.node_id = node.id
+        LEFT JOIN content AS parent ON parent.node_id = node.parent_id
+        WHERE search_index MATCH :term
+        ORDER BY bm25(search_index, 10.0, 1.0)
+    """)
+    params = dict(start=SNIPPET_START, end=SNIPPET_END, term=term)
+    try:
+        res = db.session.execute(query, params).fetchall()
+    except OperationalError:
+        current_app.logger.info("{term} is not a valid search query, search as phrase".format(term=term))
+        db.session.rollback()
+        params["term"] = '"{term}"'.format(term=term.replace('"', '""'))
+        res = db.session.execute(query, params).fetchall()
+    node_list = []
+    for row in res:
+        node = dict(row.items())
+        node["snippet"] = highlight(row.snippet, SNIPPET_START, SNIPPET_END)
+        node_list.append(node)
+    return node_list
 
 
 def update_taxonomy_for_node(nid, req_terms=None):
@@ -635,22 +1349,15 @@ def update_taxonomy_for_node(nid, req_terms=None):
     :param req_terms: List of taxonomy term IDs that apply to the node Id
     :return:
     """
-    if req_terms:
-        terms = [int(term) for term in req_terms]
-    else:
-        terms = []
-    # Get list of current taxonomy terms for the node
-    params = dict(node_id=nid)
-    tax_list = Taxonomy.query.filter_by(node_id=nid)
-    current_terms = [tax.term_id for tax in tax_list]
-    # Add new taxonomy terms
-    for term in terms:
-        if term not in current_terms:
-            params["term_id"] = term
-            Taxonomy.add(**params)
-    # Remove old taxonomy terms
-    for term in current_terms:
-        if term not in terms:
-            params["term_id"] = term
-            Taxonomy.delete(**params)
+    terms = {int(term) for term in req_terms or []}
+    # Get set of current taxonomy terms for the node
+    current_terms = {row.term_id for row in db.session.query(Taxonomy.term_id).filter_by(node_id=nid)}
+    with unit_of_work():
+        # Add new taxonomy terms
+        Taxonomy.add_terms(nid, terms - current_terms)
+        # Remove old taxonomy terms
+        Taxonomy.delete_terms(nid, current_terms - terms)
+        for term in terms ^ current_terms:
+            bump_version("term:{}".format(term))
+        node_changed(nid, lists=False)
     return
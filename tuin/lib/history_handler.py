@@ -0,0 +1,20 @@
+"""
+This script writes the page views that are buffered in Redis to the history table and the view counts. It is queued as
+an rq job by History.add when the buffer is full or when the oldest view is too old.
+"""
+from tuin import create_app
+from tuin.lib.db_model import History
+
+app = create_app()
+app.app_context().push()
+
+
+def flush_history():
+    """
+    This function writes the buffered page views to the database.
+
+    :return: Number of views written.
+    """
+    cnt = History.flush()
+    app.logger.info("History: {cnt} views written.".format(cnt=cnt))
+    return cnt
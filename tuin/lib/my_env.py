@@ -5,6 +5,7 @@ Also other utilities find their home here.
 """
 
 import configparser
+import html
 # import datetime
 import logging
 import logging.handlers
@@ -16,7 +17,7 @@ import time
 from calendar import timegm
 from datetime import datetime
 from dotenv import load_dotenv
-from flask import current_app
+from flask import current_app, escape, Markup
 
 
 def init_env(projectname, filename):
@@ -236,6 +237,36 @@ def fix_urls(text):
     return text
 
 
+TAG_REGEX = re.compile(r'<[^>]*>')
+
+
+def strip_tags(text):
+    """
+    This function removes the html tags from the text and converts html entities (&eacute;) to characters, so that only
+    the text is available for the search index.
+
+    :param text: Text with html tags, or None.
+    :return: Text without html tags.
+    """
+    if not text:
+        return ""
+    return html.unescape(TAG_REGEX.sub(" ", text))
+
+
+def highlight(snippet, start, end):
+    """
+    This function converts a search snippet with match markers into html. The snippet is escaped first, then the start
+    and end markers are replaced with the mark tags.
+
+    :param snippet: Search snippet with markers around the matches.
+    :param start: Marker for the start of a match.
+    :param end: Marker for the end of a match.
+    :return: Markup string with the matches in mark tags.
+    """
+    escaped = str(escape(snippet or ""))
+    return Markup(escaped.replace(start, "<mark>").replace(end, "</mark>"))
+
+
 def datestamp(epoch):
     """
     This is a Jinja2 filter
@@ -261,6 +292,35 @@ def monthdisp(ym):
     return "{m} {y}".format(y=yr, m=month_arr[int(mnth)-1])
 
 
+def month_key(epoch):
+    """
+    This function returns the month (UTC) for the timestamp, in the format used by the archive.
+
+    :param epoch: Unix timestamp - seconds since 1/01/1970 UTC
+
+    :return: Month in %Y-%m format.
+    """
+    return time.strftime("%Y-%m", time.gmtime(epoch))
+
+
+def month_range(ym):
+    """
+    This function returns the range of timestamps for the month, so that nodes for the month can be selected with an
+    index on the created timestamp.
+
+    :param ym: Month in %Y-%m format
+
+    :return: Timestamp of the first second of the month (UTC) and timestamp of the first second of the next month.
+    """
+    (yr, mnth) = [int(part) for part in ym.split("-")]
+    start = timegm((yr, mnth, 1, 0, 0, 0))
+    if mnth == 12:
+        end = timegm((yr + 1, 1, 1, 0, 0, 0))
+    else:
+        end = timegm((yr, mnth + 1, 1, 0, 0, 0))
+    return start, end
+
+
 class LoopInfo:
     """
     This class handles a FOR loop information handling.
@@ -0,0 +1,186 @@
+"""
+This module has the pcloud folder metadata cache. Folder listings are kept in Redis, so that folder IDs can be resolved
+and files can be found by name without listing the folder on pcloud. The cache is refreshed incrementally from the
+pcloud diff: each event since the last known diff ID is applied to the cached folders. Operations done by the handler
+(move, copy, upload) update the cache immediately.
+
+Redis keys:
+    pcloud:diffid - last diff ID applied to the cache.
+    pcloud:folders - set of folder IDs for which the listing is cached.
+    pcloud:folder:<folderid> - hash with file or folder name as key and metadata (json) as value.
+    pcloud:index - hash with pcloud id (f<fileid> or d<folderid>) as key and [parentfolderid, name] (json) as value.
+    pcloud:path - hash with folder path as key and folder ID as value.
+"""
+import json
+
+PREFIX = "pcloud"
+
+
+class FolderCache:
+
+    """
+    This class consolidates the Redis access for the pcloud folder metadata. Redis errors are not handled here, the
+    caller decides to continue without cache.
+    """
+
+    def __init__(self, redis, prefix=PREFIX):
+        """
+        :param redis: Redis connection.
+        :param prefix: Prefix for the Redis keys.
+        """
+        self.redis = redis
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return ":".join([self.prefix] + [str(part) for part in parts])
+
+    def add(self, metadata):
+        """
+        This method adds a file or folder to the listing of its parent folder, if the parent folder is cached.
+
+        :param metadata: pcloud metadata of the file or folder.
+        :return:
+        """
+        parentfolderid = metadata.get("parentfolderid")
+        if parentfolderid is None or not self.redis.sismember(self._key("folders"), parentfolderid):
+            return
+        metadata = {k: v for k, v in metadata.items() if k != "contents"}
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key("folder", parentfolderid), metadata["name"], json.dumps(metadata))
+        pipe.hset(self._key("index"), metadata["id"], json.dumps([parentfolderid, metadata["name"]]))
+        pipe.execute()
+
+    def apply_diff(self, entries):
+        """
+        This method applies the events from the pcloud diff to the cached folders. Create and modify events (including
+        rename and move) replace the file or folder, delete events remove it.
+
+        :param entries: List of diff entries.
+        :return: Number of events applied.
+        """
+        cnt = 0
+        for entry in entries:
+            event = entry["event"]
+            if event == "reset":
+                self.clear()
+            elif event.startswith("delete"):
+                self.remove(entry["metadata"]["id"])
+            elif event.startswith("create") or event.startswith("modify"):
+                if "id" not in entry.get("metadata", {}):
+                    # modifyuserinfo and the like.
+                    continue
+                self.remove(entry["metadata"]["id"], folder=False)
+                self.add(entry["metadata"])
+            else:
+                continue
+            cnt += 1
+        return cnt
+
+    def clear(self):
+        """
+        This method removes all cached metadata.
+
+        :return:
+        """
+        keys = list(self.redis.scan_iter(match=self._key("*")))
+        if keys:
+            self.redis.delete(*keys)
+
+    def diffid(self):
+        """
+        This method returns the last diff ID applied to the cache.
+
+        :return: diff ID, or None if the cache is not initialized.
+        """
+        diffid = self.redis.get(self._key("diffid"))
+        if diffid is None:
+            return None
+        return int(diffid)
+
+    def file(self, folderid, name):
+        """
+        This method returns the metadata for the file or folder name in folder folderid.
+
+        :param folderid: ID of the parent folder.
+        :param name: Name of the file or folder.
+        :return: metadata, or None if the file is not in the folder. KeyError if the folder is not cached.
+        """
+        if not self.redis.sismember(self._key("folders"), folderid):
+            raise KeyError(folderid)
+        metadata = self.redis.hget(self._key("folder", folderid), name)
+        if metadata is None:
+            return None
+        return json.loads(metadata)
+
+    def folder(self, folderid):
+        """
+        This method returns the cached listing of the folder.
+
+        :param folderid: ID of the folder.
+        :return: Dictionary with name as key and metadata as value, or None if the folder is not cached.
+        """
+        pipe = self.redis.pipeline()
+        pipe.sismember(self._key("folders"), folderid)
+        pipe.hgetall(self._key("folder", folderid))
+        cached, contents = pipe.execute()
+        if not cached:
+            return None
+        return {name.decode(): json.loads(metadata) for name, metadata in contents.items()}
+
+    def folderid(self, path):
+        """
+        This method returns the folder ID for a folder path.
+
+        :param path: Path of the folder.
+        :return: Folder ID, or None if the path is not known.
+        """
+        folderid = self.redis.hget(self._key("path"), path)
+        if folderid is None:
+            return None
+        return int(folderid)
+
+    def remove(self, pcloud_id, folder=True):
+        """
+        This method removes a file or folder from the listing of its parent folder. The listing of a removed folder is
+        dropped as well.
+
+        :param pcloud_id: pcloud id of the file (f<fileid>) or folder (d<folderid>).
+        :param folder: True to drop the listing of a removed folder. A folder that is moved or renamed keeps its
+            contents.
+        :return:
+        """
+        location = self.redis.hget(self._key("index"), pcloud_id)
+        pipe = self.redis.pipeline()
+        if location is not None:
+            parentfolderid, name = json.loads(location)
+            pipe.hdel(self._key("folder", parentfolderid), name)
+            pipe.hdel(self._key("index"), pcloud_id)
+        if folder and pcloud_id.startswith("d"):
+            folderid = pcloud_id[1:]
+            pipe.srem(self._key("folders"), folderid)
+            pipe.delete(self._key("folder", folderid))
+        pipe.execute()
+
+    def set_diffid(self, diffid):
+        self.redis.set(self._key("diffid"), diffid)
+
+    def store_folder(self, metadata, path=None):
+        """
+        This method stores the listing of a folder, replacing an earlier listing.
+
+        :param metadata: pcloud metadata of the folder, including contents.
+        :param path: Path of the folder, if the folder has been listed by path.
+        :return:
+        """
+        folderid = metadata["folderid"]
+        key = self._key("folder", folderid)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        for content in metadata["contents"]:
+            content = {k: v for k, v in content.items() if k != "contents"}
+            pipe.hset(key, content["name"], json.dumps(content))
+            pipe.hset(self._key("index"), content["id"], json.dumps([folderid, content["name"]]))
+        pipe.sadd(self._key("folders"), folderid)
+        if path:
+            pipe.hset(self._key("path"), path, folderid)
+        pipe.execute()
@@ -1,6 +1,163 @@
 import os
+import random
 import requests
+import threading
+import time
 from flask import current_app
+from redis.exceptions import RedisError
+from tuin.lib.pcloud_cache import FolderCache
+
+# Chunk size for streamed downloads.
+CHUNK_SIZE = 256 * 1024
+# Timeout in seconds for connect and for read of a request.
+TIMEOUT = (10, 120)
+# Number of retries for idempotent requests, with exponential backoff starting at BACKOFF_BASE seconds.
+RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Circuit breaker opens after FAILURE_THRESHOLD consecutive failures and stays open for RESET_TIMEOUT seconds.
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 60
+
+
+class PcloudError(Exception):
+    """
+    Base class for pcloud errors. Retryable errors are temporary errors that may succeed on a next attempt.
+    """
+
+    def __init__(self, msg, retryable=False):
+        super().__init__(msg)
+        self.retryable = retryable
+
+
+class PcloudConnectionError(PcloudError):
+    """
+    Connection error or timeout, no response received from pcloud.
+    """
+
+    def __init__(self, msg):
+        super().__init__(msg, retryable=True)
+
+
+class PcloudHTTPError(PcloudError):
+    """
+    pcloud returned a HTTP status other than OK. Server errors (5xx) and rate limiting (429) are retryable.
+    """
+
+    def __init__(self, msg, status):
+        super().__init__(msg, retryable=(status >= 500 or status == 429))
+        self.status = status
+
+
+class PcloudAPIError(PcloudError):
+    """
+    pcloud returned result other than 0 in the json response. Rate limiting (4000) and internal errors (5xxx) are
+    retryable.
+    """
+
+    def __init__(self, msg, result):
+        super().__init__(msg, retryable=(result == 4000 or result >= 5000))
+        self.result = result
+
+
+class PcloudUnavailable(PcloudError):
+    """
+    The circuit breaker is open, pcloud is not called.
+    """
+
+
+class CircuitBreaker:
+    """
+    This class stops calls to pcloud when the API is down. After failure_threshold consecutive failures the circuit
+    opens and calls fail immediately. After reset_timeout seconds the circuit is half open: a single trial call is
+    allowed through, other calls fail until the trial call is done. If the trial call is successful the circuit closes,
+    otherwise it opens again. A trial call that does not report back within reset_timeout seconds is replaced by a next
+    trial call.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.probed = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        This method raises PcloudUnavailable if the circuit is open, or if it is half open and the trial call is
+        running.
+
+        :return:
+        """
+        with self.lock:
+            if self.opened is None:
+                return
+            now = time.time()
+            remaining = self.reset_timeout - (now - self.opened)
+            if self.probed is not None:
+                remaining = max(remaining, self.reset_timeout - (now - self.probed))
+            if remaining > 0:
+                raise PcloudUnavailable("pcloud unavailable after {f} failures, retry after {s:.0f} seconds."
+                                        .format(f=self.failures, s=remaining))
+            # Half open: this call is the trial call.
+            self.probed = now
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probed is not None or self.failures >= self.failure_threshold:
+                self.opened = time.time()
+                self.probed = None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probed = None
+
+
+# The circuit breaker is shared by all handlers in the process.
+breaker = CircuitBreaker()
+
+
+def backoff(attempt):
+    """
+    This function returns the delay before the next attempt: exponential backoff with full jitter.
+
+    :param attempt: Number of the attempt that failed, starting from 1.
+    :return: Delay in seconds.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def check_result(res, action):
+    """
+    This function checks the result field of a pcloud json response.
+
+    :param res: json response.
+    :param action: Description of the action, for the error message.
+    :return:
+    """
+    result = res.get("result", 0)
+    if result != 0:
+        msg = "Could not {a}. Result: {r}, error: {e}.".format(a=action, r=result, e=res.get("error"))
+        raise PcloudAPIError(msg, result)
+
+
+def check_status(status, reason, action, accepted=(200,)):
+    """
+    This function checks the HTTP status of a pcloud response.
+
+    :param status: HTTP status code.
+    :param reason: HTTP reason.
+    :param action: Description of the action, for the error message.
+    :param accepted: Accepted status codes.
+    :return:
+    """
+    if status not in accepted:
+        msg = "Could not {a}. Status: {s}, reason: {reason}.".format(a=action, s=status, reason=reason)
+        raise PcloudHTTPError(msg, status)
 
 
 class PcloudHandler:
@@ -8,28 +165,33 @@ class PcloudHandler:
     """
     This class consolidates the pcloud functionality. On initialization a connection to pcloud account is set.
     List method allows to list all files in the specified folder. Logout method will close the connection.
+    All requests go through the same request layer: a request that fails raises a PcloudError. Temporary failures of
+    idempotent requests are retried with backoff, the circuit breaker stops all requests when pcloud is down.
+    Folder listings are kept in the folder cache in Redis. The cache is refreshed from the pcloud diff on first use, so
+    each handler does a single diff call instead of listing all folders. If Redis is not available, the folders are
+    listed on pcloud.
     """
 
-    def __init__(self):
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, cache=True):
         """
         On initialization a connection to pcloud account is done.
+
+        :param timeout: Timeout (connect, read) in seconds for each request.
+        :param retries: Number of retries for idempotent requests.
+        :param cache: True to use the folder cache.
         """
         user = os.getenv("PCLOUD_USER")
         passwd = os.getenv("PCLOUD_PWD")
         params = dict(username=user, password=passwd, getauth=1)
         self.url_base = os.getenv("PCLOUD_HOME")
-        method = "userinfo"
-        url = self.url_base + method
+        self.timeout = timeout
+        self.retries = retries
         self.session = requests.Session()
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not connect to pcloud. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        else:
-            current_app.logger.debug("Connected to pcloud")
-        # Status Code OK, so successful login
-        res = r.json()
+        self.cache = FolderCache(current_app.redis) if cache and hasattr(current_app, "redis") else None
+        self.cache_synced = False
+        res = self._call("userinfo", "connect to pcloud", params=params)
+        current_app.logger.debug("Connected to pcloud")
+        # Successful login
         self.auth = res["auth"]
         usedquota = res["usedquota"]
         quota = res["quota"]
@@ -37,6 +199,149 @@ class PcloudHandler:
         msg = "{pct:.2f}% used.".format(pct=pct)
         current_app.logger.debug(msg)
 
+    def _call(self, method, action, params=None, files=None, headers=None, idempotent=True):
+        """
+        This method calls the pcloud API method and returns the json response. The json result field is checked.
+
+        :param method: pcloud API method.
+        :param action: Description of the action, for log and error messages.
+        :param params: Dictionary with parameters for the method.
+        :param files: Files to upload, the request is a POST.
+        :param headers: Dictionary with additional headers.
+        :param idempotent: True if the request can be retried.
+        :return: json response.
+        """
+        url = self.url_base + method
+
+        def send():
+            if files:
+                r = self.session.post(url, params=params, files=files, headers=headers, timeout=self.timeout)
+            else:
+                r = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            check_status(r.status_code, r.reason, action)
+            res = r.json()
+            check_result(res, action)
+            return res
+        return self._retry(send, action, idempotent)
+
+    def _retry(self, send, action, idempotent=True):
+        """
+        This method sends a request. Temporary failures are retried with backoff if the request is idempotent. Failures
+        are registered in the circuit breaker.
+
+        :param send: Function that sends the request and checks the response.
+        :param action: Description of the action, for log and error messages.
+        :param idempotent: True if the request can be retried.
+        :return: Result of send.
+        """
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(1, attempts + 1):
+            breaker.check()
+            try:
+                res = send()
+            except PcloudError as exc:
+                error = exc
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = PcloudConnectionError("Could not {a}. {e}".format(a=action, e=exc))
+            else:
+                breaker.success()
+                return res
+            if error.retryable:
+                breaker.failure()
+            else:
+                # pcloud answered, the request itself is not accepted.
+                breaker.success()
+            if not error.retryable or attempt == attempts:
+                current_app.logger.critical(str(error))
+                raise error
+            delay = backoff(attempt)
+            current_app.logger.warning("{e} Attempt {a} of {t}, retry in {d:.1f} seconds."
+                                       .format(e=error, a=attempt, t=attempts, d=delay))
+            time.sleep(delay)
+
+    def _cache_disable(self, exc):
+        current_app.logger.warning("Folder cache not available, continue without cache. {}".format(exc))
+        self.cache = None
+
+    def _cache_sync(self):
+        """
+        This method brings the folder cache up to date with the events from the pcloud diff since the last sync. If the
+        cache is not initialized, or the diff ID is not accepted anymore, then the cache is cleared and starts from the
+        current diff ID.
+
+        :return: True if the folder cache can be used, False otherwise.
+        """
+        if self.cache is None:
+            return False
+        if self.cache_synced:
+            return True
+        try:
+            diffid = self.cache.diffid()
+            res = None
+            if diffid is not None:
+                try:
+                    res = self._call("diff", "get folder changes", params=dict(diffid=diffid))
+                except PcloudAPIError as exc:
+                    current_app.logger.warning("Folder cache reset. {}".format(exc))
+            if res is None:
+                self.cache.clear()
+                res = self._call("diff", "get folder changes", params=dict(last=0))
+            else:
+                cnt = self.cache.apply_diff(res["entries"])
+                current_app.logger.debug("Folder cache: {} changes applied.".format(cnt))
+            self.cache.set_diffid(res["diffid"])
+        except RedisError as exc:
+            self._cache_disable(exc)
+            return False
+        self.cache_synced = True
+        return True
+
+    def _cache_update(self, *metadata):
+        """
+        This method updates the folder cache with the metadata returned by an operation of this handler.
+
+        :param metadata: pcloud metadata of the files that are created, moved or copied.
+        :return:
+        """
+        if self.cache is None:
+            return
+        try:
+            for item in metadata:
+                self.cache.remove(item["id"], folder=False)
+                self.cache.add(item)
+        except RedisError as exc:
+            self._cache_disable(exc)
+
+    def _folder(self, folderid=None, foldername=None):
+        """
+        This method returns the contents of the folder from the folder cache. The folder is listed on pcloud if it is
+        not in the cache.
+
+        :param folderid: ID of the folder (preferred)
+        :param foldername: Name of the folder.
+        :return: Dictionary with name as key and metadata as value.
+        """
+        if self._cache_sync():
+            try:
+                if folderid is None:
+                    folderid = self.cache.folderid(foldername)
+                if folderid is not None:
+                    contents = self.cache.folder(folderid)
+                    if contents is not None:
+                        return contents
+            except RedisError as exc:
+                self._cache_disable(exc)
+        if foldername:
+            res = self.listfolder(foldername=foldername)
+        else:
+            res = self.listfolder(folderid)
+        if self.cache is not None:
+            try:
+                self.cache.store_folder(res["metadata"], foldername)
+            except RedisError as exc:
+                self._cache_disable(exc)
+        return {content["name"]: content for content in res["metadata"]["contents"]}
+
     def close_connection(self):
         """
         Logout from pcloud and close connection.
@@ -44,15 +349,8 @@ class PcloudHandler:
         :return:
         """
         headers = dict(Connection='close')
-        method = "logout"
-        url = self.url_base + method
-        r = self.session.get(url, headers=headers)
-        if r.status_code != 200:
-            msg = "Could not close connection. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so connection close successful.
-        res = r.json()
+        res = self._call("logout", "close connection", headers=headers)
+        self.session.close()
         return res
 
     def close_file(self, file_desc):
@@ -63,17 +361,8 @@ class PcloudHandler:
         :return: binary contents of the file
         """
         params = dict(fd=file_desc)
-        method = "file_close"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not open file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        else:
-            current_app.logger.debug("File is closed")
-        # Status Code OK, so successful login
-        res = r.json()
+        res = self._call("file_close", "close file", params=params)
+        current_app.logger.debug("File is closed")
         return res
 
     def copyfile(self, fileid, tofolderid):
@@ -85,21 +374,32 @@ class PcloudHandler:
         :return:
         """
         params = dict(fileid=fileid, tofolderid=tofolderid)
-        method = "copyfile"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not copy file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so successful login
-        res = r.json()
+        res = self._call("copyfile", "copy file", params=params, idempotent=False)
+        self._cache_update(res["metadata"])
         return res
 
+    def find_file(self, folderid, name):
+        """
+        This method returns the metadata for file name in folder folderid. The file is looked up in the folder cache,
+        the folder is listed on pcloud only if it is not in the cache.
+
+        :param folderid: ID of the folder.
+        :param name: Name of the file.
+        :return: Dictionary with file information, or None if the file is not in the folder.
+        """
+        if self._cache_sync():
+            try:
+                return self.cache.file(folderid, name)
+            except KeyError:
+                pass
+            except RedisError as exc:
+                self._cache_disable(exc)
+        return self._folder(folderid).get(name)
+
     def folder_contents(self, folderid=None, foldername=None):
         """
         This method gets a pcloud folder ID and returns a dictionary with sub-directory contents and a dictionary with
-        file contents
+        file contents. Contents are taken from the folder cache if available.
 
         :param folderid: ID of the folder (preferred)
         :param foldername: Name of the folder.
@@ -107,34 +407,29 @@ class PcloudHandler:
         """
         subdirs = {}
         files = {}
-        res = self.listfolder(folderid, foldername)
-        contents = res["metadata"]["contents"]
-        for content in contents:
-            name = content["name"]
+        for name, content in self._folder(folderid, foldername).items():
             if content["isfolder"]:
                 subdirs[name] = content
             else:
                 files[name] = content
         return subdirs, files
 
-    def get_content(self, file):
+    def get_content(self, file, length=None):
         """
-        This method returns the contents of the file.
+        This method returns the contents of the file. The file is downloaded in a single streamed request from a file
+        link. If length is specified, then only the leading bytes of the file are downloaded. This is sufficient to
+        get exif information and jpeg headers.
 
         :param file: Dictionary with file information.
+        :param length: Number of leading bytes to return. Default: complete file.
         :return: (binary) contents of the file.
         """
-        file_id = file["fileid"]
-        file_desc = self.get_file(file["fileid"])
-        fd = file_desc["fd"]
-        size = file["size"]
-        current_app.logger.debug("File {}, ID {} open with File descriptor {} and size".format(file["name"], file_id,
-                                                                                               fd, size))
-        # Get file contents
-        contents = self.read_file(fd, size)
-        # Close file
-        self.close_file(fd)
-        return contents
+        contents = bytearray()
+        for chunk in self.iter_content(file, length=length):
+            contents.extend(chunk)
+        current_app.logger.debug("File {}, ID {} downloaded {} bytes of {}".format(file["name"], file["fileid"],
+                                                                                   len(contents), file.get("size")))
+        return bytes(contents)
 
     def get_file(self, file_id):
         """
@@ -144,16 +439,20 @@ class PcloudHandler:
         :return: Result of the open operation. Json string with 'fd' as file descriptor.
         """
         params = dict(fileid=file_id, flags=0)
-        method = "file_open"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not open file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so successful login
-        res = r.json()
-        return res
+        return self._call("file_open", "open file", params=params, idempotent=False)
+
+    def get_file_link(self, file_id):
+        """
+        This method returns a download link for the file with ID file_id.
+
+        :param file_id: pcloud file ID
+        :return: URL to download the file.
+        """
+        params = dict(fileid=file_id)
+        res = self._call("getfilelink", "get file link", params=params)
+        # File link has the same scheme as the API.
+        scheme = self.url_base.split(":")[0]
+        return "{scheme}://{host}{path}".format(scheme=scheme, host=res["hosts"][0], path=res["path"])
 
     def get_public_cloud_id(self):
         """
@@ -164,6 +463,43 @@ class PcloudHandler:
         subdirs, _ = self.folder_contents(foldername="/")
         return subdirs["Public Folder"]["folderid"]
 
+    def iter_content(self, file, length=None, chunk_size=CHUNK_SIZE):
+        """
+        This method streams the contents of the file in chunks, so that the file does not need to be in memory. If
+        length is specified, then a range request is done for the leading bytes of the file.
+
+        :param file: Dictionary with file information.
+        :param length: Number of leading bytes to return. Default: complete file.
+        :param chunk_size: Size of the chunks.
+        :return: Generator for (binary) chunks of the file.
+        """
+        url = self.get_file_link(file["fileid"])
+        headers = {}
+        if length:
+            headers["Range"] = "bytes=0-{end}".format(end=length - 1)
+
+        def send():
+            resp = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+            try:
+                check_status(resp.status_code, resp.reason, "download file", accepted=(200, 206))
+            except PcloudError:
+                resp.close()
+                raise
+            return resp
+        r = self._retry(send, "download file")
+        try:
+            remaining = length
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if remaining is not None:
+                    # Server may ignore the range request.
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                yield chunk
+                if remaining == 0:
+                    break
+        finally:
+            r.close()
+
     def listfolder(self, folderid=None, foldername=None):
         """
         This method will get a folder ID and return json string with folder information.
@@ -180,16 +516,7 @@ class PcloudHandler:
         else:
             current_app.logger.error("Listfolder called without specifying foldername or ID")
             return
-        method = "listfolder"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not collect metadata. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so successful login
-        res = r.json()
-        return res
+        return self._call("listfolder", "collect metadata", params=params)
 
     def logout(self):
         """
@@ -197,19 +524,16 @@ class PcloudHandler:
 
         :return:
         """
-        method = "logout"
-        url = self.url_base + method
         params = dict(auth=self.auth)
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not logout from pcloud. Status: {s}, reason: {rsn}.".format(s=r.status_code, rsn=r.reason)
-            current_app.logger.error(msg)
+        try:
+            res = self._call("logout", "logout from pcloud", params=params)
+        except PcloudError as exc:
+            current_app.logger.error(str(exc))
         else:
-            res = r.json()
             if res["auth_deleted"]:
                 msg = "Logout as required"
             else:
-                msg = "Logout not successful, status code: {status}".format(status=r.status_code)
+                msg = "Logout not successful"
             current_app.logger.info(msg)
 
     def movefile(self, fileid, tofolderid, filename):
@@ -222,15 +546,8 @@ class PcloudHandler:
         :return:
         """
         params = dict(fileid=fileid, tofolderid=tofolderid, toname=filename)
-        method = "renamefile"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not move file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so successful login
-        res = r.json()
+        res = self._call("renamefile", "move file", params=params)
+        self._cache_update(res["metadata"])
         return res
 
     def read_file(self, file_desc, size):
@@ -242,17 +559,31 @@ class PcloudHandler:
         :return: Contents of the file.
         """
         params = dict(fd=file_desc, count=size)
-        method = "file_read"
-        url = self.url_base + method
-        r = self.session.get(url, params=params)
-        if r.status_code != 200:
-            msg = "Could not open file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        else:
-            current_app.logger.debug("File has been read")
-        # Status Code OK, so successful login
-        res = r.content
+        url = self.url_base + "file_read"
+
+        def send():
+            resp = self.session.get(url, params=params, timeout=self.timeout)
+            check_status(resp.status_code, resp.reason, "read file")
+            return resp.content
+        # Reading moves the file offset, so the request is not retried.
+        res = self._retry(send, "read file", idempotent=False)
+        current_app.logger.debug("File has been read")
+        return res
+
+    def upload_content(self, file, content, folderid):
+        """
+        This method loads content as file to folderid. Content can be bytes or a file-like object, so that pictures
+        can be uploaded from memory.
+
+        :param file: Target File name.
+        :param content: Bytes or file-like object (opened in binary mode) with the contents of the file.
+        :param folderid: pcloud target folderid.
+        :return:
+        """
+        files = {file: (file, content)}
+        params = dict(folderid=folderid)
+        res = self._call("uploadfile", "upload file", params=params, files=files, idempotent=False)
+        self._cache_update(*res["metadata"])
         return res
 
     def upload_file(self, file, ffn, folderid):
@@ -264,15 +595,5 @@ class PcloudHandler:
         :param folderid: pcloud target folderid.
         :return:
         """
-        files = {file: open(ffn, 'rb')}
-        params = dict(folderid=folderid)
-        method = "uploadfile"
-        url = self.url_base + method
-        r = self.session.post(url, files=files, params=params)
-        if r.status_code != 200:
-            msg = "Could not upload file. Status: {s}, reason: {reason}.".format(s=r.status_code, reason=r.reason)
-            current_app.logger.critical(msg)
-            raise SystemExit(msg)
-        # Status Code OK, so successful login
-        res = r.json()
-        return res
+        with open(ffn, 'rb') as fh:
+            return self.upload_content(file, fh, folderid)
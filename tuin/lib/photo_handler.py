@@ -3,22 +3,34 @@ This script captures all pictures ready for publishing, move each picture to ori
 small version of the picture. The picture is added as a 'photo' node to the database, including indication for 'new'
 picture.
 """
+import io
 import os
 import tuin.lib.db_model as ds
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from dateutil import tz
 # from flask import current_app
 from pathlib import Path
 from tuin import create_app
 from tuin.lib import pcloud_handler
-from tuin.lib.db_model import Node, Photo, Content
-from PIL import ImageFile
+from tuin.lib.db_model import Node, Photo, Content, Ingest, unit_of_work
+from PIL import Image
 from PIL.ExifTags import TAGS
 from PIL.Image import LANCZOS
+from rq import get_current_job
 
 app = create_app()
 app.app_context().push()
 
+# Job name in the ingestion ledger.
+JOB = "photo_handler"
+# Longest side of the medium image, shortest side of the small image.
+MEDIUM_SIZE = 800
+SMALL_SIZE = 150
+# Lossless transpose for EXIF orientation 3 (180), 6 (-90) and 8 (+90).
+ORIENTATION_TRANSPOSE = {3: Image.ROTATE_180, 6: Image.ROTATE_270, 8: Image.ROTATE_90}
+
 
 def create_node(filename, orig, created_dt):
     """
@@ -30,40 +42,42 @@ def create_node(filename, orig, created_dt):
     :param created_dt: Picture (or File) creation Datetime object.
     :return:
     """
-    # Check if photo already exist.
-    node_id = Photo.get_node_id(filename)
-    if node_id:
-        app.logger.warning("Photo {} from file {} exists already, refreshed.".format(filename, orig))
-        params = dict(
-            node_id=node_id,
-            filename=filename,
-            orig_filename=orig,
-            created=int(created_dt.timestamp()),
-            fresh=1
-        )
-        Photo.edit(**params)
-    else:
-        # New photo, create Node record.
-        app.logger.info("Photo {} from file {} created.".format(filename, orig))
-        params = dict(
-            type='photo',
-        )
-        node_id = Node.add(**params)
-        params = dict(
-            node_id=node_id,
-            filename=filename,
-            orig_filename=orig,
-            created=int(created_dt.timestamp()),
-            fresh=1
-        )
-        Photo.add(**params)
-        params = dict(
-            node_id=node_id,
-            title="Nieuwe Foto",
-            body=""
-        )
-        Content.update(**params)
-    Node.set_created(node_id)
+    # Node, photo and content records are committed in one transaction.
+    with unit_of_work():
+        # Check if photo already exist.
+        node_id = Photo.get_node_id(filename)
+        if node_id:
+            app.logger.warning("Photo {} from file {} exists already, refreshed.".format(filename, orig))
+            params = dict(
+                node_id=node_id,
+                filename=filename,
+                orig_filename=orig,
+                created=int(created_dt.timestamp()),
+                fresh=1
+            )
+            Photo.edit(**params)
+        else:
+            # New photo, create Node record.
+            app.logger.info("Photo {} from file {} created.".format(filename, orig))
+            params = dict(
+                type='photo',
+            )
+            node_id = Node.add(**params)
+            params = dict(
+                node_id=node_id,
+                filename=filename,
+                orig_filename=orig,
+                created=int(created_dt.timestamp()),
+                fresh=1
+            )
+            Photo.add(**params)
+            params = dict(
+                node_id=node_id,
+                title="Nieuwe Foto",
+                body=""
+            )
+            Content.update(**params)
+        Node.set_created(node_id)
     return
 
 
@@ -121,7 +135,8 @@ def get_labeled_exif(file, image):
 
 def rotate_image(image, orientation):
     """
-    This method rotates an image if required. Orientation 1 is OK, 6 is -90, 8 is +90, 3 is 180.
+    This method rotates an image if required. Orientation 1 is OK, 6 is -90, 8 is +90, 3 is 180. Rotation is done with
+    a lossless transpose.
 
     :param image: Image to be rotated.
     :param orientation: current image orientation.
@@ -129,16 +144,12 @@ def rotate_image(image, orientation):
     """
     if orientation == 1:
         return image
-    elif orientation == 6:
-        angle = -90
-    elif orientation == 8:
-        angle = 90
-    elif orientation == 3:
-        angle = 180
-    else:
+    try:
+        method = ORIENTATION_TRANSPOSE[orientation]
+    except KeyError:
         app.logger.error("Unexpected orientation: {}".format(orientation))
         return image
-    return image.rotate(angle, expand=True)
+    return image.transpose(method)
 
 
 def resize_large(size, max_length):
@@ -198,148 +209,400 @@ def to_medium(image):
     :param image: PIL Image object to be converted.
     :return:
     """
-    medium_size = 800
-    size_tuple = resize_large(image.size, medium_size)
+    size_tuple = resize_large(image.size, MEDIUM_SIZE)
     medium_image = image.resize(size_tuple, resample=LANCZOS)
     return medium_image
 
 
 def to_small(image):
     """
-    This method converts the medium image to a small sized cropped image. The shortest side is 150. The longest side
-    will be cropped in website. Orientation is OK from creating the medium-sized image.
+    This method converts the image to a small sized cropped image. The shortest side is 150. The longest side will be
+    cropped in website.
 
     :param image: PIL Image object to be converted.
     :return:
     """
-    small_size = 150
-    size_tuple = resize_small(image.size, small_size)
+    size_tuple = resize_small(image.size, SMALL_SIZE)
     small_image = image.resize(size_tuple, resample=LANCZOS)
     return small_image
 
 
-def photo_handler():
+def to_jpeg(image):
     """
-    Main function for photo handling.
+    This method encodes the image as jpeg, with the same settings as saving the image to a .jpg file.
 
-    :return:
+    :param image: PIL Image object to be encoded.
+    :return: (binary) jpeg contents of the image.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def make_derivatives(file, content):
+    """
+    This function converts the picture contents into the medium and small sized picture. The jpeg is decoded with draft
+    mode, so the decoder downscales in the DCT domain to the smallest scale that is still larger than the medium size.
+    The full resolution picture is never in memory. The medium and the small picture are both created from the decoded
+    picture in one pass, the sizes are calculated on the original size. Rotation is done on the resized pictures.
+    It is called in a worker process by the pipelined photo handler, so arguments and result need to be picklable. The
+    EXIF information is reduced to the tags that are required to create the node.
+
+    :param file: Filename of the picture.
+    :param content: (binary) contents of the picture.
+    :return: exif (dictionary with DateTimeOriginal and Orientation or None), medium and small picture as jpeg bytes.
+    """
+    img = Image.open(io.BytesIO(content))
+    # Get exif information from picture
+    exif = get_labeled_exif(file, img)
+    app.logger.debug("EXIF: {}".format(exif))
+    # Medium and small size are calculated on the original size, draft returns a size that is equal or larger.
+    medium_size = resize_large(img.size, MEDIUM_SIZE)
+    small_size = resize_small(img.size, SMALL_SIZE)
+    img.draft(img.mode, medium_size)
+    medium_img = img.resize(medium_size, resample=LANCZOS)
+    small_img = img.resize(small_size, resample=LANCZOS)
+    img.close()
+    if isinstance(exif, dict):
+        try:
+            medium_img = rotate_image(medium_img, exif["Orientation"])
+            small_img = rotate_image(small_img, exif["Orientation"])
+        except KeyError:
+            app.logger.info("{} no Orientation in exif data".format(file))
+        exif = {k: exif[k] for k in ("DateTimeOriginal", "Orientation") if k in exif}
+    return exif, to_jpeg(medium_img), to_jpeg(small_img)
+
+
+def get_folder_ids(pcloud):
+    """
+    This function returns the pcloud folder IDs for the picture directories.
+
+    :param pcloud: PcloudHandler object.
+    :return: Dictionary with keys source, original, medium and small.
     """
-    # Get directory names
-    source_dirname = app.config.get("SOURCE_FOLDER")
-    original_dirname = app.config["ORIGINAL_FOLDER"]
-    medium_dirname = app.config["MEDIUM_FOLDER"]
-    small_dirname = app.config["SMALL_FOLDER"]
-    # Connect to pcloud and get directory structure
-    pcloud = pcloud_handler.PcloudHandler()
     public_cloud_id = pcloud.get_public_cloud_id()
     # Get folders from Public Folder
     subdirs, _ = pcloud.folder_contents(public_cloud_id)
     # Directory names to folder IDs - remove trailing slashes from directory names
+    folder_ids = {}
+    for label in ["original", "medium", "small"]:
+        dirname = app.config["{}_FOLDER".format(label.upper())]
+        folder_ids[label] = subdirs[dirname[:-1]]["folderid"]
+    source_dirname = app.config.get("SOURCE_FOLDER")
     if source_dirname:
-        source_folderid = subdirs[source_dirname[:-1]]["folderid"]
+        folder_ids["source"] = subdirs[source_dirname[:-1]]["folderid"]
     else:
-        source_folderid = public_cloud_id
-    original_folderid = subdirs[original_dirname[:-1]]["folderid"]
-    medium_folderid = subdirs[medium_dirname[:-1]]["folderid"]
-    small_folderid = subdirs[small_dirname[:-1]]["folderid"]
+        folder_ids["source"] = public_cloud_id
+    return folder_ids
+
+
+def in_app_context(func, *args):
+    """
+    This function runs func in the application context. This is required for functions that run in a worker thread.
+
+    :param func: Function to run.
+    :param args: Arguments for the function.
+    :return: Result of the function.
+    """
+    with app.app_context():
+        return func(*args)
+
+
+def photo_failed(filedata, exc):
+    """
+    This function handles a pcloud error for a picture. The picture is skipped, the steps that are done are in the
+    ledger so the picture is handled in a next run. If pcloud is unavailable, then there is no use in trying the next
+    picture and the error is raised.
+
+    :param filedata: Dictionary with pcloud file information of the picture.
+    :param exc: PcloudError.
+    :return:
+    """
+    if isinstance(exc, pcloud_handler.PcloudUnavailable):
+        raise exc
+    app.logger.error("File {} skipped, will be handled in a next run. {}".format(filedata["name"], exc))
+    return
+
+
+def report_progress(progress, step):
+    """
+    This function reports the progress of the function in the job meta data, if the function runs as a task.
+
+    :param progress: Progress in percent.
+    :param step: Description of the current step.
+    :return:
+    """
+    job = get_current_job()
+    if job:
+        job.meta['progress'] = progress
+        job.meta['step'] = step
+        job.save_meta()
+    return
+
+
+def publish_photo(pcloud, filedata, fn, medium, small, folder_ids, done):
+    """
+    This function moves the picture to the original directory and uploads the medium and small picture. Steps that are
+    done already in an earlier run are skipped. Each step is registered in the ledger when it is completed.
+
+    :param pcloud: PcloudHandler object.
+    :param filedata: Dictionary with pcloud file information of the picture.
+    :param fn: Calculated filename for the picture.
+    :param medium: Medium picture (jpeg bytes).
+    :param small: Small picture (jpeg bytes).
+    :param folder_ids: Dictionary with the pcloud folder IDs.
+    :param done: Steps done for the picture in an earlier run.
+    :return:
+    """
+    if "moved" not in done:
+        # Move file to Original directory
+        pcloud.movefile(filedata["fileid"], folder_ids["original"], fn)
+        Ingest.add(JOB, filedata, "moved")
+    if "medium" not in done:
+        upload_image(pcloud, fn, medium, folder_ids["medium"], "medium")
+        Ingest.add(JOB, filedata, "medium")
+    if "small" not in done:
+        upload_image(pcloud, fn, small, folder_ids["small"], "small")
+        Ingest.add(JOB, filedata, "small")
+    Ingest.finish(JOB, filedata["fileid"])
+    return
+
+
+def needs_content(done):
+    """
+    This function checks if the picture needs to be downloaded, given the steps that are done already. The picture is
+    required to calculate the filename and to create the medium and small picture.
+
+    :param done: Steps done for the picture in an earlier run.
+    :return: True if the picture needs to be downloaded, False otherwise.
+    """
+    return not {"downloaded", "medium", "small"}.issubset(done)
+
+
+def register_photo(filedata, exif, done):
+    """
+    This function calculates the filename for the picture and creates the node for it. If the picture has been
+    registered in an earlier run, then filename and creation date are taken from the ledger.
+
+    :param filedata: Dictionary with pcloud file information of the picture.
+    :param exif: Exif information (dictionary) or None if no exif info is available.
+    :param done: Steps done for the picture in an earlier run.
+    :return: Calculated filename.
+    """
+    file = filedata["name"]
+    if "downloaded" in done:
+        fn = done["downloaded"].target
+        created_dt = datetime.fromtimestamp(done["downloaded"].created)
+    else:
+        # Calculate new filename including date/time picture taken
+        created_dt = get_created_datetime(filedata, exif)
+        fn = get_filename(file, created_dt)
+        Ingest.add(JOB, filedata, "downloaded", target=fn, created=int(created_dt.timestamp()))
+    if "node" not in done:
+        # The node and its ledger step are committed together.
+        with ds.unit_of_work():
+            create_node(fn, file, created_dt)
+            Ingest.add(JOB, filedata, "node")
+    return fn
+
+
+def submit_derivatives(download_pool, resize_pool, pcloud, filedata):
+    """
+    This function chains the download of the picture in the download pool with the creation of the medium and small
+    picture in the resize pool.
+
+    :param download_pool: Thread pool for the downloads.
+    :param resize_pool: Process pool for the resizing.
+    :param pcloud: PcloudHandler object.
+    :param filedata: Dictionary with pcloud file information of the picture.
+    :return: Future with the result of make_derivatives.
+    """
+    result = Future()
+
+    def resize(download):
+        try:
+            content = download.result()
+            resize_pool.submit(make_derivatives, filedata["name"], content).add_done_callback(copy_result)
+        except Exception as exc:
+            result.set_exception(exc)
+
+    def copy_result(derivatives):
+        try:
+            result.set_result(derivatives.result())
+        except Exception as exc:
+            result.set_exception(exc)
+
+    download_pool.submit(in_app_context, pcloud.get_content, filedata).add_done_callback(resize)
+    return result
+
+
+def upload_image(pcloud, fn, content, folderid, label):
+    """
+    This function uploads a medium or small picture from memory to pcloud.
+
+    :param pcloud: PcloudHandler object.
+    :param fn: Filename for the picture.
+    :param content: Picture (jpeg bytes).
+    :param folderid: pcloud target folder ID.
+    :param label: medium or small, for logging.
+    :return:
+    """
+    res = pcloud.upload_content(fn, io.BytesIO(content), folderid)
+    app.logger.info("File {} {} format loaded, result: {}".format(fn, label, res["result"]))
+    return
+
+
+def photo_handler(pipelined=None):
+    """
+    Main function for photo handling.
+
+    In pipelined mode the pictures are downloaded, resized and uploaded in separate bounded worker pools, nodes are
+    created in the calling thread in the order of the files. Configuration:
+    PHOTO_PIPELINE (run pipelined, default False), PHOTO_DOWNLOAD_WORKERS (default 4), PHOTO_RESIZE_WORKERS (default
+    number of cpus), PHOTO_UPLOAD_WORKERS (default 4) and PHOTO_PIPELINE_DEPTH (maximum number of pictures waiting
+    for the next stage, default 8).
+
+    A picture with a pcloud error is skipped and handled in a next run, unless pcloud is unavailable.
+
+    :param pipelined: True to run pipelined, False to run serial, None to use PHOTO_PIPELINE setting.
+    :return: Number of pictures processed.
+    """
+    if pipelined is None:
+        pipelined = app.config.get("PHOTO_PIPELINE", False)
+    Ingest.init_table()
+    # Connect to pcloud and get directory structure
+    pcloud = pcloud_handler.PcloudHandler()
+    folder_ids = get_folder_ids(pcloud)
     # Collect files from source directory
-    _, files = pcloud.folder_contents(source_folderid)
+    _, files = pcloud.folder_contents(folder_ids["source"])
     # Only handle accepted file types
     accepted_types = [".JPG", ".jpg"]
     files = [files[file] for file in files if Path(file).suffix in accepted_types]
-    for filedata in files:
-        file = filedata["name"]
-        fileid = filedata["fileid"]
-        app.logger.debug("Working on file {}".format(file))
-        # Get file contents and convert to an image - also required to get exif for date and time of picture taken.
-        content = pcloud.get_content(filedata)
-        app.logger.debug("File {} length: {} (expected: {})".format(file, len(content), filedata["size"]))
-        parser = ImageFile.Parser()
-        parser.feed(content)
-        img = parser.close()
-        # Get exif information from picture
-        exif = get_labeled_exif(file, img)
-        app.logger.debug("EXIF: {}".format(exif))
-        # Calculate new filename including date/time picture taken
-        created_dt = get_created_datetime(filedata, exif)
-        fn = get_filename(file, created_dt)
-        create_node(fn, file, created_dt)
-        # Move file to Original directory
-        pcloud.movefile(fileid, original_folderid, fn)
-        # Create medium image
-        medium_img = to_medium(img)
-        if isinstance(exif, dict):
+    # Add pictures from an earlier run that stopped halfway. These may have been moved from the source directory.
+    fileids = [filedata["fileid"] for filedata in files]
+    files += [filedata for filedata in Ingest.pending(JOB) if filedata["fileid"] not in fileids]
+    if pipelined:
+        nr_failed = photo_pipeline(pcloud, files, folder_ids)
+    else:
+        nr_failed = 0
+        for filedata in files:
+            file = filedata["name"]
+            app.logger.debug("Working on file {}".format(file))
+            done = Ingest.steps(JOB, filedata["fileid"])
+            exif, medium, small = None, None, None
             try:
-                medium_img = rotate_image(medium_img, exif["Orientation"])
-            except KeyError:
-                app.logger.info("{} ({}) no Orientation in exif data".format(file, fn))
-        medium_ffn = os.path.join(os.getenv('LOGDIR'), fn)
-        medium_img.save(medium_ffn)
-        res = pcloud.upload_file(fn, medium_ffn, medium_folderid)
-        app.logger.info("File {} medium format loaded, result: {}".format(fn, res["result"]))
-        os.remove(medium_ffn)
-        # Create small image
-        small_img = to_small(medium_img)
-        small_ffn = os.path.join(os.getenv('LOGDIR'), fn)
-        small_img.save(small_ffn)
-        res = pcloud.upload_file(fn, small_ffn, small_folderid)
-        app.logger.info("File {} small format loaded, result: {}".format(fn, res["result"]))
-        os.remove(small_ffn)
+                if needs_content(done):
+                    # Get file contents and convert to an image - also required to get exif for date and time.
+                    content = pcloud.get_content(filedata)
+                    app.logger.debug("File {} length: {} (expected: {})".format(file, len(content), filedata["size"]))
+                    exif, medium, small = make_derivatives(file, content)
+                fn = register_photo(filedata, exif, done)
+                publish_photo(pcloud, filedata, fn, medium, small, folder_ids, done)
+            except pcloud_handler.PcloudError as exc:
+                photo_failed(filedata, exc)
+                nr_failed += 1
     pcloud.close_connection()
-    nr_files = len(files)
-    app.logger.info("{} pictures have been processed.".format(nr_files))
+    ds.count_nf_reconcile()
+    nr_files = len(files) - nr_failed
+    app.logger.info("{} pictures have been processed, {} skipped.".format(nr_files, nr_failed))
     return nr_files
 
 
+def photo_pipeline(pcloud, files, folder_ids):
+    """
+    This function handles the pictures in a pipeline. Downloads and uploads run in thread pools, resizing runs in a
+    process pool. Nodes are created in this thread, in the order of the files. Upload threads register their steps in
+    the ledger with their own session, as the application context is pushed for each call. The number of pictures
+    waiting for node creation and the number of pictures waiting for upload are limited to PHOTO_PIPELINE_DEPTH, so
+    memory usage does not grow with the number of pictures.
+
+    :param pcloud: PcloudHandler object.
+    :param files: List of dictionaries with pcloud file information of the pictures.
+    :param folder_ids: Dictionary with the pcloud folder IDs.
+    :return: Number of pictures skipped on a pcloud error.
+    """
+    depth = app.config.get("PHOTO_PIPELINE_DEPTH", 8)
+    download_workers = app.config.get("PHOTO_DOWNLOAD_WORKERS", 4)
+    resize_workers = app.config.get("PHOTO_RESIZE_WORKERS", os.cpu_count())
+    upload_workers = app.config.get("PHOTO_UPLOAD_WORKERS", 4)
+    resized = deque()
+    uploads = deque()
+    failed = []
+
+    def register_next():
+        filedata, done, derivatives = resized.popleft()
+        try:
+            exif, medium, small = derivatives.result()
+        except pcloud_handler.PcloudError as exc:
+            photo_failed(filedata, exc)
+            failed.append(filedata)
+            return
+        fn = register_photo(filedata, exif, done)
+        uploads.append((filedata, upload_pool.submit(in_app_context, publish_photo, pcloud, filedata, fn, medium,
+                                                     small, folder_ids, done)))
+        # Backpressure on the uploads
+        while len(uploads) > depth:
+            wait_upload()
+
+    def wait_upload():
+        filedata, upload = uploads.popleft()
+        try:
+            upload.result()
+        except pcloud_handler.PcloudError as exc:
+            photo_failed(filedata, exc)
+            failed.append(filedata)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ProcessPoolExecutor(max_workers=resize_workers) as resize_pool, \
+            ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+        for filedata in files:
+            app.logger.debug("Working on file {}".format(filedata["name"]))
+            done = Ingest.steps(JOB, filedata["fileid"])
+            if needs_content(done):
+                derivatives = submit_derivatives(download_pool, resize_pool, pcloud, filedata)
+            else:
+                derivatives = Future()
+                derivatives.set_result((None, None, None))
+            resized.append((filedata, done, derivatives))
+            # Backpressure on downloads and resizing
+            if len(resized) >= depth:
+                register_next()
+        while resized:
+            register_next()
+        while uploads:
+            wait_upload()
+    return len(failed)
+
+
 def single_photo_handler(nid):
     """
     This function accepts a node ID and creates the medium and small size pictures for the photo associated with this
-    node.
+    node. When the function runs as a task, progress is reported in the job meta data.
 
     :param nid: Node ID for which medium and small picture need to be created.
-    :return:
+    :return: Filename of the picture, or None if the picture is not found.
     """
-    # Get directory names
-    original_dirname = app.config["ORIGINAL_FOLDER"]
-    medium_dirname = app.config["MEDIUM_FOLDER"]
-    small_dirname = app.config["SMALL_FOLDER"]
     # Connect to pcloud and get directory structure
+    report_progress(0, "connect")
     pcloud = pcloud_handler.PcloudHandler()
-    public_cloud_id = pcloud.get_public_cloud_id()
-    # Get folders from Public Folder
-    subdirs, _ = pcloud.folder_contents(public_cloud_id)
-    original_folderid = subdirs[original_dirname[:-1]]["folderid"]
-    medium_folderid = subdirs[medium_dirname[:-1]]["folderid"]
-    small_folderid = subdirs[small_dirname[:-1]]["folderid"]
+    folder_ids = get_folder_ids(pcloud)
     file = ds.get_file_from_nid(nid)
-    _, files = pcloud.folder_contents(original_folderid)
-    filedata = files[file]
-    # Get file contents and convert to an image - also required to get exif for date and time of picture taken.
+    filedata = pcloud.find_file(folder_ids["original"], file)
+    if filedata is None:
+        app.logger.error("File {} for node {} not found in original folder.".format(file, nid))
+        pcloud.close_connection()
+        report_progress(100, "not found")
+        return None
+    # Get file contents and convert to an image.
+    report_progress(20, "download")
     content = pcloud.get_content(filedata)
     app.logger.debug("File {} length: {} (expected: {})".format(file, len(content), filedata["size"]))
-    parser = ImageFile.Parser()
-    parser.feed(content)
-    img = parser.close()
-    # Get exif information from picture
-    exif = get_labeled_exif(file, img)
-    # Create medium image
-    medium_img = to_medium(img)
-    if isinstance(exif, dict):
-        try:
-            medium_img = rotate_image(medium_img, exif["Orientation"])
-        except KeyError:
-            app.logger.info("{} no Orientation in exif data".format(file))
-    medium_ffn = os.path.join(os.getenv('LOGDIR'), file)
-    medium_img.save(medium_ffn)
-    res = pcloud.upload_file(file, medium_ffn, medium_folderid)
-    app.logger.info("File {} medium format loaded, result: {}".format(file, res["result"]))
-    os.remove(medium_ffn)
-    # Create small image
-    small_img = to_small(medium_img)
-    small_ffn = os.path.join(os.getenv('LOGDIR'), file)
-    small_img.save(small_ffn)
-    res = pcloud.upload_file(file, small_ffn, small_folderid)
-    app.logger.info("File {} small format loaded, result: {}".format(file, res["result"]))
-    os.remove(small_ffn)
+    report_progress(50, "resize")
+    _, medium, small = make_derivatives(file, content)
+    report_progress(70, "upload medium")
+    upload_image(pcloud, file, medium, folder_ids["medium"], "medium")
+    report_progress(85, "upload small")
+    upload_image(pcloud, file, small, folder_ids["small"], "small")
     pcloud.close_connection()
-    return
+    report_progress(100, "done")
+    return file
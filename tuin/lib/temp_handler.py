@@ -3,17 +3,20 @@ This script captures all pictures ready for publishing, move each picture to ori
 small version of the picture. The picture is added as a 'photo' node to the database, including indication for 'new'
 picture.
 """
-import os
+import io
 from datetime import datetime
 from dateutil import tz
 from flask import current_app
 from pathlib import Path
 from tuin.lib import pcloud_handler
-from tuin.lib.db_model import Node, Photo, Content
+from tuin.lib.db_model import Node, Photo, Content, Ingest, unit_of_work
 from PIL import ImageFile
 from PIL.ExifTags import TAGS
 from PIL.Image import LANCZOS
 
+# Job name in the ingestion ledger.
+JOB = "temp_handler"
+
 
 def create_node(filename, orig, created_dt):
     """
@@ -25,40 +28,42 @@ def create_node(filename, orig, created_dt):
     :param created_dt: Picture (or File) creation Datetime object.
     :return:
     """
-    # Check if photo already exist.
-    node_id = Photo.get_node_id(filename)
-    if node_id:
-        current_app.logger.warning("Photo {} from file {} exists already, refreshed.".format(filename, orig))
-        params = dict(
-            node_id=node_id,
-            filename=filename,
-            orig_filename=orig,
-            created=int(created_dt.timestamp()),
-            fresh=1
-        )
-        Photo.edit(**params)
-    else:
-        # New photo, create Node record.
-        current_app.logger.info("Photo {} from file {} created.".format(filename, orig))
-        params = dict(
-            type='photo',
-        )
-        node_id = Node.add(**params)
-        params = dict(
-            node_id=node_id,
-            filename=filename,
-            orig_filename=orig,
-            created=int(created_dt.timestamp()),
-            fresh=1
-        )
-        Photo.add(**params)
-        params = dict(
-            node_id=node_id,
-            title="Nieuwe Foto",
-            body=""
-        )
-        Content.update(**params)
-    Node.set_created(node_id)
+    # Node, photo and content records are committed in one transaction.
+    with unit_of_work():
+        # Check if photo already exist.
+        node_id = Photo.get_node_id(filename)
+        if node_id:
+            current_app.logger.warning("Photo {} from file {} exists already, refreshed.".format(filename, orig))
+            params = dict(
+                node_id=node_id,
+                filename=filename,
+                orig_filename=orig,
+                created=int(created_dt.timestamp()),
+                fresh=1
+            )
+            Photo.edit(**params)
+        else:
+            # New photo, create Node record.
+            current_app.logger.info("Photo {} from file {} created.".format(filename, orig))
+            params = dict(
+                type='photo',
+            )
+            node_id = Node.add(**params)
+            params = dict(
+                node_id=node_id,
+                filename=filename,
+                orig_filename=orig,
+                created=int(created_dt.timestamp()),
+                fresh=1
+            )
+            Photo.add(**params)
+            params = dict(
+                node_id=node_id,
+                title="Nieuwe Foto",
+                body=""
+            )
+            Content.update(**params)
+        Node.set_created(node_id)
     return
 
 
@@ -213,6 +218,31 @@ def to_small(image):
     return small_image
 
 
+def to_image(content):
+    """
+    This method decodes the picture contents into an image.
+
+    :param content: (binary) contents of the picture.
+    :return: PIL Image object.
+    """
+    parser = ImageFile.Parser()
+    parser.feed(content)
+    return parser.close()
+
+
+def to_buffer(image):
+    """
+    This method encodes the image as jpeg in memory, for upload without temporary file.
+
+    :param image: PIL Image object to be encoded.
+    :return: BytesIO object with the jpeg, positioned at the start.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    buffer.seek(0)
+    return buffer
+
+
 def photo_handler():
     """
     Main function for photo handling.
@@ -224,6 +254,7 @@ def photo_handler():
     original_dirname = current_app.config["ORIGINAL_FOLDER"]
     medium_dirname = current_app.config["MEDIUM_FOLDER"]
     small_dirname = current_app.config["SMALL_FOLDER"]
+    Ingest.init_table()
     # Connect to pcloud and get directory structure
     pcloud = pcloud_handler.PcloudHandler()
     public_cloud_id = pcloud.get_public_cloud_id()
@@ -246,34 +277,37 @@ def photo_handler():
     current_app.logger.info("{} files ready for processing".format(len(files)))
     for filedata in files:
         file = filedata["name"]
-        # Get file contents and convert to an image - also required to get exif for date and time of picture taken.
-        content = pcloud.get_content(filedata)
-        current_app.logger.debug("File {} length: {} (expected: {})".format(file, len(content), filedata["size"]))
-        parser = ImageFile.Parser()
-        parser.feed(content)
-        img = parser.close()
-        # Get exif information from picture
-        exif = get_labeled_exif(file, img)
         fn = file
-        # Create medium image
-        medium_img = to_medium(img)
-        if isinstance(exif, dict):
-            try:
-                medium_img = rotate_image(medium_img, exif["Orientation"])
-            except KeyError:
-                current_app.logger.info("{} ({}) no Orientation in exif data".format(file, fn))
-        medium_ffn = os.path.join(os.getenv('LOGDIR'), fn)
-        medium_img.save(medium_ffn)
-        res = pcloud.upload_file(fn, medium_ffn, medium_folderid)
-        current_app.logger.info("File {} medium format loaded, result: {}".format(fn, res["result"]))
-        os.remove(medium_ffn)
+        # Medium image may be loaded in an earlier run that stopped before the small image was loaded. Then the small
+        # image is created from the medium image on pcloud, the original picture is not downloaded and decoded.
+        done = Ingest.steps(JOB, filedata["fileid"])
+        medium_data = pcloud.find_file(medium_folderid, fn) if "medium" in done else None
+        if medium_data:
+            current_app.logger.info("File {} medium format loaded in earlier run".format(fn))
+            medium_img = to_image(pcloud.get_content(medium_data))
+        else:
+            # Get file contents and convert to an image - also required to get exif for date and time of picture taken.
+            content = pcloud.get_content(filedata)
+            current_app.logger.debug("File {} length: {} (expected: {})".format(file, len(content), filedata["size"]))
+            img = to_image(content)
+            # Get exif information from picture
+            exif = get_labeled_exif(file, img)
+            # Create medium image
+            medium_img = to_medium(img)
+            if isinstance(exif, dict):
+                try:
+                    medium_img = rotate_image(medium_img, exif["Orientation"])
+                except KeyError:
+                    current_app.logger.info("{} ({}) no Orientation in exif data".format(file, fn))
+            res = pcloud.upload_content(fn, to_buffer(medium_img), medium_folderid)
+            current_app.logger.info("File {} medium format loaded, result: {}".format(fn, res["result"]))
+            if "medium" not in done:
+                Ingest.add(JOB, filedata, "medium")
         # Create small image
         small_img = to_small(medium_img)
-        small_ffn = os.path.join(os.getenv('LOGDIR'), fn)
-        small_img.save(small_ffn)
-        res = pcloud.upload_file(fn, small_ffn, small_folderid)
+        res = pcloud.upload_content(fn, to_buffer(small_img), small_folderid)
         current_app.logger.info("File {} small format loaded, result: {}".format(fn, res["result"]))
-        os.remove(small_ffn)
+        Ingest.finish(JOB, filedata["fileid"])
     pcloud.close_connection()
     nr_files = len(files)
     current_app.logger.info("{} pictures have been processed.".format(nr_files))
@@ -1,11 +1,53 @@
+import hashlib
+import json
+import time
 import tuin.lib.db_model as ds
-from flask import render_template, flash, redirect, url_for, request
+from datetime import datetime
+from flask import render_template, flash, redirect, url_for, request, jsonify, make_response, session
 from flask_login import login_required, login_user, logout_user, current_user
 from .forms import *
 from . import main
+from pathlib import Path
 from tuin.lib.db_model import *
-from tuin.lib import my_env
-from tuin.lib import photo_handler
+from tuin.lib import cache_handler, my_env
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from werkzeug.http import is_resource_modified
+
+# Last change of the templates, so that the ETags change when the application is deployed.
+TEMPLATES_STAMP = int(max(path.stat().st_mtime for path in (Path(__file__).parents[1] / "templates").glob("*.html")))
+
+
+def conditional(versions, render):
+    """
+    This method answers a conditional GET with 304 Not Modified before the page is rendered. The ETag is calculated from
+    the version stamps for the page, the number of new photos, the user, the request and the CSRF token time window.
+    Last-Modified is the time of the last change. Pages are revalidated on each request. If the cache is not available
+    or if messages are flashed, then the page is rendered without validators.
+
+    :param versions: Names of the version stamps for the page.
+    :param render: Function that renders the page.
+    :return: Response
+    """
+    res = cache_handler.stamps(versions + ["nfc"])
+    if res is None or session.get("_flashes"):
+        return make_response(render())
+    stamps, modified = res
+    # The CSRF token in the search form expires, a page is reused for half of the token time limit.
+    window = (current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600) // 2
+    window_start = int(time.time()) // window * window
+    validators = [stamps, ds.count_nf(), current_user.get_id(), request.full_path, window_start, TEMPLATES_STAMP]
+    etag = hashlib.sha1(json.dumps(validators).encode()).hexdigest()
+    last_modified = datetime.utcfromtimestamp(max(modified, window_start))
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = make_response(render())
+    else:
+        resp = current_app.response_class(status=304)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
 
 
 @main.route('/login', methods=['GET', 'POST'])
@@ -45,73 +87,129 @@ def pwd_update():
 
 
 @main.route('/')
-@main.route('/index/<page>')
+@main.route('/index')
 @login_required
-def index(page=1):
-    params = dict(
-        nodes=ds.get_pics().paginate(int(page), current_app.config['PICS_PER_PAGE'], False),
-        searchForm=Search(),
-        title="Overzicht",
-        page=page,
-        folders=my_env.get_pic_folders(),
-        nfc=ds.count_nf()
-    )
-    return render_template("pic_matrix.html", **params)
+def index():
+    # Keyset pagination: the page after cursor 'after' (older pictures) or before cursor 'before' (newer pictures).
+    before = request.args.get('before')
+    cursor = before or request.args.get('after')
+
+    def render():
+        params = dict(
+            nodes=ds.get_pics_page(cursor, bool(before), current_app.config['PICS_PER_PAGE']),
+            title="Overzicht",
+            total=ds.count_pics(),
+            folders=my_env.get_pic_folders()
+        )
+        return render_template("pic_matrix_content.html", **params)
+
+    def render_page():
+        key = "{d}:{c}".format(d="before" if before else "after", c=cursor or "")
+        params = dict(
+            content=cache_handler.fragment("pics", key, ["pics"], render),
+            searchForm=Search(),
+            nfc=ds.count_nf()
+        )
+        return render_template("pic_matrix.html", **params)
+    return conditional(["pics"], render_page)
+
+
+@main.route('/index/<int:page>')
+@login_required
+def index_page(page):
+    """
+    Method to redirect the page number URLs from before the keyset pagination to the picture overview.
+
+    :param page: Page number, not used.
+    :return:
+    """
+    return redirect(url_for('main.index'), code=301)
 
 
 @main.route('/archive')
 @main.route('/archive/<page>')
 @login_required
 def archive(page=1):
-    items_per_page = current_app.config["ITEMS_PER_PAGE"]
-    archlist = ds.get_archive()
-    start = (int(page) - 1) * items_per_page
-    end = int(page) * items_per_page
-    max_page = ((len(archlist) - 1) // items_per_page) + 1
-    params = dict(
-        archlist=archlist[start:end],
-        searchForm=Search(),
-        page=page,
-        max_page=max_page
-    )
-    return render_template("archive.html", **params)
+    def render():
+        items_per_page = current_app.config["ITEMS_PER_PAGE"]
+        archlist = ds.get_archive().paginate(int(page), items_per_page, False)
+        params = dict(
+            archlist=archlist.items,
+            page=page,
+            max_page=max(archlist.pages, 1)
+        )
+        return render_template("archive_content.html", **params)
+
+    def render_page():
+        params = dict(
+            content=cache_handler.fragment("archive", page, ["archive"], render),
+            searchForm=Search()
+        )
+        return render_template("archive.html", **params)
+    return conditional(["archive"], render_page)
 
 
 @main.route('/monthlist/<ym>')
 @main.route('/monthlist/<ym>/<page>')
 @login_required
 def monthlist(ym, page=1):
-    nodes_per_page = current_app.config["NODES_PER_PAGE"]
-    nodes = ds.get_nodes_for_month(ym)
-    start = (int(page) - 1) * nodes_per_page
-    end = int(page) * nodes_per_page
-    max_page = ((len(nodes) - 1) // nodes_per_page) + 1
-    params = dict(
-        ym=ym,
-        title=my_env.monthdisp(ym),
-        nodes=nodes[start:end],
-        page=page,
-        max_page=max_page,
-        searchForm=Search(),
-        folders=my_env.get_pic_folders()
-    )
-    return render_template("node_list.html", **params)
+    def render():
+        nodes_per_page = current_app.config["NODES_PER_PAGE"]
+        try:
+            nodes = ds.get_nodes_for_month(ym).paginate(int(page), nodes_per_page, False)
+        except ValueError:
+            # Not a month or not a page number, the list is empty.
+            current_app.logger.info("Month {ym} page {p} not found".format(ym=ym, p=page))
+            items, pages, title = [], 1, ym
+        else:
+            items, pages, title = nodes.items, nodes.pages, my_env.monthdisp(ym)
+        params = dict(
+            ym=ym,
+            title=title,
+            nodes=items,
+            page=page,
+            max_page=max(pages, 1),
+            searchForm=Search(),
+            folders=my_env.get_pic_folders()
+        )
+        return render_template("node_list.html", **params)
+    return conditional(["nodes"], render)
 
 
 @main.route('/node/<id>')
 @login_required
 def node(id):
-    node_obj = ds.get_node_attribs(id)
-    bc = ds.get_breadcrumb(id)
-    params = dict(
-        node=node_obj,
-        breadcrumb=bc,
-        searchForm=Search(),
-        folders=my_env.get_pic_folders(),
-        nfc=ds.count_nf()
-    )
+    if Node.query.filter_by(id=id).with_entities(Node.id).scalar() is None:
+        msg = "Node ID {nid} not found.".format(nid=id)
+        current_app.logger.error(msg)
+        flash(msg, "error")
+        return redirect(url_for('main.index'))
+    # Register history first: without Redis the view is committed, which expires the loaded nodes.
     ds.History.add(id)
-    return render_template('node.html', **params)
+    nfc = ds.count_nf()
+
+    def render():
+        node_obj = ds.get_node_attribs(id)
+        params = dict(
+            node=node_obj,
+            breadcrumb=ds.get_breadcrumb(id) if node_obj.type == "book" else [],
+            folders=my_env.get_pic_folders(),
+            nfc=nfc
+        )
+        return [render_template("node_content.html", **params), render_template("node_actions.html", **params)]
+    # Breadcrumb and children of a book are labelled with titles from the book tree.
+    versions = ["node:{}".format(id), "tree"]
+
+    def render_page():
+        content, actions = cache_handler.fragment("node", "{}:{}".format(id, nfc), versions, render)
+        params = dict(
+            content=content,
+            actions=actions,
+            searchForm=Search(),
+            job_id=request.args.get('job')
+        )
+        return render_template('node.html', **params)
+    return conditional(versions, render_page)
 
 
 @main.route('/loadpictures')
@@ -195,13 +293,15 @@ def post_add(node_id=None, book_id=None):
             params["type"] = "book"
         elif not node_id:
             params["type"] = "blog"
-        if node_id:
-            Node.edit(node_id)
-        else:
-            node_id = Node.add(**params)
-        params = dict(node_id=node_id, title=title, body=body)
-        Content.update(**params)
-        ds.update_taxonomy_for_node(node_id, plaats + planten)
+        # Node, content and taxonomy are committed in one transaction.
+        with ds.unit_of_work():
+            if node_id:
+                Node.edit(node_id)
+            else:
+                node_id = Node.add(**params)
+            params = dict(node_id=node_id, title=title, body=body)
+            Content.update(**params)
+            ds.update_taxonomy_for_node(node_id, plaats + planten)
         return redirect(url_for('main.node', id=node_id))
 
 
@@ -251,73 +351,107 @@ def post_edit(node_id):
 @login_required
 def reloadpicture(nid):
     """
-    Method to reload medium and small image of a picture.
+    Method to reload medium and small image of a picture. The reload runs as a task, the node page polls the job
+    status.
 
     :param nid: Node ID for the picture to be reloaded.
     :return:
     """
-    filename = photo_handler.single_photo_handler(nid)
-    flash("{} is opnieuw geladen".format(filename))
-    return redirect(url_for('main.node', id=nid))
+    job = current_app.task_queue.enqueue('tuin.lib.photo_handler.single_photo_handler', nid)
+    flash("Foto herladen gestart...", "info")
+    return redirect(url_for('main.node', id=nid, job=job.get_id()))
+
+
+@main.route('/job/<job_id>')
+@login_required
+def job_status(job_id):
+    """
+    Method to return the status of a task, for polling.
+
+    :param job_id: ID of the job.
+    :return: json with status, progress, step and result of the job.
+    """
+    try:
+        job = Job.fetch(job_id, connection=current_app.redis)
+    except NoSuchJobError:
+        return jsonify(status="unknown"), 404
+    params = dict(
+        status=job.get_status(),
+        progress=job.meta.get('progress', 0),
+        step=job.meta.get('step'),
+        result=job.result
+    )
+    return jsonify(**params)
+
+
+@main.route('/cache/stats')
+@login_required
+def cache_stats():
+    """
+    Method to return the hit and miss counters of the fragment cache.
+
+    :return: json with fragment name as key and hit and miss counts as value.
+    """
+    return jsonify(cache_handler.stats())
 
 
 @main.route('/taxonomy/<id>')
 @main.route('/taxonomy/<id>/<page>')
 @login_required
 def taxonomy(id, page=1):
-    items_per_page = current_app.config["ITEMS_PER_PAGE"]
-    term = Term.query.filter_by(id=id).one()
-    start = (int(page) - 1) * items_per_page
-    end = int(page) * items_per_page
-    nodes = [node for node in term.nodes]
-    sel_nodes = sorted(nodes, key=lambda node: node.created, reverse=True)
-    max_page = ((len(sel_nodes) - 1) // items_per_page) + 1
-    params = dict(
-        term_id=id,
-        title=term.name,
-        nodes=sel_nodes[start:end],
-        page=page,
-        max_page=max_page,
-        searchForm=Search(),
-        folders=my_env.get_pic_folders()
-    )
-    return render_template("node_list.html", **params)
+    def render():
+        items_per_page = current_app.config["ITEMS_PER_PAGE"]
+        term = Term.query.filter_by(id=id).one()
+        sel_nodes = ds.get_nodes_for_term(id).paginate(int(page), items_per_page, False)
+        params = dict(
+            term_id=id,
+            title=term.name,
+            nodes=sel_nodes.items,
+            page=page,
+            max_page=max(sel_nodes.pages, 1),
+            searchForm=Search(),
+            folders=my_env.get_pic_folders()
+        )
+        return render_template("node_list.html", **params)
+    return conditional(["term:{}".format(id), "nodes"], render)
 
 
 @main.route('/taxpics/<id>')
 @main.route('/taxpics/<id>/<page>')
 @login_required
 def taxpics(id, page=1):
-    pics_per_page = current_app.config["PICS_PER_PAGE"]
-    term = Term.query.filter_by(id=id).one()
-    start = (int(page) - 1) * pics_per_page
-    end = int(page) * pics_per_page
-    nodes = [node for node in term.nodes if (node.type == "photo" or node.type == "lophoto")]
-    sel_nodes = sorted(nodes, key=lambda node: node.created, reverse=True)
-    max_page = ((len(sel_nodes) - 1) // pics_per_page) + 1
-    params = dict(
-        term_id=id,
-        title=term.name,
-        nodes=sel_nodes[start:end],
-        page=page,
-        max_page=max_page,
-        searchForm=Search(),
-        folders=my_env.get_pic_folders()
-    )
-    return render_template("taxpics.html", **params)
+    def render():
+        pics_per_page = current_app.config["PICS_PER_PAGE"]
+        term = Term.query.filter_by(id=id).one()
+        sel_nodes = ds.get_nodes_for_term(id, profile="pics", pics=True).paginate(int(page), pics_per_page, False)
+        params = dict(
+            term_id=id,
+            title=term.name,
+            nodes=sel_nodes.items,
+            page=page,
+            max_page=max(sel_nodes.pages, 1),
+            folders=my_env.get_pic_folders()
+        )
+        return render_template("taxpics_content.html", **params)
+    versions = ["term:{}".format(id), "pics"]
+
+    def render_page():
+        params = dict(
+            content=cache_handler.fragment("taxpics", "{}:{}".format(id, page), versions, render),
+            searchForm=Search()
+        )
+        return render_template("taxpics.html", **params)
+    return conditional(versions, render_page)
 
 
 @main.route("/timeline/<term_id>/<datestamp>")
 @login_required
 def timeline(term_id, datestamp):
     # Get node selected
-    node = Node.query.filter_by(created=datestamp).one()
-    # Then find term and get node pictures related to the term and in reverse created order (youngest first)
+    node = Node.query.options(*ds.LOADER_PROFILES["list"]).filter_by(created=datestamp).one()
+    # Then find term and the node pictures related to the term just before and after the node (youngest first)
     term = Term.query.filter_by(id=term_id).one()
-    nodes = [node for node in term.nodes if (node.type == "photo" or node.type == "lophoto")]
-    sel_nodes = sorted(nodes, key=lambda node: node.created, reverse=True)
-    # Find index of the requested node
-    pos = sel_nodes.index(node)
+    prev_node, next_node = ds.get_term_neighbours(term_id, node.created)
     params = dict(
         term_id=term_id,
         title=term.name,
@@ -325,10 +459,10 @@ def timeline(term_id, datestamp):
         searchForm=Search(),
         folders=my_env.get_pic_folders()
     )
-    if pos > 0:
-        params["prev_node"] = sel_nodes[pos - 1]
-    if len(sel_nodes) > (pos + 1):
-        params["next_node"] = sel_nodes[pos + 1]
+    if prev_node:
+        params["prev_node"] = prev_node
+    if next_node:
+        params["next_node"] = next_node
     return render_template("timeline.html", **params)
 
 
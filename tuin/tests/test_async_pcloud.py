@@ -0,0 +1,122 @@
+"""
+This procedure will test the asyncio pcloud handler against a local stub server that mimics the pcloud json API.
+"""
+
+import asyncio
+import unittest
+
+from aiohttp import web
+from tuin.lib.async_pcloud_handler import AsyncPcloudHandler
+
+CONTENT = bytes(range(256)) * 1024
+
+
+class PcloudStub:
+    """
+    Stub for the pcloud API. Folder 1 has a subfolder 2 and file 11. Requests are delayed, to measure the number of
+    requests in flight.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploads = {}
+        self.port = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls.append((method, dict(request.query)))
+        if method != "userinfo" and request.query.get("auth") != "token":
+            return web.json_response(dict(result=1000, error="Log in required."))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        if method == "userinfo":
+            res = dict(result=0, auth="token", usedquota=1, quota=10)
+        elif method == "listfolder":
+            contents = [dict(name="sub", isfolder=True, folderid=2),
+                        dict(name="file.jpg", isfolder=False, fileid=11, size=len(CONTENT))]
+            res = dict(result=0, metadata=dict(folderid=1, contents=contents))
+        elif method == "getfilelink":
+            res = dict(result=0, hosts=["127.0.0.1:{}".format(self.port)], path="/dl/file.jpg")
+        elif method == "uploadfile":
+            data = await request.post()
+            for name, field in data.items():
+                self.uploads[name] = field.file.read()
+            res = dict(result=0, metadata=[dict(name=name) for name in data])
+        elif method == "logout":
+            res = dict(result=0, auth_deleted=True)
+        else:
+            res = dict(result=0, metadata=dict(fileid=int(request.query["fileid"])))
+        return web.json_response(res)
+
+    async def download(self, request):
+        body = CONTENT
+        status = 200
+        if "Range" in request.headers:
+            end = int(request.headers["Range"].split("-")[1])
+            body = CONTENT[:end + 1]
+            status = 206
+        return web.Response(body=body, status=status)
+
+
+class TestAsyncPcloud(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stub = PcloudStub()
+        app = web.Application()
+        app.router.add_get("/dl/file.jpg", self.stub.download)
+        app.router.add_route("*", "/{method}", self.stub.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.stub.port = self.runner.addresses[0][1]
+        self.url_base = "http://127.0.0.1:{}/".format(self.stub.port)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def run_with_handler(self, coro_func, concurrency=4):
+        async def run():
+            async with AsyncPcloudHandler(concurrency=concurrency, url_base=self.url_base) as pcloud:
+                return await coro_func(pcloud)
+        return self.loop.run_until_complete(run())
+
+    def test_folder_contents(self):
+        subdirs, files = self.run_with_handler(lambda pcloud: pcloud.folder_contents(1))
+        self.assertEqual(subdirs["sub"]["folderid"], 2)
+        self.assertEqual(files["file.jpg"]["fileid"], 11)
+        self.assertEqual([call[0] for call in self.stub.calls], ["userinfo", "listfolder", "logout"])
+
+    def test_get_content(self):
+        file = dict(name="file.jpg", fileid=11)
+        content = self.run_with_handler(lambda pcloud: pcloud.get_content(file))
+        self.assertEqual(content, CONTENT)
+        header = self.run_with_handler(lambda pcloud: pcloud.get_content(file, length=1000))
+        self.assertEqual(header, CONTENT[:1000])
+
+    def test_upload_move(self):
+        async def upload_move(pcloud):
+            await pcloud.upload_content("new.jpg", b"jpeg", 2)
+            return await pcloud.movefile(11, 2, "moved.jpg")
+        res = self.run_with_handler(upload_move)
+        self.assertEqual(self.stub.uploads["new.jpg"], b"jpeg")
+        self.assertEqual(res["metadata"]["fileid"], 11)
+        self.assertIn(("renamefile", dict(fileid="11", tofolderid="2", toname="moved.jpg", auth="token")),
+                      self.stub.calls)
+
+    def test_concurrency_limit(self):
+        async def copy_all(pcloud):
+            return await asyncio.gather(*[pcloud.copyfile(fileid, 2) for fileid in range(20)])
+        res = self.run_with_handler(copy_all, concurrency=5)
+        self.assertEqual(sorted(r["metadata"]["fileid"] for r in res), list(range(20)))
+        self.assertEqual(self.stub.max_in_flight, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+"""
+This procedure will test the cache in Redis on the routes, with fakeredis in place of Redis. Changes to the nodes must
+bump the version stamps of the cached fragments that show them, so that the fragments are rendered again.
+"""
+
+import unittest
+
+import fakeredis
+from tuin import create_app, db
+from tuin.lib import cache_handler, db_migrate
+from tuin.lib.db_model import *
+
+
+class TestConfig:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REDIS_URL = "redis://localhost:6379/15"
+    SECRET_KEY = "test"
+    WTF_CSRF_ENABLED = False
+    LOGIN_DISABLED = True
+    ITEMS_PER_PAGE = 10
+    NODES_PER_PAGE = 10
+    PICS_PER_PAGE = 10
+    PUBLIC_FOLDER = "https://public/"
+    SOURCE_FOLDER = "source/"
+    ORIGINAL_FOLDER = "original/"
+    MEDIUM_FOLDER = "medium/"
+    SMALL_FOLDER = "small/"
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment with fakeredis for the cache.
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+        db_migrate.upgrade()
+        for name in ["Plaats", "Planten"]:
+            db.session.add(Vocabulary(name=name))
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.photo_id = self.add_photo("Roos", "roos.jpg")
+        self.blog_id = Node.add(type="blog")
+        Content.update(node_id=self.blog_id, title="Snoeien", body="<p>In maart.</p>")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    @staticmethod
+    def add_photo(title, filename, fresh=0):
+        nid = Node.add(type="photo")
+        Photo.add(node_id=nid, filename=filename, created=int(time.time()), fresh=fresh)
+        Content.update(node_id=nid, title=title, body="")
+        return nid
+
+    @staticmethod
+    def versions(*names):
+        return cache_handler.stamps(names)[0]
+
+    def get_pages(self):
+        for url in ["/node/{}".format(self.photo_id), "/node/{}".format(self.blog_id), "/index", "/archive"]:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200, url)
+
+
+class TestCache(CacheTestCase):
+
+    def test_fragments(self):
+        self.get_pages()
+        self.assertEqual(cache_handler.stats(), dict(node=dict(hit=0, miss=2), pics=dict(hit=0, miss=1),
+                                                     archive=dict(hit=0, miss=1)))
+        self.get_pages()
+        self.assertEqual(cache_handler.stats(), dict(node=dict(hit=2, miss=2), pics=dict(hit=1, miss=1),
+                                                     archive=dict(hit=1, miss=1)))
+        # The stats are available on the route.
+        self.assertEqual(self.client.get("/cache/stats").get_json()["node"], dict(hit=2, miss=2))
+
+    def test_edit(self):
+        self.get_pages()
+        names = ["node:{}".format(self.photo_id), "node:{}".format(self.blog_id), "nodes", "pics", "archive", "tree"]
+        before = self.versions(*names)
+        # Edit of the photo title: the node, the node lists and the picture lists are rendered again.
+        resp = self.client.post("/post/edit/{}".format(self.photo_id), data=dict(title="Rode roos", body=""))
+        self.assertEqual(resp.status_code, 302)
+        after = self.versions(*names)
+        self.assertEqual([new > old for (old, new) in zip(before, after)], [True, False, True, True, False, False])
+        self.get_pages()
+        self.assertEqual(cache_handler.stats(), dict(node=dict(hit=1, miss=3), pics=dict(hit=0, miss=2),
+                                                     archive=dict(hit=1, miss=1)))
+        self.assertIn(b"Rode roos", self.client.get("/index").data)
+
+    def test_add(self):
+        self.get_pages()
+        before = self.versions("archive", "nodes", "pics")
+        resp = self.client.post("/post/add", data=dict(title="Zaaien", body="<p>In april.</p>"))
+        self.assertEqual(resp.status_code, 302)
+        # A new node counts in the archive and shows in the node lists, a blog is not in the picture lists.
+        after = self.versions("archive", "nodes", "pics")
+        self.assertEqual([new > old for (old, new) in zip(before, after)], [True, True, False])
+        self.get_pages()
+        self.assertEqual(cache_handler.stats()["archive"], dict(hit=0, miss=2))
+        self.assertEqual(cache_handler.stats()["pics"], dict(hit=1, miss=1))
+
+
+class TestConditional(CacheTestCase):
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=headers)
+
+    def test_etag(self):
+        url = "/node/{}".format(self.photo_id)
+        resp = self.get(url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+        self.assertIn("no-cache", resp.headers["Cache-Control"])
+        resp = self.get(url, **{"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        resp = self.get(url, **{"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, 304)
+        # The ETag is different for each page.
+        self.assertEqual(self.get("/node/{}".format(self.blog_id), **{"If-None-Match": etag}).status_code, 200)
+
+    def test_edit(self):
+        url = "/node/{}".format(self.photo_id)
+        etag = self.get(url).headers["ETag"]
+        self.client.post("/post/edit/{}".format(self.photo_id), data=dict(title="Rode roos", body=""))
+        resp = self.get(url, **{"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertIn(b"Rode roos", resp.data)
+        # Pages that do not show the node are not changed.
+        etag = self.get("/archive").headers["ETag"]
+        self.client.post("/post/edit/{}".format(self.blog_id), data=dict(title="Snoeien", body="<p>In april.</p>"))
+        self.assertEqual(self.get("/archive", **{"If-None-Match": etag}).status_code, 304)
+
+    def test_unknown_node(self):
+        # A node that does not exist is not rendered and the view is not registered.
+        resp = self.get("/node/9999")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.app.redis.llen(HISTORY_KEY), 0)
+        self.get("/node/{}".format(self.photo_id))
+        self.assertEqual(self.app.redis.llen(HISTORY_KEY), 1)
+
+
+class TestCounter(CacheTestCase):
+
+    def test_count_nf(self):
+        # The counter is calculated on the first use.
+        self.assertIsNone(cache_handler.get("nfc"))
+        self.assertEqual(count_nf(), 0)
+        self.assertEqual(cache_handler.get("nfc"), 0)
+        # New photos count up from zero, an edit of the node counts down.
+        first_id = self.add_photo("Nieuwe Foto", "tulp.jpg", fresh=1)
+        second_id = self.add_photo("Nieuwe Foto", "iris.jpg", fresh=1)
+        self.assertEqual(cache_handler.get("nfc"), 2)
+        Node.edit(first_id)
+        self.assertEqual(cache_handler.get("nfc"), 1)
+        Node.edit(first_id)
+        self.assertEqual(cache_handler.get("nfc"), 1)
+        Photo.edit(node_id=self.photo_id, fresh=1)
+        self.assertEqual(cache_handler.get("nfc"), 2)
+        Photo.edit(node_id=self.photo_id, fresh=1)
+        Photo.edit(node_id=second_id, fresh=0)
+        self.assertEqual(cache_handler.get("nfc"), 1)
+        self.assertEqual(count_nf(), Photo.query.filter_by(fresh=1).count())
+
+    def test_missing(self):
+        # A counter that is not in the cache is not created by a change, it is calculated on the next use.
+        Photo.edit(node_id=self.photo_id, fresh=1)
+        self.assertIsNone(cache_handler.get("nfc"))
+        self.assertIsNone(self.app.redis.get("tuin:nfc"))
+        self.assertEqual(count_nf(), 1)
+        # A counter below zero is wrong, it is removed.
+        cache_handler.put("nfc", 0)
+        cache_handler.incr("nfc", -1)
+        self.assertIsNone(cache_handler.get("nfc"))
+
+    def test_rollback(self):
+        self.assertEqual(count_nf(), 0)
+        with self.assertRaises(ZeroDivisionError):
+            with unit_of_work():
+                Photo.edit(node_id=self.photo_id, fresh=1)
+                1 / 0
+        self.assertEqual(cache_handler.get("nfc"), 0)
+
+    def test_reconcile(self):
+        cache_handler.put("nfc", 7)
+        self.assertEqual(count_nf(), 7)
+        self.assertEqual(count_nf_reconcile(), 0)
+        self.assertEqual(count_nf(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+This procedure will test the job status route that the node page polls, with fakeredis in place of Redis. Jobs run in
+the test process with a simple worker.
+"""
+
+import unittest
+
+import fakeredis
+import rq
+from tuin import create_app
+from tuin.lib import photo_handler
+
+
+class TestConfig:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REDIS_URL = "redis://localhost:6379/15"
+    SECRET_KEY = "test"
+    WTF_CSRF_ENABLED = False
+    LOGIN_DISABLED = True
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment with fakeredis for the task queue.
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.task_queue = rq.Queue("tuin-tasks", connection=self.app.redis)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app_ctx.pop()
+
+    def job_status(self, job_id, status_code=200):
+        resp = self.client.get("/job/{}".format(job_id))
+        self.assertEqual(resp.status_code, status_code)
+        return resp.get_json()
+
+    def work(self):
+        worker = rq.SimpleWorker([self.app.task_queue], connection=self.app.redis)
+        worker.work(burst=True)
+
+    def test_queued(self):
+        job = self.app.task_queue.enqueue("tuin.lib.photo_handler.report_progress", 50, "resize")
+        self.assertEqual(self.job_status(job.get_id()), dict(status="queued", progress=0, step=None, result=None))
+
+    def test_started(self):
+        job = self.app.task_queue.enqueue("tuin.lib.photo_handler.report_progress", 50, "resize")
+        job.set_status(rq.job.JobStatus.STARTED)
+        job.meta["progress"] = 20
+        job.meta["step"] = "download"
+        job.save_meta()
+        self.assertEqual(self.job_status(job.get_id()),
+                         dict(status="started", progress=20, step="download", result=None))
+
+    def test_finished(self):
+        # The progress is reported by the job in its meta data.
+        job = self.app.task_queue.enqueue("tuin.lib.photo_handler.report_progress", 50, "resize")
+        self.work()
+        self.assertEqual(self.job_status(job.get_id()),
+                         dict(status="finished", progress=50, step="resize", result=None))
+        job = self.app.task_queue.enqueue("tuin.lib.my_env.monthdisp", "2019-05")
+        self.work()
+        self.assertEqual(self.job_status(job.get_id()),
+                         dict(status="finished", progress=0, step=None, result="mei 2019"))
+
+    def test_failed(self):
+        job = self.app.task_queue.enqueue("tuin.lib.my_env.monthdisp", "2019-13")
+        self.work()
+        self.assertEqual(self.job_status(job.get_id())["status"], "failed")
+
+    def test_unknown(self):
+        self.assertEqual(self.job_status("no-such-job", 404), dict(status="unknown"))
+
+    def test_no_job(self):
+        # Outside a job the progress is not reported.
+        photo_handler.report_progress(50, "resize")
+
+
+if __name__ == "__main__":
+    unittest.main()
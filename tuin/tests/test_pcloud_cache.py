@@ -0,0 +1,109 @@
+"""
+This procedure will test the pcloud folder cache with fakeredis. The diff entries have the format of the pcloud diff
+method: event, diffid and the metadata of the file or folder after the event.
+"""
+
+import unittest
+
+import fakeredis
+from tuin.lib.pcloud_cache import FolderCache
+
+
+def folder(folderid, name, parentfolderid, contents=None):
+    metadata = dict(id="d{}".format(folderid), folderid=folderid, name=name, parentfolderid=parentfolderid,
+                    isfolder=True)
+    if contents is not None:
+        metadata["contents"] = contents
+    return metadata
+
+
+def file(fileid, name, parentfolderid, size=100):
+    return dict(id="f{}".format(fileid), fileid=fileid, name=name, parentfolderid=parentfolderid, isfolder=False,
+                size=size)
+
+
+def entry(diffid, event, metadata=None):
+    res = dict(diffid=diffid, event=event, time="Thu, 02 May 2019 10:00:00 +0000")
+    if metadata is not None:
+        res["metadata"] = metadata
+    return res
+
+
+class TestFolderCache(unittest.TestCase):
+
+    def setUp(self):
+        # Root folder 0 has folder Public (1) and file notes.txt (10). Public has picture a.jpg (11) and folder small
+        # (3), small is not cached.
+        self.cache = FolderCache(fakeredis.FakeStrictRedis())
+        self.cache.store_folder(folder(0, "/", None, [folder(1, "Public", 0), file(10, "notes.txt", 0)]))
+        self.cache.store_folder(folder(1, "Public", 0, [file(11, "a.jpg", 1), folder(3, "small", 1)]), "/Public")
+        self.cache.set_diffid(100)
+
+    def names(self, folderid):
+        return sorted(self.cache.folder(folderid))
+
+    def test_listing(self):
+        self.assertEqual(self.names(0), ["Public", "notes.txt"])
+        self.assertEqual(self.names(1), ["a.jpg", "small"])
+        self.assertIsNone(self.cache.folder(3))
+        self.assertEqual(self.cache.folderid("/Public"), 1)
+        self.assertIsNone(self.cache.folderid("/Private"))
+        self.assertEqual(self.cache.file(1, "a.jpg"), file(11, "a.jpg", 1))
+        self.assertIsNone(self.cache.file(1, "b.jpg"))
+        with self.assertRaises(KeyError):
+            self.cache.file(3, "a.jpg")
+        self.assertEqual(self.cache.diffid(), 100)
+
+    def test_files(self):
+        entries = [
+            entry(101, "createfile", file(12, "b.jpg", 1)),
+            # Rename
+            entry(102, "modifyfile", file(11, "c.jpg", 1, size=200)),
+            # Move to the root folder
+            entry(103, "modifyfile", file(12, "b.jpg", 0)),
+            entry(104, "deletefile", file(10, "notes.txt", 0)),
+            # Created in a folder that is not cached
+            entry(105, "createfile", file(13, "d.jpg", 3))
+        ]
+        self.assertEqual(self.cache.apply_diff(entries), 5)
+        self.assertEqual(self.names(0), ["Public", "b.jpg"])
+        self.assertEqual(self.names(1), ["c.jpg", "small"])
+        self.assertEqual(self.cache.file(1, "c.jpg")["size"], 200)
+        self.assertIsNone(self.cache.file(1, "a.jpg"))
+        self.assertEqual(self.cache.file(0, "b.jpg"), file(12, "b.jpg", 0))
+        self.assertIsNone(self.cache.file(0, "notes.txt"))
+        self.assertIsNone(self.cache.folder(3))
+
+    def test_folders(self):
+        entries = [
+            entry(101, "createfolder", folder(4, "medium", 1)),
+            # Rename of a cached folder keeps its contents.
+            entry(102, "modifyfolder", folder(1, "Openbaar", 0)),
+            entry(103, "deletefolder", folder(3, "small", 1)),
+            # Events that are not about files or folders are skipped.
+            entry(104, "modifyuserinfo"),
+            entry(105, "share", dict(sharerequestid=7))
+        ]
+        self.assertEqual(self.cache.apply_diff(entries), 3)
+        self.assertEqual(self.names(0), ["Openbaar", "notes.txt"])
+        self.assertEqual(self.names(1), ["a.jpg", "medium"])
+        # Delete of a folder removes its listing.
+        self.cache.apply_diff([entry(106, "deletefolder", folder(1, "Openbaar", 0))])
+        self.assertEqual(self.names(0), ["notes.txt"])
+        self.assertIsNone(self.cache.folder(1))
+        with self.assertRaises(KeyError):
+            self.cache.file(1, "a.jpg")
+
+    def test_reset(self):
+        # A reset event clears the cache, the events after the reset are applied on an empty cache.
+        entries = [entry(101, "createfile", file(12, "b.jpg", 1)), entry(102, "reset"),
+                   entry(103, "createfile", file(13, "c.jpg", 1))]
+        self.assertEqual(self.cache.apply_diff(entries), 3)
+        self.assertIsNone(self.cache.folder(0))
+        self.assertIsNone(self.cache.folder(1))
+        self.assertIsNone(self.cache.folderid("/Public"))
+        self.assertIsNone(self.cache.diffid())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+"""
+This procedure will test the request layer of the pcloud handler: retry with backoff, the typed errors and the circuit
+breaker. The requests session is replaced by a stub that returns the prepared responses.
+"""
+
+import os
+import unittest
+from unittest import mock
+
+import fakeredis
+import requests
+from tuin import create_app
+from tuin.lib import pcloud_handler
+from tuin.lib.pcloud_cache import FolderCache
+from tuin.lib.pcloud_handler import CircuitBreaker, PcloudAPIError, PcloudConnectionError, PcloudHTTPError, \
+    PcloudUnavailable
+
+USERINFO = dict(result=0, auth="token", usedquota=1, quota=10)
+
+
+class TestConfig:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REDIS_URL = "redis://localhost:6379/15"
+    SECRET_KEY = "test"
+
+
+class Response:
+
+    def __init__(self, status_code=200, res=None):
+        self.status_code = status_code
+        self.reason = "Status {}".format(status_code)
+        self.res = dict(result=0) if res is None else res
+
+    def json(self):
+        return self.res
+
+
+class SessionStub:
+    """
+    Stub for the requests session. Each request takes the next response, an exception in the responses is raised.
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.params = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url.rsplit("/", 1)[-1]))
+        self.params.append(kwargs.get("params"))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+
+class PcloudTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment, without backoff delays and with a circuit breaker for this test.
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        self.delays = []
+        patches = [
+            mock.patch.dict(os.environ, PCLOUD_HOME="https://pcloud/"),
+            mock.patch.object(pcloud_handler, "breaker", self.breaker),
+            mock.patch.object(pcloud_handler, "backoff", side_effect=self.backoff)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.app_ctx.pop()
+
+    def backoff(self, attempt):
+        self.delays.append(attempt)
+        return 0
+
+    def handler(self, *responses, retries=2, cache=False):
+        """
+        This method returns a handler that is connected with the stub. The responses follow the userinfo response.
+
+        :param responses: Responses for the requests after the connection.
+        :param retries: Number of retries for idempotent requests.
+        :param cache: True to use the folder cache.
+        :return: PcloudHandler object.
+        """
+        session = SessionStub(Response(res=USERINFO), *responses)
+        with mock.patch.object(pcloud_handler.requests, "Session", return_value=session):
+            pcloud = pcloud_handler.PcloudHandler(retries=retries, cache=cache)
+        self.assertEqual(pcloud.auth, "token")
+        return pcloud
+
+
+class TestPcloudHandler(PcloudTestCase):
+
+    def test_retry(self):
+        pcloud = self.handler(Response(502), requests.ConnectionError("reset"), Response(res=dict(result=0, x=1)))
+        self.assertEqual(pcloud._call("stat", "get file"), dict(result=0, x=1))
+        self.assertEqual(self.delays, [1, 2])
+        self.assertEqual(len(pcloud.session.calls), 4)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_retry_exhausted(self):
+        pcloud = self.handler(Response(503), Response(503), Response(503))
+        with self.assertRaises(PcloudHTTPError) as ctx:
+            pcloud._call("stat", "get file")
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertTrue(ctx.exception.retryable)
+        self.assertEqual(self.delays, [1, 2])
+        self.assertEqual(len(pcloud.session.calls), 4)
+
+    def test_not_idempotent(self):
+        # An upload is not repeated, pcloud may have stored the file.
+        pcloud = self.handler(Response(502))
+        with self.assertRaises(PcloudHTTPError):
+            pcloud._call("uploadfile", "upload file", files=dict(file=b"x"), idempotent=False)
+        self.assertEqual(pcloud.session.calls[-1], ("post", "uploadfile"))
+        self.assertEqual(self.delays, [])
+        self.assertEqual(len(pcloud.session.calls), 2)
+
+    def test_errors(self):
+        pcloud = self.handler(requests.Timeout("read timeout"), Response(404), Response(res=dict(result=2009)),
+                              Response(429), Response(res=dict(result=4000)), Response(res=dict(result=5000)),
+                              retries=0)
+        expected = [(PcloudConnectionError, True), (PcloudHTTPError, False), (PcloudAPIError, False),
+                    (PcloudHTTPError, True), (PcloudAPIError, True), (PcloudAPIError, True)]
+        for (error, retryable) in expected:
+            with self.assertRaises(error) as ctx:
+                pcloud._call("stat", "get file")
+            self.assertEqual(ctx.exception.retryable, retryable, error)
+        self.assertEqual(ctx.exception.result, 5000)
+        self.assertEqual(self.delays, [])
+
+    def test_no_retry_on_request_error(self):
+        # A request that pcloud does not accept is not retried.
+        pcloud = self.handler(Response(res=dict(result=2009)))
+        with self.assertRaises(PcloudAPIError):
+            pcloud._call("stat", "get file")
+        self.assertEqual(len(pcloud.session.calls), 2)
+
+    def test_breaker_opens(self):
+        pcloud = self.handler(Response(500), Response(500), Response(500), retries=2)
+        with self.assertRaises(PcloudHTTPError):
+            pcloud._call("stat", "get file")
+        # The circuit is open, pcloud is not called.
+        with self.assertRaises(PcloudUnavailable):
+            pcloud._call("stat", "get file")
+        self.assertEqual(len(pcloud.session.calls), 4)
+        # After the reset timeout a single trial call closes the circuit.
+        self.breaker.opened -= 60
+        pcloud.session.responses.append(Response())
+        pcloud._call("stat", "get file")
+        self.assertIsNone(self.breaker.opened)
+
+
+class TestFolderCacheSync(PcloudTestCase):
+    """
+    The folder cache of the handler is brought up to date with the pcloud diff. Folder 1 has file a.jpg (11).
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.cache = FolderCache(self.app.redis)
+        self.listing = dict(result=0, metadata=dict(folderid=1, name="Public", contents=[
+            dict(id="f11", fileid=11, name="a.jpg", parentfolderid=1, isfolder=False)]))
+
+    def test_sync(self):
+        self.cache.store_folder(self.listing["metadata"])
+        self.cache.set_diffid(100)
+        diff = dict(result=0, diffid=101, entries=[dict(diffid=101, event="createfile", metadata=dict(
+            id="f12", fileid=12, name="b.jpg", parentfolderid=1, isfolder=False))])
+        pcloud = self.handler(Response(res=diff), cache=True)
+        self.assertEqual(pcloud.find_file(1, "b.jpg")["fileid"], 12)
+        self.assertEqual(pcloud.find_file(1, "a.jpg")["fileid"], 11)
+        self.assertIsNone(pcloud.find_file(1, "c.jpg"))
+        # One diff call, the folder is not listed.
+        self.assertEqual(pcloud.session.calls[1:], [("get", "diff")])
+        self.assertEqual(pcloud.session.params[1]["diffid"], 100)
+        self.assertEqual(self.cache.diffid(), 101)
+
+    def test_reset(self):
+        # pcloud does not accept the diff ID anymore: the cache is cleared and starts from the current diff ID.
+        self.cache.store_folder(self.listing["metadata"])
+        self.cache.set_diffid(100)
+        pcloud = self.handler(Response(res=dict(result=2000, error="Invalid diffid.")),
+                              Response(res=dict(result=0, diffid=200, entries=[])), Response(res=self.listing),
+                              cache=True)
+        self.assertEqual(pcloud.find_file(1, "a.jpg")["fileid"], 11)
+        self.assertEqual(pcloud.find_file(1, "a.jpg")["fileid"], 11)
+        self.assertEqual(pcloud.session.calls[1:], [("get", "diff"), ("get", "diff"), ("get", "listfolder")])
+        self.assertEqual(pcloud.session.params[2]["last"], 0)
+        self.assertEqual(self.cache.diffid(), 200)
+        self.assertEqual(sorted(self.cache.folder(1)), ["a.jpg"])
+
+    def test_first_sync(self):
+        # An empty cache starts from the current diff ID.
+        pcloud = self.handler(Response(res=dict(result=0, diffid=200, entries=[])), Response(res=self.listing),
+                              cache=True)
+        self.assertEqual(pcloud.find_file(1, "a.jpg")["fileid"], 11)
+        self.assertEqual(pcloud.session.calls[1:], [("get", "diff"), ("get", "listfolder")])
+        self.assertEqual(self.cache.diffid(), 200)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    def open(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        with self.assertRaises(PcloudUnavailable):
+            self.breaker.check()
+
+    def test_closed(self):
+        self.breaker.failure()
+        self.breaker.check()
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.check()
+
+    def test_half_open(self):
+        self.open()
+        self.breaker.opened -= 60
+        # A single trial call is allowed through.
+        self.breaker.check()
+        with self.assertRaises(PcloudUnavailable):
+            self.breaker.check()
+        self.breaker.success()
+        self.breaker.check()
+        self.breaker.check()
+
+    def test_half_open_failure(self):
+        self.open()
+        self.breaker.opened -= 60
+        self.breaker.check()
+        # The trial call fails, the circuit opens again for the reset timeout.
+        self.breaker.failure()
+        with self.assertRaises(PcloudUnavailable):
+            self.breaker.check()
+        self.breaker.opened -= 60
+        self.breaker.check()
+
+    def test_half_open_lost(self):
+        # A trial call that does not report back is replaced after the reset timeout.
+        self.open()
+        self.breaker.opened -= 60
+        self.breaker.check()
+        self.breaker.probed -= 60
+        self.breaker.check()
+        with self.assertRaises(PcloudUnavailable):
+            self.breaker.check()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+This procedure will test the pipelined and the serial photo handler against a pcloud stub with pictures in memory. Both
+need to create the same nodes and upload the same derivatives, also when a download or an upload fails.
+"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+from tuin import db
+from tuin.lib import db_migrate, pcloud_handler, photo_handler
+from tuin.lib.db_model import Ingest, Photo
+
+# pcloud folder IDs
+PUBLIC = 1
+SOURCE = 2
+ORIGINAL = 3
+MEDIUM = 4
+SMALL = 5
+# Width, height and exif orientation of the pictures. Nikon (DSC) pictures get the date/time in the filename.
+PICTURES = [(1600, 1200, 1), (1200, 1600, 6), (2000, 1000, 8), (900, 700, 3), (640, 480, None)]
+
+
+def make_jpeg(width, height, orientation):
+    """
+    This function creates a jpeg picture in memory with the date/time it was taken and the orientation in exif.
+
+    :param width: Width of the picture.
+    :param height: Height of the picture.
+    :param orientation: Exif orientation, or None.
+    :return: Picture (jpeg bytes).
+    """
+    image = Image.new("RGB", (width, height), (200, 30, 30))
+    for x in range(0, width, 7):
+        for y in range(0, height, 50):
+            image.putpixel((x, y), (x % 255, y % 255, 90))
+    exif = Image.Exif()
+    exif[0x8769] = {0x9003: "2019:05:01 10:11:{:02d}".format(width % 60)}
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+class PcloudStub:
+    """
+    Stub for the PcloudHandler. The pictures are in the source folder. A download or an upload of a file can be set to
+    fail with a pcloud HTTP error.
+    """
+
+    def __init__(self, fail_download=None, fail_upload=None):
+        self.files = {}
+        for cnt, (width, height, orientation) in enumerate(PICTURES):
+            name = "DSC{:04d}.JPG".format(cnt) if cnt % 2 == 0 else "IMG_{:04d}.jpg".format(cnt)
+            content = make_jpeg(width, height, orientation)
+            self.files[name] = dict(name=name, fileid=100 + cnt, size=len(content), parentfolderid=SOURCE,
+                                    created="Thu, 02 May 2019 10:00:00 +0000", content=content)
+        self.fail_download = fail_download
+        self.fail_upload = fail_upload
+        self.moves = []
+        self.uploads = {}
+
+    def get_public_cloud_id(self):
+        return PUBLIC
+
+    def folder_contents(self, folderid):
+        if folderid == PUBLIC:
+            subdirs = dict(source=dict(folderid=SOURCE), original=dict(folderid=ORIGINAL),
+                           medium=dict(folderid=MEDIUM), small=dict(folderid=SMALL))
+            return subdirs, {}
+        return {}, {name: filedata for name, filedata in self.files.items() if filedata["parentfolderid"] == folderid}
+
+    def get_content(self, filedata):
+        if filedata["name"] == self.fail_download:
+            raise pcloud_handler.PcloudHTTPError("Download failed", 502)
+        return self.files[filedata["name"]]["content"]
+
+    def movefile(self, fileid, tofolderid, filename):
+        for filedata in self.files.values():
+            if filedata["fileid"] == fileid:
+                filedata["parentfolderid"] = tofolderid
+        self.moves.append((fileid, tofolderid, filename))
+        return dict(result=0)
+
+    def upload_content(self, filename, content, folderid):
+        if (filename, folderid) == self.fail_upload:
+            raise pcloud_handler.PcloudHTTPError("Upload failed", 502)
+        self.uploads[(filename, folderid)] = content.read()
+        return dict(result=0)
+
+    def close_connection(self):
+        return
+
+
+class TestPhotoHandler(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment, the worker threads use the application of the photo handler so the databases are in
+        # files.
+        self.app = photo_handler.app
+        self.config = dict(self.app.config)
+        self.dbfiles = []
+        self.app.config.update(SOURCE_FOLDER="source/", ORIGINAL_FOLDER="original/", MEDIUM_FOLDER="medium/",
+                               SMALL_FOLDER="small/",
+                               PHOTO_DOWNLOAD_WORKERS=2, PHOTO_RESIZE_WORKERS=2, PHOTO_UPLOAD_WORKERS=2,
+                               PHOTO_PIPELINE_DEPTH=2)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_ctx.pop()
+        self.app.config.clear()
+        self.app.config.update(self.config)
+        for dbfile in self.dbfiles:
+            os.remove(dbfile)
+
+    def run_handler(self, pipelined, pcloud):
+        """
+        This method runs the photo handler on a new database.
+
+        :param pipelined: True to run pipelined, False to run serial.
+        :param pcloud: PcloudStub object.
+        :return: Number of pictures processed, nodes, moves, uploads and pending ledger steps.
+        """
+        db.session.remove()
+        fd, dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.dbfiles.append(dbfile)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}".format(dbfile)
+        db.create_all()
+        db_migrate.upgrade()
+        with mock.patch.object(pcloud_handler, "PcloudHandler", return_value=pcloud):
+            nr_files = photo_handler.photo_handler(pipelined=pipelined)
+        nodes = [(photo.node_id, photo.filename, photo.orig_filename, photo.created)
+                 for photo in Photo.query.order_by(Photo.node_id)]
+        pending = sorted((filedata["fileid"], sorted(Ingest.steps(photo_handler.JOB, filedata["fileid"])))
+                         for filedata in Ingest.pending(photo_handler.JOB))
+        return nr_files, nodes, sorted(pcloud.moves), pcloud.uploads, pending
+
+    def test_pipelined(self):
+        serial = self.run_handler(False, PcloudStub())
+        pipelined = self.run_handler(True, PcloudStub())
+        self.assertEqual(serial, pipelined)
+        nr_files, nodes, moves, uploads, pending = pipelined
+        self.assertEqual(nr_files, len(PICTURES))
+        self.assertEqual(len(nodes), len(PICTURES))
+        self.assertEqual([filename for (_, filename, _, _) in nodes],
+                         ["DSC0000_20190501_101140.JPG", "IMG_0001.jpg", "DSC0002_20190501_101120.JPG",
+                          "IMG_0003.jpg", "DSC0004_20190501_101140.JPG"])
+        self.assertEqual(len(moves), len(PICTURES))
+        self.assertEqual(len(uploads), 2 * len(PICTURES))
+        self.assertEqual(pending, [])
+        # The portrait picture is rotated to landscape for orientation 6.
+        medium = Image.open(io.BytesIO(uploads[("IMG_0001.jpg", MEDIUM)]))
+        self.assertEqual(medium.size, (800, 600))
+        small = Image.open(io.BytesIO(uploads[("IMG_0001.jpg", SMALL)]))
+        self.assertEqual(small.size, (200, 150))
+
+    def test_pipelined_failure(self):
+        fail_download = "IMG_0001.jpg"
+        fail_upload = ("DSC0002_20190501_101120.JPG", SMALL)
+        serial = self.run_handler(False, PcloudStub(fail_download, fail_upload))
+        pipelined = self.run_handler(True, PcloudStub(fail_download, fail_upload))
+        self.assertEqual(serial, pipelined)
+        nr_files, nodes, moves, uploads, pending = pipelined
+        self.assertEqual(nr_files, len(PICTURES) - 2)
+        # The picture that is not downloaded has no node, the picture with the failed upload has its node.
+        self.assertEqual(len(nodes), len(PICTURES) - 1)
+        self.assertNotIn(("IMG_0001.jpg", MEDIUM), uploads)
+        self.assertIn(("DSC0002_20190501_101120.JPG", MEDIUM), uploads)
+        self.assertNotIn(fail_upload, uploads)
+        self.assertEqual(pending, [(102, ["downloaded", "medium", "moved", "node"])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,424 @@
+"""
+This procedure will test the number of queries that are required to show a page. The pages must use the loader profiles,
+so that the number of queries does not grow with the number of nodes on the page.
+The query plans of the queries in db_model are checked for table scans on the migrated schema.
+"""
+
+import unittest
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from tuin import create_app, db
+from tuin.lib import db_migrate
+from tuin.lib.db_model import *
+
+# Number of pictures, children and terms in the test database. These are more than the maximum number of queries, so a
+# lazy load per node would exceed the maximum.
+NR_NODES = 24
+# Maximum number of queries for a page.
+MAX_QUERIES = 10
+
+
+class TestConfig:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REDIS_URL = "redis://localhost:6379/15"
+    SECRET_KEY = "test"
+    WTF_CSRF_ENABLED = False
+    LOGIN_DISABLED = True
+    ITEMS_PER_PAGE = NR_NODES
+    NODES_PER_PAGE = NR_NODES
+    PICS_PER_PAGE = NR_NODES
+    PUBLIC_FOLDER = "https://public/"
+    SOURCE_FOLDER = "source/"
+    ORIGINAL_FOLDER = "original/"
+    MEDIUM_FOLDER = "medium/"
+    SMALL_FOLDER = "small/"
+
+
+class TestQueries(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+        db_migrate.upgrade()
+        self.client = self.app.test_client()
+        self.created = 1556700000
+        voc = Vocabulary(name="Planten")
+        db.session.add(voc)
+        db.session.commit()
+        self.term_ids = []
+        for cnt in range(NR_NODES):
+            term = Term(vocabulary_id=voc.id, name="Plant {}".format(cnt))
+            db.session.add(term)
+            db.session.commit()
+            self.term_ids.append(term.id)
+        self.book_id = self.add_node("book", "Tuin")
+        for cnt in range(NR_NODES):
+            child_id = self.add_node("book", "Pagina {}".format(cnt), parent_id=self.book_id)
+            self.add_node("book", "Sub {}".format(cnt), parent_id=child_id)
+        for cnt in range(NR_NODES):
+            nid = self.add_node("photo", "Foto {}".format(cnt))
+            db.session.add(Photo(node_id=nid, filename="foto{}.jpg".format(cnt), created=self.created, fresh=0))
+            db.session.commit()
+            for term_id in self.term_ids:
+                Taxonomy.add(node_id=nid, term_id=term_id)
+        for term_id in self.term_ids:
+            Taxonomy.add(node_id=self.book_id, term_id=term_id)
+        self.queries = []
+        event.listen(db.engine, "before_cursor_execute", self.count_query)
+
+    def tearDown(self):
+        event.remove(db.engine, "before_cursor_execute", self.count_query)
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    def add_node(self, node_type, title, parent_id=-1):
+        self.created += 3600
+        nid = Node.add(type=node_type, parent_id=parent_id)
+        Node.query.filter_by(id=nid).update(dict(created=self.created))
+        Content.update(node_id=nid, title=title, body="Body {}".format(title))
+        return nid
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def assert_page_queries(self, url):
+        db.session.expire_all()
+        self.queries = []
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(self.queries), MAX_QUERIES, "{}: {}".format(url, "\n".join(self.queries)))
+
+    def test_index(self):
+        self.assert_page_queries("/")
+        cursor = get_pics_cursor(get_pics().all()[NR_NODES // 2])
+        self.assert_page_queries("/index?after={}".format(cursor))
+        self.assert_page_queries("/index?before={}".format(cursor))
+
+    def test_pics_page(self):
+        expected = [node.id for node in get_pics()]
+        # Forward with the next cursors, then back with the previous cursors.
+        pages = [get_pics_page(per_page=5)]
+        while pages[-1].next_cursor:
+            pages.append(get_pics_page(pages[-1].next_cursor, per_page=5))
+        self.assertEqual([node.id for page in pages for node in page.items], expected)
+        self.assertIsNone(pages[0].prev_cursor)
+        back = [pages[-1]]
+        while back[-1].prev_cursor:
+            back.append(get_pics_page(back[-1].prev_cursor, before=True, per_page=5))
+        self.assertEqual([[node.id for node in page.items] for page in reversed(back)],
+                         [[node.id for node in page.items] for page in pages])
+        self.assertEqual(count_pics(), NR_NODES)
+
+    def test_index_page(self):
+        # Page number URLs from before the keyset pagination redirect to the overview.
+        resp = self.client.get("/index/2")
+        self.assertEqual(resp.status_code, 301)
+        self.assertTrue(resp.headers["Location"].endswith("/index"))
+
+    def test_pics_cursor(self):
+        # Cursors that are not two integers within the SQLite range give the first page.
+        first = [node.id for node in get_pics_page(per_page=5).items]
+        for cursor in ["5", "99999999999999999999999-1", "1-99999999999999999999999", "a-1", "1-2-3", "-1-2"]:
+            self.assertIsNone(parse_pics_cursor(cursor), cursor)
+            self.assertEqual([node.id for node in get_pics_page(cursor, per_page=5).items], first, cursor)
+            resp = self.client.get("/index?after={}".format(cursor))
+            self.assertEqual(resp.status_code, 200, cursor)
+            resp = self.client.get("/index?before={}".format(cursor))
+            self.assertEqual(resp.status_code, 200, cursor)
+
+    def test_monthlist(self):
+        self.assert_page_queries("/monthlist/2019-05")
+        self.assertIn(b"Foto 0", self.client.get("/monthlist/2019-05").data)
+        # A month that does not exist gives an empty list.
+        for ym in ["2019-13", "2019-00", "foo", "2019-05-01"]:
+            resp = self.client.get("/monthlist/{}".format(ym))
+            self.assertEqual(resp.status_code, 200, ym)
+            self.assertNotIn(b"Foto 0", resp.data, ym)
+
+    def test_node(self):
+        self.assert_page_queries("/node/{}".format(self.book_id))
+
+    def test_node_body(self):
+        # The body is html from the editor, it is shown as entered.
+        body = "<p>Zie http://www.example.com</p>\n<p>Snoeien in maart</p>"
+        Content.update(node_id=self.book_id, title="Tuin", body=body)
+        self.assertIn(body.encode(), self.client.get("/node/{}".format(self.book_id)).data)
+
+    def test_taxonomy(self):
+        self.assert_page_queries("/taxonomy/{}".format(self.term_ids[0]))
+
+    def test_taxpics(self):
+        self.assert_page_queries("/taxpics/{}".format(self.term_ids[0]))
+
+    def test_timeline(self):
+        node = Node.query.filter_by(type="photo").order_by(Node.created).all()[NR_NODES // 2]
+        self.assert_page_queries("/timeline/{}/{}".format(self.term_ids[0], node.created))
+
+    def test_term_neighbours(self):
+        nodes = get_nodes_for_term(self.term_ids[0], profile="pics", pics=True).all()
+        self.assertEqual(len(nodes), NR_NODES)
+        prev_node, next_node = get_term_neighbours(self.term_ids[0], nodes[1].created)
+        self.assertEqual((prev_node, next_node), (nodes[0], nodes[2]))
+        self.assertEqual(get_term_neighbours(self.term_ids[0], nodes[0].created)[0], None)
+        self.assertEqual(get_term_neighbours(self.term_ids[0], nodes[-1].created)[1], None)
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment with the schema from the migrations: create tables, remove the lookup indexes and
+        # upgrade.
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+        query = "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%' AND sql NOT LIKE '%UNIQUE%'"
+        for row in db.session.execute(text(query)).fetchall():
+            db.session.execute(text("DROP INDEX {}".format(row.name)))
+        db.session.commit()
+        db_migrate.upgrade()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    @staticmethod
+    def get_indexes():
+        query = "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'"
+        return {row.name for row in db.session.execute(text(query))}
+
+    def assert_no_scan(self, query, params=None):
+        """
+        The query plan must not have a table scan, a scan using an index is OK. Scans of the recursive CTEs and of the
+        subqueries (anon_) are OK.
+
+        :param query: SQLAlchemy Query or SQL string.
+        :param params: Parameters for the SQL string.
+        """
+        if not isinstance(query, str):
+            query = str(query.with_labels().statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        plan = [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + query), params or {})]
+        scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step and "CONSTANT" not in step
+                 and "ancestors" not in step and "tree" not in step and "anon_" not in step]
+        self.assertEqual(scans, [], "{}\n{}".format(query, "\n".join(plan)))
+
+    def test_migration(self):
+        self.assertEqual(db_migrate.get_version(), db_migrate.latest_version())
+        model_indexes = {index.name for table in db.metadata.tables.values() for index in table.indexes}
+        self.assertEqual(self.get_indexes(), model_indexes)
+        self.assertEqual(db_migrate.upgrade(), [])
+
+    def test_content(self):
+        self.assert_no_scan(Content.query.filter_by(node_id=1))
+
+    def test_history(self):
+        self.assert_no_scan(History.query.filter_by(node_id=1))
+
+    def test_node(self):
+        self.assert_no_scan(Node.query.options(*LOADER_PROFILES["node"]).filter_by(id=1))
+        self.assert_no_scan(Node.query.filter(Node.parent_id == 1))
+        self.assert_no_scan(get_node_list())
+        self.assert_no_scan(get_node_list("modified"))
+
+    def test_node_tree(self):
+        self.assert_no_scan(TREE_QUERY, dict(parent_id=-1, exclnid=-1))
+
+    def test_nodes_for_month(self):
+        self.assert_no_scan(get_nodes_for_month("2019-05"))
+
+    def test_nodes_for_term(self):
+        self.assert_no_scan(get_nodes_for_term(1))
+        self.assert_no_scan(get_nodes_for_term(1, profile="pics", pics=True))
+        query = get_nodes_for_term(1, profile="pics", pics=True).order_by(None)
+        self.assert_no_scan(query.filter(Node.created > 1).order_by(Node.created.asc()).limit(1))
+        self.assert_no_scan(query.filter(Node.created < 1).order_by(Node.created.desc()).limit(1))
+
+    def test_photo(self):
+        self.assert_no_scan(Photo.query.filter_by(filename="foto.jpg"))
+        self.assert_no_scan(Photo.query.filter_by(node_id=1))
+        self.assert_no_scan(Photo.query.filter_by(fresh=1).order_by(Photo.created.asc()).limit(1))
+        self.assert_no_scan(db.session.query(db.func.count(Photo.id)).filter_by(fresh=1))
+
+    def test_pics(self):
+        self.assert_no_scan(get_pics())
+        self.assert_no_scan(get_pics_ids())
+        self.assert_no_scan(get_pics_ids((1556700000, 10)))
+        self.assert_no_scan(get_pics_ids((1556700000, 10), before=True))
+        # Each picture type is read in index order, only the merged page is sorted.
+        query = str(get_pics_ids().statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        plan = [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + query))]
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+
+    def test_view_count(self):
+        self.assert_no_scan(get_most_viewed())
+
+    def test_taxonomy(self):
+        self.assert_no_scan(Taxonomy.query.filter(Taxonomy.term_id.in_([1, 2]), Taxonomy.node_id == 1))
+        self.assert_no_scan(Taxonomy.query.filter_by(node_id=1, term_id=1))
+        self.assert_no_scan(Term.query.filter_by(vocabulary_id=1))
+
+
+class TestUnitOfWork(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+        db_migrate.upgrade()
+        voc = Vocabulary(name="Planten")
+        db.session.add(voc)
+        db.session.commit()
+        self.term_ids = [Term.add(vocabulary_id=voc.id, name="Plant {}".format(cnt)) for cnt in range(NR_NODES)]
+        self.commits = 0
+        event.listen(db.session(), "after_commit", self.count_commit)
+
+    def tearDown(self):
+        event.remove(db.session(), "after_commit", self.count_commit)
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    def count_commit(self, session):
+        self.commits += 1
+
+    def test_node(self):
+        with unit_of_work():
+            nid = Node.add(type="blog")
+            Content.update(node_id=nid, title="Blog", body="Body")
+            update_taxonomy_for_node(nid, self.term_ids)
+        self.assertEqual(self.commits, 1)
+        self.assertEqual(Taxonomy.query.filter_by(node_id=nid).count(), NR_NODES)
+        self.commits = 0
+        update_taxonomy_for_node(nid, self.term_ids[:1])
+        self.assertEqual(self.commits, 1)
+        self.assertEqual(Taxonomy.query.filter_by(node_id=nid).count(), 1)
+
+    def test_taxonomy_unique(self):
+        nid = Node.add(type="blog")
+        # Terms from the form are strings, a term can be in both lists.
+        update_taxonomy_for_node(nid, [str(term_id) for term_id in self.term_ids + self.term_ids[:2]])
+        self.assertEqual(Taxonomy.query.filter_by(node_id=nid).count(), NR_NODES)
+        with self.assertRaises(IntegrityError):
+            Taxonomy.add(node_id=nid, term_id=self.term_ids[0])
+        db.session.rollback()
+
+    def test_history(self):
+        History.record([[1, 100], [2, 200], [1, 300]])
+        History.record([[1, 250]])
+        self.assertEqual(self.commits, 2)
+        self.assertEqual(History.query.count(), 4)
+        counts = {row.node_id: (row.cnt, row.last_view) for row in ViewCount.query}
+        self.assertEqual(counts, {1: (3, 300), 2: (1, 200)})
+
+    def test_delete(self):
+        nid = Node.add(type="photo")
+        Photo.add(node_id=nid, filename="foto.jpg", created=1556700000, fresh=1)
+        Content.update(node_id=nid, title="Foto", body="Body")
+        self.commits = 0
+        Node.delete(nid)
+        self.assertEqual(self.commits, 1)
+        self.assertEqual((Node.query.count(), Photo.query.count(), Content.query.count()), (0, 0, 0))
+
+    def test_delete_rollback(self):
+        nid = Node.add(type="photo")
+        Photo.add(node_id=nid, filename="foto.jpg", created=1556700000, fresh=1)
+        Content.update(node_id=nid, title="Foto", body="Body")
+        remove = Archive.remove
+        Archive.remove = staticmethod(lambda created: 1 / 0)
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                Node.delete(nid)
+        finally:
+            Archive.remove = remove
+        self.assertEqual((Node.query.count(), Photo.query.count(), Content.query.count()), (1, 1, 1))
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                nid = Node.add(type="blog")
+                Content.update(node_id=nid, title="Blog", body="Body")
+                raise ValueError("Test")
+        self.assertEqual(self.commits, 0)
+        self.assertEqual(Node.query.count(), 0)
+        self.assertEqual(Content.query.count(), 0)
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        # Initialize Environment, the search index is created by the migrations.
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+        db_migrate.upgrade()
+        self.title_id = self.add_node("Rozen snoeien", "<p>Snoeien in maart.</p>")
+        self.body_id = self.add_node("Maart", "<p>De rozen worden in maart gesnoeid & bemest.</p>")
+        self.other_id = self.add_node("Appel", "<p>Een appel boom.</p>")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    @staticmethod
+    def add_node(title, body):
+        nid = Node.add(type="blog")
+        Content.update(node_id=nid, title=title, body=body)
+        return nid
+
+    @staticmethod
+    def search_ids(term):
+        return [node["nid"] for node in search_term(term)]
+
+    def test_ranking(self):
+        # A match on the title weighs more than a match on the body.
+        self.assertEqual(self.search_ids("rozen"), [self.title_id, self.body_id])
+        self.assertEqual(self.search_ids("maart"), [self.body_id, self.title_id])
+        # Diacritics are removed.
+        self.assertEqual(self.search_ids("appél"), [self.other_id])
+        self.assertEqual(self.search_ids("peren"), [])
+
+    def test_snippet(self):
+        node = search_term("rozen")[1]
+        self.assertEqual(node["title"], "Maart")
+        self.assertEqual(node["parent"], "Main")
+        # Html tags are not indexed, the snippet is escaped and the matches are marked.
+        self.assertEqual(node["snippet"].strip(), "De <mark>rozen</mark> worden in maart gesnoeid &amp; bemest.")
+
+    def test_phrase(self):
+        # Not a valid fts5 query, the term is searched as a phrase.
+        self.assertEqual(self.search_ids("appel-boom"), [self.other_id])
+        self.assertEqual(self.search_ids('"appel'), [self.other_id])
+        self.assertEqual(self.search_ids("boom-appel"), [])
+
+    def test_sync(self):
+        nid = self.add_node("Tulpen", "<p>Planten in oktober.</p>")
+        self.assertEqual(self.search_ids("tulpen"), [nid])
+        Content.update(node_id=nid, title="Narcissen", body="<p>Planten in oktober.</p>")
+        self.assertEqual(self.search_ids("tulpen"), [])
+        self.assertEqual(self.search_ids("narcissen"), [nid])
+        Node.delete(nid)
+        self.assertEqual(self.search_ids("narcissen"), [])
+        self.assertEqual(self.search_ids("oktober"), [])
+
+    def test_rebuild(self):
+        Content.update(node_id=self.other_id, title="Appel", body="<p>De appel boom bij de rozen.</p>")
+        terms = ["rozen", "maart", "appel", "appel-boom"]
+        before = [search_term(term) for term in terms]
+        self.assertEqual(search_index_rebuild(), 3)
+        self.assertEqual([search_term(term) for term in terms], before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+This procedure will test the temp photo handler against a pcloud stub with pictures in memory. A picture of which the
+medium format is loaded in an earlier run is not downloaded again.
+"""
+
+import io
+import unittest
+from unittest import mock
+
+from PIL import Image
+from tuin import create_app, db
+from tuin.lib import pcloud_handler, temp_handler
+from tuin.lib.db_model import Ingest
+
+# pcloud folder IDs
+PUBLIC = 1
+ORIGINAL = 3
+MEDIUM = 4
+SMALL = 5
+
+
+class TestConfig:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    REDIS_URL = "redis://localhost:6379/15"
+    SECRET_KEY = "test"
+    ORIGINAL_FOLDER = "original/"
+    MEDIUM_FOLDER = "medium/"
+    SMALL_FOLDER = "small/"
+
+
+def make_jpeg(width, height):
+    image = Image.new("RGB", (width, height), (200, 30, 30))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def filedata(fileid, name, folderid, content):
+    return dict(fileid=fileid, name=name, parentfolderid=folderid, size=len(content), content=content)
+
+
+class PcloudStub:
+    """
+    Stub for the PcloudHandler. Uploads are stored in their folder, downloads are registered.
+    """
+
+    def __init__(self, *files):
+        self.files = list(files)
+        self.downloads = []
+
+    def get_public_cloud_id(self):
+        return PUBLIC
+
+    def folder_contents(self, folderid):
+        if folderid == PUBLIC:
+            subdirs = dict(original=dict(folderid=ORIGINAL), medium=dict(folderid=MEDIUM), small=dict(folderid=SMALL))
+            return subdirs, {}
+        return {}, {file["name"]: file for file in self.files if file["parentfolderid"] == folderid}
+
+    def find_file(self, folderid, name):
+        return self.folder_contents(folderid)[1].get(name)
+
+    def get_content(self, file):
+        self.downloads.append((file["name"], file["parentfolderid"]))
+        return file["content"]
+
+    def upload_content(self, filename, content, folderid):
+        self.files.append(filedata(len(self.files) + 100, filename, folderid, content.read()))
+        return dict(result=0)
+
+    def close_connection(self):
+        return
+
+
+class TestTempHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_ctx = self.app.app_context()
+        self.app_ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_ctx.pop()
+
+    def run_handler(self, pcloud):
+        with mock.patch.object(pcloud_handler, "PcloudHandler", return_value=pcloud):
+            return temp_handler.photo_handler()
+
+    def test_resume(self):
+        # The medium format of a.jpg is loaded in an earlier run, b.jpg is new.
+        first = filedata(11, "a.jpg", ORIGINAL, make_jpeg(1600, 1200))
+        second = filedata(12, "b.jpg", ORIGINAL, make_jpeg(1200, 900))
+        pcloud = PcloudStub(first, second, filedata(21, "a.jpg", MEDIUM, make_jpeg(800, 600)))
+        Ingest.init_table()
+        Ingest.add(temp_handler.JOB, first, "medium")
+        self.assertEqual(self.run_handler(pcloud), 2)
+        self.assertEqual(pcloud.downloads, [("a.jpg", MEDIUM), ("b.jpg", ORIGINAL)])
+        _, medium = pcloud.folder_contents(MEDIUM)
+        _, small = pcloud.folder_contents(SMALL)
+        self.assertEqual(sorted(medium), ["a.jpg", "b.jpg"])
+        self.assertEqual(sorted(small), ["a.jpg", "b.jpg"])
+        self.assertEqual(Image.open(io.BytesIO(small["a.jpg"]["content"])).size, (200, 150))
+        self.assertEqual(Ingest.pending(temp_handler.JOB, "medium"), [])
+
+    def test_medium_missing(self):
+        # The medium format is registered, but not on pcloud: the picture is handled again.
+        first = filedata(11, "a.jpg", ORIGINAL, make_jpeg(1600, 1200))
+        pcloud = PcloudStub(first)
+        Ingest.init_table()
+        Ingest.add(temp_handler.JOB, first, "medium")
+        self.assertEqual(self.run_handler(pcloud), 1)
+        self.assertEqual(pcloud.downloads, [("a.jpg", ORIGINAL)])
+        self.assertEqual(sorted(pcloud.folder_contents(MEDIUM)[1]), ["a.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()